@@ -0,0 +1,149 @@
+""" Benchmark of DynamicStateMachine.next() on the ExampleMachine from the README.
+
+Compares the precompiled dispatch plan against the old per-step reflection (inspect.signature, hasattr and getattr
+with string concatenation on every transition and hook), which is reimplemented here as LegacyExampleMachine.
+
+Run with:
+    python benchmarks/bench_next.py [--number N] [--repeat R]
+"""
+import argparse
+import inspect
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from DynamicStateMachine import DynamicStateMachine, States, State
+
+
+class ExampleStates(States):
+    a = 'this is a'
+    b = 'this is b'
+    c = 'this is c'
+    # A virtual State
+    pre_c = None
+
+
+class ExampleMachine(DynamicStateMachine):
+    # Same as the README, but without the prints, so we time the machine and not the terminal
+    def before_a(self): pass
+    def after_a(self): pass
+    def before_c(self): pass
+    def before_pre_c(self): pass
+    def after_pre_c(self): pass
+
+    def do_the_thing(self, decider=True):
+        if decider:
+            return ExampleStates.a, 'if decider is True'
+        else:
+            return ExampleStates.pre_c
+
+    def decide_if_done(self, done=False):
+        if done:
+            return None, 'Im done talking to you now.'
+        else:
+            return ExampleStates.a, 'no keep going!'
+
+    states = ExampleStates
+    initial = ExampleStates.a
+    transitions = (
+        ExampleStates.a >> ExampleStates.b,
+        ExampleStates.b >> do_the_thing,
+        ExampleStates.pre_c >> ExampleStates.c,
+        ExampleStates.c >> decide_if_done,
+    )
+
+
+class LegacyExampleMachine(ExampleMachine):
+    """ ExampleMachine, dispatched the way DynamicStateMachine used to do it """
+
+    def __init__(self, *args, **kwargs):
+        # Simple transitions used to be lambdas that return the State
+        self._legacy_transitions = {
+            s: (lambda *a, _t=t, **k: _t) if isinstance(t, State) else t
+            for s, t in self.transitions
+        }
+        super().__init__(*args, **kwargs)
+
+    def _call_function_with_correct_params(self, func, *args, **kwargs):
+        try:
+            if hasattr(self, func.__name__):
+                args = (self,) + args
+        except:
+            raise TypeError('func must be a function')
+        sig = inspect.signature(func)
+        args = args[:len(sig.parameters)]
+        kwargs = {k: v for k, v in kwargs.items() if k in sig.parameters}
+        return func(*args, **kwargs)
+
+    def set_state(self, new, *args, side_effects=True, **kwargs):
+        old = self._state
+        if new is None:
+            self._state = None
+            self.on_end()
+            return
+        if type(new) is tuple and len(new) == 2 and type(new[1]) is str:
+            new = new[0]
+        if new not in self.states._states_list:
+            raise ValueError('Invalid state given. self.states be a member of self.states.')
+        if side_effects:
+            if old is not None:
+                if (method := getattr(self, 'after_' + old.name, False)):
+                    self._call_function_with_correct_params(method, *args, **kwargs)
+            if (method := getattr(self, 'before_' + new.name, False)):
+                self._call_function_with_correct_params(method, *args, **kwargs)
+            if (method := getattr(self, 'on_' + new.name, False)):
+                self._call_function_with_correct_params(method, *args, **kwargs)
+        self._state = new
+
+    def next(self, *args, **kwargs):
+        do = True
+        while not self.finished and (self.state.virtual or do):
+            do = False
+            next_state = self._call_function_with_correct_params(self._legacy_transitions[self.state], *args, **kwargs)
+            while True:
+                try:
+                    next_state = self._call_function_with_correct_params(next_state, *args, **kwargs)
+                except TypeError:
+                    break
+            if isinstance(next_state, (list, tuple)):
+                next_state = next_state[0]
+            self.set_state(next_state, *args, **kwargs)
+        return self.state
+
+
+def cycle(m):
+    """ One trip around the README example: a -> b -> (pre_c) -> c -> a -> b -> a """
+    m.next()
+    m.next(False)
+    m.next(False)
+    m.next()
+    m.next(True)
+
+
+STEPS_PER_CYCLE = 5
+
+
+def bench(cls, number, repeat):
+    m = cls()
+    best = min(timeit.repeat(lambda: cycle(m), number=number, repeat=repeat))
+    return best / (number * STEPS_PER_CYCLE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20_000, help='cycles per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs; the best one is reported')
+    args = parser.parse_args(argv)
+
+    legacy = bench(LegacyExampleMachine, args.number, args.repeat)
+    planned = bench(ExampleMachine, args.number, args.repeat)
+
+    print(f'legacy reflection next(): {legacy * 1e6:8.3f} us/step')
+    print(f'dispatch plan next():     {planned * 1e6:8.3f} us/step')
+    print(f'speedup:                  {legacy / planned:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
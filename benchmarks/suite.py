@@ -0,0 +1,371 @@
+""" Benchmarks of DynamicStateMachine's hot paths. Everything runs offline, with only the standard library (graph
+generation is skipped if graphviz isn't installed).
+
+Run with:
+    python benchmarks/suite.py                          # run everything and print the results
+    python benchmarks/suite.py -k step                  # only the benchmarks with 'step' in their name
+    python benchmarks/suite.py --save baseline.json     # save the results...
+    python benchmarks/suite.py --compare baseline.json  # ...and compare a later run against them
+
+Times are the best of --repeat runs, so noise mostly makes things look slower, not faster. When comparing, anything
+within --tolerance of the baseline is reported as unchanged.
+"""
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from DynamicStateMachine import DynamicStateMachine, States
+
+
+BENCHMARKS = {}
+
+
+def benchmark(unit:str, lower_is_better=True):
+    """ Register a benchmark. The function takes the number of repeats, and returns a single number in `unit` """
+    def decorator(func):
+        BENCHMARKS[func.__name__] = (func, unit, lower_is_better)
+        return func
+    return decorator
+
+
+def best_per_call(func, number:int, repeat:int) -> float:
+    """ The best time per call to func, in microseconds """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def make_states(n:int, virtual_every:int=0) -> type:
+    """ Generate a States subclass with n states, s0 to s{n-1}. If virtual_every is set, every virtual_every'th
+    state is virtual.
+    """
+    namespace = {f's{i}': None if virtual_every and i % virtual_every == virtual_every - 1 else i for i in range(n)}
+    return type(f'States{n}', (States,), namespace)
+
+
+def make_machine(states:type, **namespace) -> type:
+    """ Generate a machine over `states` which goes through them in a loop with simple transitions """
+    members = states._states_list
+    namespace.setdefault('transitions', tuple(s >> members[(i + 1) % len(members)] for i, s in enumerate(members)))
+    return type(f'Machine{len(members)}', (DynamicStateMachine,), dict(states=states, initial=members[0], **namespace))
+
+
+# Import
+
+@benchmark('ms')
+def import_package(repeat):
+    # In a fresh interpreter each time, minus the time it takes to start one
+    src = str(Path(__file__).resolve().parent.parent / 'src')
+    def run(code):
+        return min(timeit.repeat(lambda: subprocess.run([sys.executable, '-c', code], check=True, cwd=src),
+                                 number=1, repeat=repeat))
+    return (run('import DynamicStateMachine') - run('pass')) * 1e3
+
+
+# Step throughput
+
+SimpleStates = make_states(10)
+SimpleMachine = make_machine(SimpleStates)
+
+
+@benchmark('us/step')
+def step_simple(repeat):
+    m = SimpleMachine()
+    return best_per_call(m.next, 100_000, repeat)
+
+
+class MethodStates(States):
+    a = 'a'
+    b = 'b'
+    c = 'c'
+
+
+class MethodMachine(DynamicStateMachine):
+    def route(self, kind='b'):
+        return MethodStates.b if kind == 'b' else MethodStates.c
+
+    def chained(self, x=0):
+        return self.back, 'chained'
+
+    def back(self, x=0):
+        return MethodStates.a
+
+    states = MethodStates
+    initial = MethodStates.a
+    transitions = (
+        MethodStates.a >> route,
+        MethodStates.b >> chained,
+        MethodStates.c >> back,
+    )
+
+
+@benchmark('us/step')
+def step_method(repeat):
+    m = MethodMachine()
+    return best_per_call(lambda: m.next(kind='b', x=1), 100_000, repeat)
+
+
+VirtualStates = make_states(40, virtual_every=4)
+VirtualMachine = make_machine(VirtualStates)
+
+
+@benchmark('us/step')
+def step_virtual_chain(repeat):
+    # Every 4th state is virtual, so each next() goes through one
+    m = VirtualMachine()
+    return best_per_call(m.next, 100_000, repeat)
+
+
+def _hook(name:str):
+    def hook(self, *args, **kwargs):
+        pass
+    # Methods are recognised by their name
+    hook.__name__ = name
+    return hook
+
+
+HookStates = make_states(10, virtual_every=5)
+HookMachine = make_machine(HookStates, **{
+    name: _hook(name) for state in HookStates._states_list for name in (f'before_{state.name}', f'after_{state.name}', f'on_{state.name}')
+})
+
+
+@benchmark('us/step')
+def step_hooks(repeat):
+    m = HookMachine()
+    return best_per_call(lambda: m.next(1, key=2), 100_000, repeat)
+
+
+@benchmark('us/step')
+def step_method_compiled(repeat):
+    m = MethodMachine.compile()()
+    return best_per_call(lambda: m.next(kind='b', x=1), 100_000, repeat)
+
+
+@benchmark('us/step')
+def step_hooks_compiled(repeat):
+    m = HookMachine.compile()()
+    return best_per_call(lambda: m.next(1, key=2), 100_000, repeat)
+
+
+# Instances
+
+@benchmark('us/instance')
+def instantiate(repeat):
+    return best_per_call(SimpleMachine, 20_000, repeat)
+
+
+@benchmark('us/call')
+def peek_method(repeat):
+    m = MethodMachine()
+    return best_per_call(lambda: m.peek(kind='b', x=1), 100_000, repeat)
+
+
+@benchmark('us/instance')
+def fork(repeat):
+    m = SimpleMachine()
+    return best_per_call(m.fork, 100_000, repeat)
+
+
+SlimMachine = make_machine(SimpleStates, __slots__=())
+
+
+@benchmark('bytes/instance')
+def memory_per_instance(repeat):
+    return _bytes_per_instance(SimpleMachine)
+
+
+# About 49 bytes on CPython 3.11, compared to about 89 for memory_per_instance. The state (and any other slots) are
+# kept in the object itself, instead of in a __dict__.
+@benchmark('bytes/instance')
+def memory_per_slotted_instance(repeat):
+    return _bytes_per_instance(SlimMachine)
+
+
+def _bytes_per_instance(cls, n=20_000):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    machines = [cls() for _ in range(n)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Don't count the list holding them
+    return (after - before) / len(machines) - 8
+
+
+# Class creation
+
+@benchmark('ms')
+def states_class_10k(repeat):
+    namespace = {f's{i}': i for i in range(10_000)}
+    return min(timeit.repeat(lambda: type('Big', (States,), dict(namespace)), number=1, repeat=repeat)) * 1e3
+
+
+@benchmark('ms')
+def states_from_mapping_100k(repeat):
+    mapping = {f's{i}': i for i in range(100_000)}
+    return min(timeit.repeat(lambda: States.from_mapping('Big', mapping), number=1, repeat=repeat)) * 1e3
+
+
+BigStates = make_states(10_000, virtual_every=100)
+
+
+@benchmark('ms')
+def machine_class_10k(repeat):
+    members = BigStates._states_list
+    transitions = tuple(s >> members[(i + 1) % len(members)] for i, s in enumerate(members))
+    return min(timeit.repeat(lambda: make_machine(BigStates, transitions=transitions), number=1, repeat=repeat)) * 1e3
+
+
+# Graphs
+
+def _make_graph_machine(n:int) -> type:
+    states = make_states(n, virtual_every=7)
+    members = states._states_list
+    namespace = {}
+    transitions = []
+    for i, state in enumerate(members):
+        if i % 5 == 0:
+            # A transition method which can go to either of the next two states
+            a, b = members[(i + 1) % n], members[(i + 2) % n]
+            exec(f'def go_{i}(self, x=True):\n    return {states.__name__}.{a.name} if x else {states.__name__}.{b.name}',
+                 {states.__name__: states}, namespace)
+            transitions.append(state >> namespace[f'go_{i}'])
+        else:
+            transitions.append(state >> members[(i + 1) % n])
+    return make_machine(states, transitions=tuple(transitions), **namespace)
+
+
+@benchmark('ms')
+def graph_2k_cold(repeat):
+    try:
+        import graphviz
+    except ImportError:
+        return None
+    from DynamicStateMachine import analysis_cache
+
+    cls = _make_graph_machine(2_000)
+    m = cls()
+    def build():
+        analysis_cache.clear()
+        cls._plan.graphs.clear()
+        m.construct_graphvis()
+    return min(timeit.repeat(build, number=1, repeat=repeat)) * 1e3
+
+
+@benchmark('ms')
+def graph_2k_warm(repeat):
+    try:
+        import graphviz
+    except ImportError:
+        return None
+    cls = _make_graph_machine(2_000)
+    m = cls()
+    m.construct_graphvis()
+    return min(timeit.repeat(m.construct_graphvis, number=1, repeat=repeat)) * 1e3
+
+
+@benchmark('ms')
+def export_dot_2k(repeat):
+    import io
+    from DynamicStateMachine import write_dot
+
+    cls = _make_graph_machine(2_000)
+    write_dot(cls, io.StringIO())
+    return min(timeit.repeat(lambda: write_dot(cls, io.StringIO()), number=1, repeat=repeat)) * 1e3
+
+
+# Timeouts
+
+TimeoutStates = make_states(2)
+TimeoutMachine = make_machine(TimeoutStates, timeouts={TimeoutStates.s0: (30, TimeoutStates.s1)})
+
+
+@benchmark('us/timer')
+def timer_wheel_add(repeat):
+    from DynamicStateMachine import TimerWheel
+
+    wheel = TimerWheel(clock=lambda: 0.0)
+    m = TimeoutMachine()
+    return best_per_call(lambda: wheel.add(m), 100_000, repeat)
+
+
+@benchmark('ms')
+def timer_wheel_expire_100k(repeat):
+    from DynamicStateMachine import TimerWheel
+
+    now = [0.0]
+    machines = [TimeoutMachine() for _ in range(100_000)]
+    def expire():
+        now[0] = 0.0
+        wheel = TimerWheel(clock=lambda: now[0])
+        for i, m in enumerate(machines):
+            m._state = TimeoutStates.s0
+            now[0] = i * 1e-4
+            wheel.add(m)
+        now[0] = 60.0
+        return wheel.advance
+    return min(timeit.repeat('advance()', setup='advance = expire()', number=1, repeat=repeat,
+                             globals=dict(expire=expire))) * 1e3
+
+
+def run(selected:list[str], repeat:int) -> dict[str, float|None]:
+    results = {}
+    for name in selected:
+        func, unit, _ = BENCHMARKS[name]
+        results[name] = value = func(repeat)
+        print(f'{name:30} {"skipped" if value is None else f"{value:12.3f}"} {unit}', flush=True)
+    return results
+
+
+def compare(results:dict[str, float|None], baseline:dict[str, float|None], tolerance:float) -> int:
+    """ Print how the results compare to the baseline. Returns how many benchmarks got worse. """
+    worse = 0
+    print(f'\n{"benchmark":30} {"baseline":>12} {"now":>12} {"change":>8}')
+    for name, value in results.items():
+        old = baseline.get(name)
+        if value is None or old is None:
+            continue
+        _, unit, lower_is_better = BENCHMARKS[name]
+        change = value / old - 1 if old else 0.0
+        if abs(change) <= tolerance:
+            verdict = 'same'
+        elif (change < 0) == lower_is_better:
+            verdict = 'better'
+        else:
+            verdict = 'WORSE'
+            worse += 1
+        print(f'{name:30} {old:12.3f} {value:12.3f} {change:+8.1%} {verdict}')
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='filter', default='', help='only run benchmarks with this in their name')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs per benchmark; the best one is used')
+    parser.add_argument('--save', type=Path, help='save the results to this JSON file')
+    parser.add_argument('--compare', type=Path, help='compare the results to ones saved with --save')
+    parser.add_argument('--tolerance', type=float, default=.05, help='relative change still considered the same')
+    args = parser.parse_args(argv)
+
+    selected = [name for name in BENCHMARKS if args.filter in name]
+    print(f'Python {platform.python_version()} ({platform.python_implementation()}) on {platform.platform()}\n')
+    results = run(selected, args.repeat)
+
+    if args.save:
+        args.save.write_text(json.dumps(dict(python=platform.python_version(), results=results), indent=2))
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())['results']
+        # Exit non-zero if anything regressed, so it can be used in CI
+        return 1 if compare(results, baseline, args.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
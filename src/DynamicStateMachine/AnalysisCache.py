@@ -0,0 +1,125 @@
+import hashlib
+import marshal
+import os
+import tempfile
+from importlib.util import MAGIC_NUMBER
+from pathlib import Path
+from typing import Any, Callable
+
+
+class AnalysisCache:
+    """ Caches the results of analysing transition methods (i.e. DynamicStateMachine.get_returns_dis() and
+    get_returns_ast()), so rendering a machine again doesn't have to re-walk the bytecode or re-parse the source of
+    every method.
+
+    Results are kept in memory, keyed by the function's code object, and, if `directory` is set, on disk, keyed by a
+    hash of the compiled code (so it's shared between processes, and goes stale on its own when a method changes).
+    The files are written with marshal, and only results made of plain data (None, bools, numbers, strings, bytes,
+    and lists, tuples, dicts, and frozensets of them) are read back, so nothing in the directory can run code.
+    """
+
+    def __init__(self, directory:str|os.PathLike|None=None):
+        self.directory = directory
+        """ The directory to keep the on-disk cache in. If None, results are only cached in memory. """
+        self._memory:dict[tuple[str, Any], Any] = {}
+        self.hits = 0
+        """ How many times a result was found in the cache (in memory or on disk) """
+        self.misses = 0
+        """ How many times a function had to be analysed """
+
+    @property
+    def directory(self) -> Path|None:
+        return self._directory
+
+    @directory.setter
+    def directory(self, directory:str|os.PathLike|None):
+        self._directory = None if directory is None else Path(directory)
+
+    @staticmethod
+    def _disk_key(backend:str, code) -> str:
+        # marshal includes everything about the code, including nested code objects and (for the ast backend) where
+        # it was defined. The magic number changes along with the bytecode format.
+        return hashlib.sha256(MAGIC_NUMBER + backend.encode() + marshal.dumps(code)).hexdigest()
+
+    def get(self, func:Callable, backend:str, analyse:Callable[[Callable], Any]) -> Any:
+        """ Get the result of analyse(func) with the given backend, from the cache if it's in there """
+        code = getattr(func, '__code__', None)
+        # Things like callable instances don't have a code object to key off of
+        if code is None:
+            self.misses += 1
+            return analyse(func)
+
+        key = (backend, code)
+        try:
+            rtn = self._memory[key]
+            self.hits += 1
+            return rtn
+        except KeyError:
+            pass
+
+        path = None
+        if self._directory is not None:
+            path = self._directory / (self._disk_key(backend, code) + '.marshal')
+            try:
+                with open(path, 'rb') as f:
+                    rtn = marshal.load(f)
+            except (OSError, ValueError, EOFError, TypeError):
+                pass
+            else:
+                if _is_plain(rtn):
+                    self._memory[key] = rtn
+                    self.hits += 1
+                    return rtn
+
+        self.misses += 1
+        rtn = self._memory[key] = analyse(func)
+
+        if path is not None:
+            self._save(path, rtn)
+        return rtn
+
+    def _save(self, path:Path, result:Any):
+        """ Write a result to disk, atomically, so other workers never see half a file. Failing to write the cache
+        isn't an error, it just won't be cached.
+        """
+        if not _is_plain(result):
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    marshal.dump(result, f)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except (OSError, ValueError):
+            pass
+
+    def clear(self, disk=False):
+        """ Forget everything in memory, and if disk is True, everything in the directory as well """
+        self._memory.clear()
+        if disk and self._directory is not None and self._directory.is_dir():
+            for path in self._directory.glob('*.marshal'):
+                path.unlink(missing_ok=True)
+
+
+_PLAIN_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+
+def _is_plain(value:Any) -> bool:
+    """ If value is only made of plain data, and not things like code objects """
+    if type(value) in _PLAIN_TYPES:
+        return True
+    if type(value) in (list, tuple, frozenset):
+        return all(_is_plain(item) for item in value)
+    if type(value) is dict:
+        return all(_is_plain(k) and _is_plain(v) for k, v in value.items())
+    return False
+
+
+analysis_cache = AnalysisCache()
+""" The cache used by DynamicStateMachine.get_returns_dis() and get_returns_ast(). Set
+`analysis_cache.directory` to also cache results on disk.
+"""
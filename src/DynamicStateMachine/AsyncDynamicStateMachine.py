@@ -0,0 +1,168 @@
+from collections.abc import Awaitable
+from itertools import repeat
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Iterable
+from .State import State
+from .Transition import Transition
+from .DynamicStateMachine import DynamicStateMachine
+
+
+async def _aiter_sync(iterable:Iterable) -> AsyncIterator:
+    for item in iterable:
+        yield item
+
+
+class AsyncDynamicStateMachine(DynamicStateMachine):
+    """ A DynamicStateMachine for use with asyncio. It's defined exactly the same way, but any of the transition
+    methods, before_/after_/on_ methods, on_start and on_end can be coroutines (`async def`), and are awaited.
+    Regular methods work too.
+
+    Because starting the machine can run coroutines, it isn't started on instantiation: use `await m.start()`.
+    next(), set_state() and start() have to be awaited, and `self.state = ...` can't be used, use
+    `await self.set_state(...)` instead. The machine can also be advanced with `async for state in m`, which calls
+    next() with no parameters until the machine finishes.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, start_immediately=False, trigger_initial_side_effects=True):
+        if start_immediately:
+            raise ValueError('AsyncDynamicStateMachine can\'t be started on instantiation, use `await m.start()`')
+        super().__init__(start_immediately=False, trigger_initial_side_effects=trigger_initial_side_effects)
+
+    async def start(self, trigger_initial_side_effects:bool|None=None):
+        """ Start the state machine. If trigger_initial_side_effects is True, the initial state's before_<state>
+        method will be called. If it's None, what was given to __init__() is used.
+        """
+        if trigger_initial_side_effects is None:
+            trigger_initial_side_effects = getattr(self, '_trigger_initial_side_effects', True)
+        if isinstance(rtn := self.on_start(), Awaitable):
+            await rtn
+        if trigger_initial_side_effects:
+            await self.set_state(self.initial)
+        else:
+            self._state = self.initial
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, new:State):
+        raise AttributeError('The state of an AsyncDynamicStateMachine must be set with `await m.set_state(...)`')
+
+    async def set_state(self, new:State|None|Any|tuple[State|None|Any, str], *args, side_effects=True, **kwargs):
+        """ The same as DynamicStateMachine.set_state(), but awaits any side effect methods that are coroutines """
+        old = self._state
+        plan = self._plan
+        comment = None
+
+        if type(new) is not State or new.owner is not self.states:
+            if type(new) is tuple and len(new) == 2 and type(new[1]) is str:
+                comment = new[1]
+            new = self._coerce_state(new)
+
+        if new is None:
+            self._state = None
+            if isinstance(rtn := self.on_end(), Awaitable):
+                await rtn
+            if plan.listeners:
+                self._notify(old, None, comment)
+            return
+
+        if side_effects:
+            for hook in (plan.after[old.id] if old is not None else None, plan.before[new.id], plan.on[new.id]):
+                if hook and isinstance(rtn := hook(self, args, kwargs), Awaitable):
+                    await rtn
+
+        self._state = new
+        if plan.listeners:
+            self._notify(old, new, comment)
+
+    async def _resolve(self, step:State|Callable, args:tuple, kwargs:dict) -> tuple[State|None, str|None]:
+        """ The same as DynamicStateMachine._resolve(), but awaits any transition methods that are coroutines """
+        if isinstance(step, State):
+            return step, None
+
+        comment = None
+        rtn = step(self, args, kwargs)
+        while True:
+            if isinstance(rtn, Awaitable):
+                rtn = await rtn
+            elif rtn is None or isinstance(rtn, State):
+                return rtn, comment
+            elif type(rtn) in (tuple, list) and len(rtn) == 2 and isinstance(rtn[1], str):
+                rtn, comment = rtn
+            elif callable(rtn):
+                rtn = self._plan.compile(rtn)(self, args, kwargs)
+            else:
+                raise TypeError(f'Transition methods must return a transition method, a State, or None. Got {rtn!r}')
+
+    async def _advance(self, args:tuple, kwargs:dict) -> str|None:
+        """ The same as DynamicStateMachine._advance(), but awaits any methods that are coroutines """
+        steps = self._plan.steps
+        comment = None
+        do = True
+        while not self.finished and (self.state.virtual or do):
+            if (step := steps[self._state.id]) is None:
+                raise KeyError(f'{self._state!r} has no transition')
+            next_state, _comment = await self._resolve(step, args, kwargs)
+            if do:
+                comment = _comment
+                do = False
+            await self.set_state(next_state if _comment is None else (next_state, _comment), *args, **kwargs)
+
+        return comment
+
+    async def next(self, *args, **kwargs) -> State:
+        """ The same as DynamicStateMachine.next(), but awaits any methods that are coroutines """
+        await self._advance(args, kwargs)
+        return self.state
+
+    async def peek(self, *args, **kwargs) -> State|None:
+        """ The same as DynamicStateMachine.peek(), but awaits any transition methods that are coroutines """
+        state = original = self._state
+        steps = self._plan.steps
+        try:
+            while state is not None:
+                if (step := steps[state.id]) is None:
+                    raise KeyError(f'{state!r} has no transition')
+                self._state = state
+                state = (await self._resolve(step, args, kwargs))[0]
+                if state is not None and state.owner is not self.states:
+                    state = self._coerce_state(state)
+                if state is None or not state.virtual:
+                    break
+        finally:
+            self._state = original
+        return state
+
+    async def run(self, events:Iterable|AsyncIterable|None=None, **kwargs) -> AsyncIterator[Transition]:
+        """ The same as DynamicStateMachine.run(), but as an async generator. events can also be an async iterable. """
+        if events is None:
+            events = repeat(())
+        if self._state is None:
+            return
+        if not hasattr(events, '__aiter__'):
+            events = _aiter_sync(events)
+
+        async for event in events:
+            old = self._state
+            comment = await self._advance(event if type(event) is tuple else (event,), kwargs)
+            yield Transition(old, self._state, comment)
+            if self._state is None:
+                return
+
+    def __next__(self):
+        raise TypeError('AsyncDynamicStateMachine must be advanced with `await m.next()` or `async for`')
+
+    @classmethod
+    def compile(cls) -> type:
+        raise TypeError('AsyncDynamicStateMachine subclasses can\'t be compiled')
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> State:
+        if self.finished:
+            raise StopAsyncIteration
+        return await self.next()
@@ -0,0 +1,182 @@
+""" Generates specialized versions of DynamicStateMachine subclasses, see DynamicStateMachine.compile() """
+from types import FunctionType
+from typing import Callable
+from .State import State
+from .DispatchPlan import DispatchPlan, accepted_params
+from .DynamicStateMachine import DynamicStateMachine
+
+
+class _Source:
+    """ The source of the generated module, and the objects it refers to """
+    def __init__(self, plan:DispatchPlan):
+        self.plan = plan
+        self.lines:list[str] = []
+        self.namespace:dict[str, object] = dict(State=State, _plan=plan, _owner=plan.machine_cls.states)
+        self._names:dict[int, str] = {}
+
+    def ref(self, obj:object, prefix:str) -> str:
+        """ The name the generated code can use to refer to obj """
+        if (name := self._names.get(id(obj))) is None:
+            name = self._names[id(obj)] = f'{prefix}{len(self._names)}'
+            self.namespace[name] = obj
+        return name
+
+    def state(self, state:State) -> str:
+        return self.ref(state, f'_{state.name}_')
+
+    def call(self, func:Callable) -> str:
+        """ An expression calling func like the compiled call from the plan would, with the parameters it accepts
+        worked out now instead of when it's called. Anything that isn't a plain function goes through the plan's
+        compiled call for it.
+        """
+        if type(func) is not FunctionType or hasattr(func, 'transition_cache'):
+            return f'{self.ref(self.plan.compile(func), "_call_")}(self, args, kwargs)'
+
+        # The same way DispatchPlan.compile() decides it
+        bind = hasattr(self.plan.machine_cls, func.__name__)
+        nargs, kwnames = accepted_params(func, bind)
+        params = ['self'] if bind else []
+        if nargs is None:
+            params.append('*args')
+        elif nargs:
+            params.append(f'*args[:{nargs}]')
+        if kwnames is None:
+            params.append('**kwargs')
+        elif kwnames:
+            names = self.ref(frozenset(kwnames), '_kw_')
+            params.append(f'**({{k: v for k, v in kwargs.items() if k in {names}}} if kwargs else kwargs)')
+        return f'{self.ref(func, f"_{func.__name__}_")}({", ".join(params)})'
+
+    def add(self, indent:int, *lines:str):
+        self.lines.extend('    ' * indent + line if line else line for line in lines)
+
+
+def _hook(plan:DispatchPlan, prefix:str, state:State) -> Callable|None:
+    """ The before_/after_/on_ method of the state, if the plan found one """
+    if {'before_': plan.before, 'after_': plan.after, 'on_': plan.on}[prefix][state.id]:
+        return getattr(plan.machine_cls, prefix + state.name)
+    return None
+
+
+def _add_step(src:_Source, state:State):
+    """ Generate the function which advances a machine out of `state`, returning the comment the transition was
+    returned with, if any.
+    """
+    plan = src.plan
+    machine_cls = plan.machine_cls
+    step = plan.steps[state.id]
+    name = src.state(state)
+    # Subclasses which override set_state() still get it called
+    inline = machine_cls.set_state is DynamicStateMachine.set_state
+    src.add(0, f'def _step_{state.id}(self, args, kwargs):')
+
+    if step is None:
+        src.add(1, f'raise KeyError(f"{{{name}!r}} has no transition")', '')
+        return
+
+    if isinstance(step, State):
+        target = src.state(step)
+        if not inline:
+            src.add(1, f'self.set_state({target}, *args, **kwargs)')
+        else:
+            # Everything's known ahead of time, so it's just the hooks that exist, in order
+            for hook in (_hook(plan, 'after_', state), _hook(plan, 'before_', step), _hook(plan, 'on_', step)):
+                if hook is not None:
+                    src.add(1, src.call(hook))
+            src.add(1,
+                f'self._state = {target}',
+                f'if _plan.listeners:',
+                f'    self._notify({name}, {target}, None)',
+            )
+        src.add(1, 'return None', '')
+        return
+
+    # Comments are only kept for the first transition of a next(), not the virtual states after it
+    comment = 'None' if state.virtual else 'comment'
+    src.add(1,
+        f'new = {src.call(plan.transitions[state])}',
+        f'if new is None or type(new) is State:',
+        f'    comment = None',
+        f'else:',
+        f'    new, comment = self._follow(new, args, kwargs)',
+    )
+    if not inline:
+        src.add(1, f'self.set_state(new if {comment} is None else (new, {comment}), *args, **kwargs)', 'return comment', '')
+        return
+
+    src.add(1,
+        # The transition method changed the state itself, so it's not known which after_ method to call
+        f'if self._state is not {name}:',
+        f'    self.set_state(new if {comment} is None else (new, {comment}), *args, **kwargs)',
+        f'    return comment',
+        f'if new is None:',
+        f'    self._state = None',
+        f'    self.on_end()',
+        f'    if _plan.listeners:',
+        f'        self._notify({name}, None, {comment})',
+        f'    return comment',
+        f'if new.owner is not _owner:',
+        f'    new = self._coerce_state(new)',
+    )
+    if (after := _hook(plan, 'after_', state)) is not None:
+        src.add(1, src.call(after))
+    src.add(1,
+        f'if (hook := _plan.before[new.id]):',
+        f'    hook(self, args, kwargs)',
+        f'if (hook := _plan.on[new.id]):',
+        f'    hook(self, args, kwargs)',
+        f'self._state = new',
+        f'if _plan.listeners:',
+        f'    self._notify({name}, new, {comment})',
+        f'return comment',
+        '',
+    )
+
+
+def compile_machine(machine_cls:type) -> type:
+    """ Generate a subclass of machine_cls with an _advance() (which next() and run() use) written out for its
+    transitions: one function per state, with simple transitions calling only the hooks that exist, and every
+    transition method and hook called with the parameters it accepts worked out ahead of time. The current state's
+    function is picked by its State.id.
+
+    The subclass shares machine_cls's DispatchPlan, so listeners added to either are called for both, and while a
+    Profiler is attached to either, it runs through the plan like machine_cls does, so it's profiled too. Hooks and
+    transition methods are looked up when it's generated, so changes to machine_cls after that aren't picked up.
+    """
+    plan = machine_cls._get_plan()
+    src = _Source(plan)
+    states = machine_cls.states._states_list
+    for state in states:
+        _add_step(src, state)
+
+    src.add(0,
+        'def _advance(self, args, kwargs):',
+        '    # The hooks above are called directly, so while a Profiler has swapped them in the plan, use the plan',
+        '    if _plan.profilers:',
+        '        return _original_advance(self, args, kwargs)',
+        '    state = self._state',
+        '    if state is None:',
+        '        return None',
+        '    comment = _steps[state.id](self, args, kwargs)',
+        '    # Virtual states go straight on to the next state',
+        '    while (state := self._state) is not None and state.virtual:',
+        '        _steps[state.id](self, args, kwargs)',
+        '    return comment',
+    )
+    namespace = src.namespace
+    namespace['_original_advance'] = machine_cls._advance
+    exec(compile('\n'.join(src.lines), f'<compiled {machine_cls.__qualname__}>', 'exec'), namespace)
+    namespace['_steps'] = tuple(namespace[f'_step_{state.id}'] for state in states)
+
+    # With _plan already in it, so __init_subclass__() doesn't build another one
+    compiled = type(machine_cls.__name__, (machine_cls,), dict(
+        __slots__=(),
+        _plan=plan,
+        __module__=machine_cls.__module__,
+        __qualname__=machine_cls.__qualname__,
+        __doc__=machine_cls.__doc__,
+        _advance=namespace['_advance'],
+    ))
+    compiled._compiled = compiled
+    compiled._source = '\n'.join(src.lines)
+    return compiled
@@ -0,0 +1,254 @@
+from types import FunctionType, MemberDescriptorType, MethodType
+from typing import Any, Callable
+from .State import State
+from .TransitionCache import TransitionCache
+
+
+def accepted_params(func:Callable, bind:bool) -> tuple[int|None, set[str]|None]:
+    """ How many positional arguments `func` accepts, and the names of the keyword arguments it accepts. Either is
+    None if it accepts any amount. If `bind` is True, the first parameter (self) isn't counted.
+    """
+    params = _parameters(func)
+    if bind:
+        params = params[1:]
+
+    # None means "accepts any amount"
+    nargs = 0
+    kwnames = set()
+    for kind, name in params:
+        if kind is _VAR_POSITIONAL:
+            nargs = None
+        elif kind is _VAR_KEYWORD:
+            kwnames = None
+        else:
+            if kind in (_POSITIONAL_ONLY, _POSITIONAL_OR_KEYWORD) and nargs is not None:
+                nargs += 1
+            if kind is not _POSITIONAL_ONLY and kwnames is not None:
+                kwnames.add(name)
+    return nargs, kwnames
+
+
+_POSITIONAL_ONLY, _POSITIONAL_OR_KEYWORD, _VAR_POSITIONAL, _KEYWORD_ONLY, _VAR_KEYWORD = range(5)
+# The same values as inspect.Parameter.kind
+_MAX_OTHER_CALLS = 256
+""" How many compiled calls of functions that aren't the class's own a DispatchPlan keeps """
+
+_CO_VARARGS = 0x04
+_CO_VARKEYWORDS = 0x08
+
+
+def _parameters(func:Callable) -> list[tuple[int, str]]:
+    """ The (kind, name) of each of func's parameters, in order, like inspect.signature() would give.
+    Plain functions are read straight from their code object, so inspect (which is slow to import) only gets
+    imported for anything else.
+    """
+    if type(func) is not FunctionType or hasattr(func, '__wrapped__') or hasattr(func, '__signature__'):
+        import inspect
+        return [(int(p.kind), p.name) for p in inspect.signature(func).parameters.values()]
+
+    code = func.__code__
+    names = code.co_varnames
+    n_pos = code.co_argcount
+    n_kw = code.co_kwonlyargcount
+    params = [(_POSITIONAL_ONLY, name) for name in names[:code.co_posonlyargcount]]
+    params += [(_POSITIONAL_OR_KEYWORD, name) for name in names[code.co_posonlyargcount:n_pos]]
+    i = n_pos + n_kw
+    if code.co_flags & _CO_VARARGS:
+        params.append((_VAR_POSITIONAL, names[i]))
+        i += 1
+    params += [(_KEYWORD_ONLY, name) for name in names[n_pos:n_pos + n_kw]]
+    if code.co_flags & _CO_VARKEYWORDS:
+        params.append((_VAR_KEYWORD, names[i]))
+    return params
+
+
+def compile_call(func:Callable, bind:bool) -> Callable[[Any, tuple, dict], Any]:
+    """ Work out once which of the given parameters `func` can accept, and return a function with the signature
+    `call(machine, args, kwargs)` that calls `func` with only those parameters.
+    If `bind` is True, the machine is passed as the first argument (i.e. `func` is a method of the machine).
+    The filtering rules are the same as they've always been: extra positional arguments are cut off, and keyword
+    arguments `func` doesn't have a parameter for are dropped.
+    """
+    nargs, kwnames = accepted_params(func, bind)
+
+    # Most hooks only take self, so make that as cheap as possible
+    if bind and nargs == 0 and not kwnames and kwnames is not None:
+        return lambda machine, args, kwargs: func(machine)
+
+    def call(machine, args, kwargs):
+        if nargs is not None:
+            args = args[:nargs]
+        if kwargs and kwnames is not None:
+            kwargs = {k: v for k, v in kwargs.items() if k in kwnames}
+        if bind:
+            return func(machine, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    call.__name__ = func.__name__
+    return call
+
+
+class DispatchPlan:
+    """ Everything `next()` and `set_state()` need to know about a DynamicStateMachine subclass, worked out once
+    per subclass instead of on every step: the transition for each state, the before_/after_/on_ hooks for each
+    state, and how to call each of them with the parameters they accept.
+    """
+
+    def __init__(self, machine_cls:type):
+        if not (isinstance(machine_cls.states, type)): #issubclass(self.states, States)) <- TODO: this should work, NO clue why it doesn't
+            raise ValueError(f'states must be a type which is a subclass of States. Got {machine_cls.states!r}, which is of type {type(machine_cls.states)}')
+
+        if not isinstance(machine_cls.initial, State):
+            raise ValueError(f'initial must be a State (a member of the states class)')
+
+        if not machine_cls.transitions:
+            raise ValueError('transitions not specified')
+
+        self.machine_cls = machine_cls
+        """ The DynamicStateMachine subclass this plan was built for """
+        states = machine_cls.states._states_list
+        self.transitions:dict[State, State|Callable] = {s: t for s, t in machine_cls.transitions}
+        """ The transition for each state. Either a State (for simple transitions), or a transition method """
+        self._calls:dict[Callable, Callable] = {}
+        """ Compiled calls of the class's own functions (its transition methods and hooks), keyed by the function """
+        self._other_calls:dict[Callable, Callable] = {}
+        """ Compiled calls of any other functions transition methods return (which can be a new lambda every time),
+            the most recently compiled _MAX_OTHER_CALLS of them """
+        self.listeners:tuple[Callable, ...] = ()
+        """ Called every time an instance changes state, see DynamicStateMachine.add_listener() """
+        self.profilers = 0
+        """ How many Profilers have swapped the compiled calls for timed ones. Compiled classes (see
+            DynamicStateMachine.compile()) go through the plan instead of their generated code while it has. """
+        self.graphs:dict[tuple, Any] = {}
+        """ The graphs construct_graphvis() has made for this class, by the options they were made with """
+        self.graph_index = None
+        """ The GraphIndex of this class, once DynamicStateMachine.graph_index() has built it """
+        self.slots:tuple[MemberDescriptorType, ...] = tuple(
+            attr for klass in machine_cls.__mro__ if '__slots__' in klass.__dict__
+            for attr in klass.__dict__.values() if type(attr) is MemberDescriptorType
+        )
+        """ The descriptors of every slot instances of the class have, which DynamicStateMachine.fork() copies """
+
+        for state, transition in self.transitions.items():
+            if state.owner is not machine_cls.states or (isinstance(transition, State) and transition.owner is not machine_cls.states):
+                raise ValueError(f'Transition {state!r} >> {transition!r} uses a State which is not a member of {machine_cls.states.__name__}')
+
+        self.timeouts:list[tuple[float, State|None]|None] = [None] * len(states)
+        """ The (seconds, target) timeout of each state from the class's timeouts, by State.id, or None """
+        for state, (seconds, target) in (machine_cls.timeouts or {}).items():
+            if state.owner is not machine_cls.states or (target is not None and target.owner is not machine_cls.states):
+                raise ValueError(f'Timeout {state!r} -> {target!r} uses a State which is not a member of {machine_cls.states.__name__}')
+            if not seconds > 0:
+                raise ValueError(f'The timeout of {state!r} must be a positive number of seconds. Got {seconds!r}')
+            self.timeouts[state.id] = (seconds, target)
+
+        # All of these are indexed by State.id
+        self.before:list[Callable|None] = [None] * len(states)
+        """ The compiled before_<state> hook of each state, or None if it doesn't have one """
+        self.after:list[Callable|None] = [None] * len(states)
+        """ The compiled after_<state> hook of each state, or None if it doesn't have one """
+        self.on:list[Callable|None] = [None] * len(states)
+        """ The compiled on_<state> hook of each state, or None if it doesn't have one """
+
+        for state in states:
+            for prefix, hooks in (('before_', self.before), ('after_', self.after), ('on_', self.on)):
+                if callable(method := getattr(machine_cls, prefix + state.name, None)):
+                    hooks[state.id] = self.compile(method)
+
+        self.steps:list[Callable|State|None] = [None] * len(states)
+        """ The same as self.transitions, but indexed by State.id, and with the transition methods already compiled.
+            None for states without a transition """
+        for state, transition in self.transitions.items():
+            self.steps[state.id] = transition if isinstance(transition, State) else self.compile(transition)
+
+        self._check_virtual_cycles()
+
+        # Simple transitions into virtual states which just go on to another state can jump straight to where they
+        # end up, as long as nothing would have been called along the way
+        for state in states:
+            if isinstance(target := self.steps[state.id], State):
+                while target.virtual and isinstance(after := self.steps[target.id], State) and not self.has_hooks(target):
+                    target = after
+                self.steps[state.id] = target
+
+    def has_hooks(self, state:State) -> bool:
+        """ If state has any before_/after_/on_ hooks """
+        return bool(self.before[state.id] or self.after[state.id] or self.on[state.id])
+
+    def _check_virtual_cycles(self):
+        """ Raise a ValueError if following simple transitions through virtual states would never end """
+        # States we know don't lead to a cycle
+        settled = set()
+        for state in self.machine_cls.states._states_list:
+            path = []
+            current = state
+            while current.virtual and isinstance(self.steps[current.id], State) and current not in settled:
+                if current in path:
+                    cycle = path[path.index(current):] + [current]
+                    raise ValueError(f'{self.machine_cls.__name__} has a cycle of virtual states, which would never '
+                                     f'stop transitioning: {" >> ".join(s.name for s in cycle)}')
+                path.append(current)
+                current = self.steps[current.id]
+            settled.update(path)
+
+    def compile(self, func:Callable) -> Callable[[Any, tuple, dict], Any]:
+        """ Get the compiled call for func (see compile_call()), compiling it if it hasn't been already.
+        The calls of the class's own functions are kept for good, and only the most recent few of any others.
+        Raises a TypeError if func isn't a function.
+        """
+        try:
+            return self._calls[func]
+        except KeyError:
+            pass
+        except TypeError:
+            raise TypeError('func must be a function')
+        if (call := self._other_calls.get(func)) is not None:
+            return call
+
+        # Bound methods are created fresh every time they're accessed, so compile (and cache) the underlying
+        # function instead, and call it with the instance the method is bound to
+        if isinstance(func, MethodType):
+            instance = func.__self__
+            call = self.compile(func.__func__)
+            return lambda machine, args, kwargs: call(instance, args, kwargs)
+
+        try:
+            # This is how it's always been detected: if it's an attribute of the class, it's a method
+            bind = hasattr(self.machine_cls, func.__name__)
+        except AttributeError:
+            raise TypeError('func must be a function')
+
+        call = compile_call(func, bind)
+        # Transition methods declared with @pure get their results cached
+        if isinstance(cache := getattr(func, 'transition_cache', None), TransitionCache):
+            call = cache.wrap(call, *accepted_params(func, bind))
+        attr = getattr(self.machine_cls, func.__name__, None) if bind else None
+        if attr is func or getattr(attr, '__func__', None) is func or func in self.transitions.values():
+            self._calls[func] = call
+        else:
+            others = self._other_calls
+            if len(others) >= _MAX_OTHER_CALLS:
+                del others[next(iter(others))]
+            others[func] = call
+        return call
+
+    def hookless_destination(self, state:State) -> State|None:
+        """ Where next() would go from `state` if it can get there without calling anything: by following simple
+        transitions (through any virtual states) where none of the states involved have hooks that would fire.
+        Returns None if something has to be called along the way.
+        """
+        seen = set()
+        current = state
+        while True:
+            target = self.steps[current.id]
+            if not isinstance(target, State):
+                return None
+            if self.after[current.id] or self.before[target.id] or self.on[target.id]:
+                return None
+            if not target.virtual:
+                return target
+            # A virtual cycle never settles, leave it to next() to deal with
+            if target.id in seen:
+                return None
+            seen.add(target.id)
+            current = target
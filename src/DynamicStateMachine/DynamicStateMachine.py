@@ -1,14 +1,10 @@
-import inspect
-from typing import Any, Callable, Iterable, Literal
-import dis
-import ast
+from itertools import repeat
+from typing import Any, Callable, Iterable, Iterator, Literal
 from .State import State
 from .States import States
-
-try:
-    from graphviz import Digraph
-except:
-    Diagraph = None
+from .Transition import Transition
+from .DispatchPlan import DispatchPlan
+from .Snapshot import FINISHED, Snapshot, find_machine, machine_path, state_id
 
 
 # TODO: allow standalone functions as transition functions (in the works)
@@ -40,7 +36,8 @@ class DynamicStateMachine:
         - Each state should only be on the left hand side (be transitioned from) once (enforced, but not warned)
         - Methods on the right hand side must be methods of this class's subclass, and not standalone functions (this is enforced at the moment)
         - Infinite loops function, and may be intentional, and thus are not checked for
-        - Infinite virtual loops (a cycle of all virtual States) will result in a max recursion error. This is not checked for explicitly
+        - Infinite virtual loops (a cycle of all virtual States) are rejected when the class is defined, if they're made of
+          simple transitions. Ones that go through transition methods can't be checked for, and will loop forever
 
     Side effects can be defined using methods named according to the following:
         - before_<step>
@@ -48,8 +45,14 @@ class DynamicStateMachine:
         - on_<step>
         - on_start
         - on_end2
+
+    Instances normally have a __dict__, like any other class. For machines with lots of instances, a subclass can
+    declare `__slots__` (with any fields it needs of its own), and then each instance only stores its current state,
+    trigger_initial_side_effects (if it's False), and those fields. Everything else is shared by the class.
     """
 
+    __slots__ = ('_state', '_trigger_initial_side_effects')
+
     states:type[States] = None
     """ The initial state of the state machine """
     initial:State = None
@@ -59,36 +62,83 @@ class DynamicStateMachine:
         state and a method. The method must be a method of this class's subclass, and not a standalone
         function.
     """
+    timeouts:dict[State, tuple[float, State|None]] = None
+    """ Optional. {state: (seconds, target)}: a machine which stays in state for `seconds` goes to target (or
+        finishes, if target is None). Only enforced for classes attached to a TimerWheel.
+    """
 
     def __init__(self, start_immediately=True, trigger_initial_side_effects=True):
-        self._trigger_initial_side_effects = trigger_initial_side_effects
-        """ If True, then the initial state's before_<state> method will be called on instantiation. """
-
+        """ If trigger_initial_side_effects is True, then the initial state's before_<state> method will be called
+        when the machine is started, whether that's now or by a later start().
+        """
         self._state = None
+        if not trigger_initial_side_effects:
+            # Only stored when it's not the default, see start()
+            self._trigger_initial_side_effects = False
 
-        if not (isinstance(self.states, type)): #issubclass(self.states, States)) <- TODO: this should work, NO clue why it doesn't
-            raise ValueError(f'states must be a type which is a subclass of States. Got {self.states!r}, which is of type {type(self.states)}')
-
-        if not isinstance(self.initial, State):
-            raise ValueError(f'initial must be a State (a member of the states class)')
-
-        if not self.transitions:
-            raise ValueError('transitions not specified')
-
-        # Convert the transitions into a dict for faster lookup, ease of internal use, and ensuring uniqueness
-        self._transitions:dict[State, Callable] = {s: t for s, t in self.transitions}
+        # The class is only validated the first time it's used
+        self._get_plan()
 
         if start_immediately:
             self.start()
 
-    def start(self):
-        """ Start the state machine. """
+    @property
+    def _transitions(self) -> dict[State, State|Callable]:
+        """ The transitions as a dict, for faster lookup, ease of internal use, and ensuring uniqueness. Shared by
+        every instance of the class.
+        """
+        return self._plan.transitions
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Build (and validate) the plan as soon as the class is defined, unless it's an intermediate class that
+        # doesn't define the machine yet. Compiled classes come with their original's.
+        if cls.transitions is not None and '_plan' not in cls.__dict__:
+            cls._plan = DispatchPlan(cls)
+
+    @classmethod
+    def _get_plan(cls) -> DispatchPlan:
+        """ Get the DispatchPlan for this class, building it the first time it's needed.
+        Every subclass gets its own, since they can each have different hooks. The class is validated here, so
+        it's only done once per class.
+        """
+        if '_plan' not in cls.__dict__:
+            cls._plan = DispatchPlan(cls)
+        return cls._plan
+
+    def start(self, trigger_initial_side_effects:bool|None=None):
+        """ Start the state machine. If trigger_initial_side_effects is True, the initial state's before_<state>
+        method will be called. If it's None, what was given to __init__() is used.
+        """
+        if trigger_initial_side_effects is None:
+            trigger_initial_side_effects = getattr(self, '_trigger_initial_side_effects', True)
         self.on_start()
-        if self._trigger_initial_side_effects:
+        if trigger_initial_side_effects:
             self.state = self.initial
         else:
             self._state = self.initial
 
+    def snapshot(self, payload:Any=None) -> Snapshot:
+        """ Get a small, picklable snapshot of this machine: its class, the id of its current state, and the given
+        payload. Use restore() to turn it back into a machine.
+        """
+        return Snapshot(machine_path(type(self)), state_id(self), payload)
+
+    @classmethod
+    def restore(cls, snapshot:Snapshot) -> 'DynamicStateMachine':
+        """ Recreate a machine from a snapshot (see snapshot()), in the state it was in, without calling on_start()
+        or any side effect methods. If called on DynamicStateMachine itself, the class is imported from the
+        snapshot. The snapshot's payload is left for the caller to deal with.
+        """
+        if cls is DynamicStateMachine:
+            cls = find_machine(snapshot.machine)
+        elif snapshot.machine is not None and snapshot.machine != machine_path(cls):
+            raise ValueError(f'Snapshot is of a {snapshot.machine}, not a {machine_path(cls)}')
+
+        machine = cls(start_immediately=False)
+        machine._state = None if snapshot.state == FINISHED else cls.states._states_list[snapshot.state]
+        return machine
+
     def on_start(self):
         """ Called when the state machine is started (when self.start() is called, immediately before the state is set) """
 
@@ -100,23 +150,8 @@ class DynamicStateMachine:
         it will be called with the state machine instance as the first argument. Otherwise, it will be
         called as is. Also, it will only attempt to call the function with the parameters it accepts.
         """
-        # TODO: This isn't the best way to detect this
-        try:
-            if hasattr(self, func.__name__):
-                args = (self,) + args
-        except:
-            raise TypeError('func must be a function')
-
-        # TODO: This maaay fail if positional args are passed in as keyword args. Needs more testing, or better yet,
-        # just steal how python-statemachines does it
-        sig = inspect.signature(func)
-        # Cut args down until it fits the signature
-        args = args[:len(sig.parameters)]
-        # Remove any kwargs that aren't in the signature
-        kwargs = {k: v for k, v in kwargs.items() if k in sig.parameters}
-        # bound_args = sig.bind_partial(self, *args, **kwargs)
-        # bound_args.apply_defaults()
-        return func(*args, **kwargs)
+        # The signature is only inspected the first time a function is called, see DispatchPlan.compile()
+        return self._get_plan().compile(func)(self, args, kwargs)
 
     @property
     def finished(self) -> bool:
@@ -130,6 +165,28 @@ class DynamicStateMachine:
     def state(self, new:State):
         self.set_state(new)
 
+    def _coerce_state(self, new:State|None|Any|tuple[State|None|Any, str]) -> State|None:
+        """ Turn anything set_state() accepts into the State it refers to (or None). See set_state() for the rules. """
+        # type() here is intentional, implicit tuples are going to only ever be just tuples
+        # Don't just assume a tuple means what we think it does, since tuples are hashable, they could be used as the
+        # values of State's
+        if type(new) is tuple and len(new) == 2 and type(new[1]) is str:
+            new = new[0]
+
+        if new is None:
+            return None
+
+        if not isinstance(new, State):
+            try:
+                new = self.states._from_value(new)
+            except KeyError:
+                raise ValueError(f'Invalid state given. Must be a State instance, but got {type(new)}: {new!r}')
+
+        if new.owner is not self.states:
+            raise ValueError('Invalid state given. self.states be a member of self.states.')
+
+        return new
+
     def set_state(self, new:State|None|Any|tuple[State|None|Any, str], *args, side_effects=True, **kwargs):
         """ Set the state. This is the setter for self.state, but can also be called directly.
         If side_effects is False, then the before/after methods will not be called.
@@ -145,39 +202,103 @@ class DynamicStateMachine:
             and the string is completely ignored
         """
         old = self._state
+        plan = self._plan
+        comment = None
+
+        if type(new) is not State or new.owner is not self.states:
+            if type(new) is tuple and len(new) == 2 and type(new[1]) is str:
+                comment = new[1]
+            new = self._coerce_state(new)
 
         if new is None:
             self._state = None
             self.on_end()
+            if plan.listeners:
+                self._notify(old, None, comment)
             return
 
-        # type() here is intentional, implicit tuples are going to only ever be just tuples
-        # Don't just assume a tuple means what we think it does, since tuples are hashable, they could be used as the
-        # values of State's
-        if type(new) is tuple and len(new) == 2 and type(new[1]) is str:
-            new = new[0]
+        if side_effects:
+            if old is not None and (hook := plan.after[old.id]):
+                hook(self, args, kwargs)
 
-        if not isinstance(new, State):
-            try:
-                new = self.states._reverse_states[new]
-            except KeyError:
-                raise ValueError(f'Invalid state given. Must be a State instance, but got {type(new)}: {new!r}')
+            if (hook := plan.before[new.id]):
+                hook(self, args, kwargs)
 
-        if  new not in self.states._states_list:
-            raise ValueError('Invalid state given. self.states be a member of self.states.')
+            if (hook := plan.on[new.id]):
+                hook(self, args, kwargs)
 
-        if side_effects:
-            if old is not None:
-                if (method := getattr(self, 'after_' + old.name, False)):
-                    self._call_function_with_correct_params(method, *args, **kwargs)
+        self._state = new
+        if plan.listeners:
+            self._notify(old, new, comment)
+
+    def _notify(self, old:State|None, new:State|None, comment:str|None):
+        transition = Transition(old, new, comment)
+        for listener in self._plan.listeners:
+            listener(self, transition)
+
+    @classmethod
+    def add_listener(cls, listener:Callable[['DynamicStateMachine', Transition], Any]):
+        """ Call listener(machine, Transition(old, new, comment)) every time the state of any instance of this class
+        changes, right after it's changed. Listeners are per class: they aren't called for subclasses.
+        Transitions through virtual states which have no hooks are skipped over (see DispatchPlan), and show up as a
+        single Transition to the state after them.
+        """
+        plan = cls._get_plan()
+        plan.listeners += (listener,)
+
+    @classmethod
+    def remove_listener(cls, listener:Callable[['DynamicStateMachine', Transition], Any]):
+        """ Stop calling a listener added with add_listener() """
+        plan = cls._get_plan()
+        plan.listeners = tuple(l for l in plan.listeners if l != listener)
+
+    def _resolve(self, step:State|Callable, args:tuple, kwargs:dict) -> tuple[State|None, str|None]:
+        """ Follow a step from the dispatch plan, and any transition methods it returns, to the State it ends up at.
+        Returns that State (or None) and the comment it was returned with, if there was one.
+        """
+        if isinstance(step, State):
+            return step, None
+        return self._follow(step(self, args, kwargs), args, kwargs)
+
+    def _follow(self, rtn:Any, args:tuple, kwargs:dict) -> tuple[State|None, str|None]:
+        """ Follow what a transition method returned to the State it ends up at, see _resolve() """
+        comment = None
+        # Keep calling the returned transition methods until one returns a state
+        while True:
+            if rtn is None or isinstance(rtn, State):
+                return rtn, comment
+
+            # If it returns 2 things, assume the 2nd is a comment for the graphvis graph
+            # A State can't be callable, so check this first: the comment may come with another transition method
+            if type(rtn) in (tuple, list) and len(rtn) == 2 and isinstance(rtn[1], str):
+                rtn, comment = rtn
+            elif callable(rtn):
+                rtn = self._plan.compile(rtn)(self, args, kwargs)
+            else:
+                raise TypeError(f'Transition methods must return a transition method, a State, or None. Got {rtn!r}')
 
-            if (method := getattr(self, 'before_' + new.name, False)):
-                self._call_function_with_correct_params(method, *args, **kwargs)
+    def _advance(self, args:tuple, kwargs:dict) -> str|None:
+        """ The guts of next(). Returns the comment the transition out of the current state was returned with, if
+        there was one.
+        """
+        steps = self._plan.steps
+        state = self._state
+        if state is None:
+            return None
 
-            if (method := getattr(self, 'on_' + new.name, False)):
-                self._call_function_with_correct_params(method, *args, **kwargs)
+        if (step := steps[state.id]) is None:
+            raise KeyError(f'{state!r} has no transition')
+        next_state, comment = self._resolve(step, args, kwargs)
+        # Pass along the args and kwargs, so the before/after methods can use them
+        self.set_state(next_state if comment is None else (next_state, comment), *args, **kwargs)
 
-        self._state = new
+        # Virtual states go straight on to the next state
+        while (state := self._state) is not None and state.virtual:
+            if (step := steps[state.id]) is None:
+                raise KeyError(f'{state!r} has no transition')
+            self.set_state(self._resolve(step, args, kwargs)[0], *args, **kwargs)
+
+        return comment
 
     def next(self, *args, **kwargs) -> State:
         """ Transition to the next state. If the next state is a virtual state, then it will
@@ -185,120 +306,90 @@ class DynamicStateMachine:
         Pass along any additional arguments to the transition and side effect methods.
         Returns the current state, for convenience
         """
-        # Stupid Python not having do-while loops
-        do = True
-        while not self.finished and (self.state.virtual or do):
-            do = False
-            # It's can be a method here only breifly, until it returns a state
-            # Apparently just adding self like this works
-            next_state:State|Callable = self._call_function_with_correct_params(self._transitions[self.state], *args, **kwargs)
-
-            # Keep calling the returned function until it returns a state
-            while True:
-                try:
-                    next_state = self._call_function_with_correct_params(next_state, *args, **kwargs)
-                except TypeError:
-                    break
-
-            _warning = 'Transition methods must return a transition method, a State, or None'
-            # If it returns 2 things, assume the 2nd is a comment for the graphvis graph
-            if isinstance(next_state, (list, tuple)):
-                assert isinstance(next_state[1], str), _warning
-                next_state = next_state[0]
+        self._advance(args, kwargs)
+        return self.state
 
-            assert isinstance(next_state, State) or next_state is None, _warning
-            # Pass along the args and kwargs, so the before/after methods can use them
-            self.set_state(next_state, *args, **kwargs)
+    def peek(self, *args, **kwargs) -> State|None:
+        """ Find the state next(*args, **kwargs) would go to, without going there: the machine stays in its current
+        state, and no before_/after_/on_ methods or listeners are called. Transition methods and virtual states are
+        followed the same way next() does, so the result is never a virtual state. Returns None if the machine would
+        finish (or already has).
 
-        return self.state
+        The transition methods are still called (with the state set to the one they're the transition of, like
+        next() would), so this is only side effect free if they are.
+        """
+        state = original = self._state
+        steps = self._plan.steps
+        try:
+            while state is not None:
+                if (step := steps[state.id]) is None:
+                    raise KeyError(f'{state!r} has no transition')
+                self._state = state
+                state = self._resolve(step, args, kwargs)[0]
+                if state is not None and state.owner is not self.states:
+                    state = self._coerce_state(state)
+                if state is None or not state.virtual:
+                    break
+        finally:
+            self._state = original
+        return state
+
+    def fork(self) -> 'DynamicStateMachine':
+        """ Make a copy of this machine, in the same state, without calling __init__(), on_start(), or any side effect
+        methods. Everything about the class (the transitions, hooks, listeners, etc.) is shared, so a fork only costs
+        a new instance holding the state and the machine's own fields. The fields are copied shallowly: both machines
+        refer to the same values until one of them sets a field to something else, so mutable values should be
+        replaced rather than changed in place.
+
+        Useful for trying out events with next() or peek() on several candidates, without touching this machine.
+        """
+        clone = object.__new__(type(self))
+        for slot in self._plan.slots:
+            try:
+                slot.__set__(clone, slot.__get__(self))
+            except AttributeError:
+                # Not set on this machine either
+                pass
+        if fields := getattr(self, '__dict__', None):
+            clone.__dict__.update(fields)
+        return clone
+
+    def run(self, events:Iterable|None=None, **kwargs) -> Iterator[Transition]:
+        """ Advance the machine once for each event in `events`, lazily, and yield a Transition(old, new, comment)
+        for each one: the state before the event, the state after it (after any virtual states), and the comment the
+        transition method returned, if any. Stops once the machine finishes, without consuming any more events.
+
+        Each event is a tuple of the parameters to pass to next(); anything else is passed as the only parameter.
+        Any kwargs are passed along with every event. If events is None, the machine is advanced without any
+        parameters until it finishes.
+        """
+        if events is None:
+            events = repeat(())
+        if self._state is None:
+            return
+        advance = self._advance
+        for event in events:
+            old = self._state
+            comment = advance(event if type(event) is tuple else (event,), kwargs)
+            yield Transition(old, self._state, comment)
+            if self._state is None:
+                return
 
-    # This would probably be easier and work better if it used ast instead of dis
     @staticmethod
     def get_returns_dis(func):
-        # return [instr.argrepr for instr in dis.Bytecode(func) if instr.opname in ("RETURN_CONST", "RETURN_VALUE")]
-        rtn = []
-        stack = []  # Tracks last loaded values
-
-        for instr in dis.Bytecode(func):
-            if instr.opname in {"LOAD_FAST", "LOAD_GLOBAL", "LOAD_DEREF", "LOAD_CONST", 'LOAD_ATTR'}:  # Variable names
-                stack.append(instr.argval)
-            elif instr.opname == "RETURN_VALUE":
-                if stack[-1] is None:
-                    stack.pop(-1)
-                    continue
-                if stack:  # Use last loaded value (var name or literal)
-                    rtn.append(stack[-1])
-            elif instr.opname == "RETURN_CONST":
-                rtn.append(instr.argval)
-            elif instr.opname == "BUILD_TUPLE":
-                rtn.append((stack.pop(-2), stack.pop(-1)))
-                stack.append(None)
-
-        return [((i, '') if type(i) is not tuple else i) for i in rtn]
-
-    # This almost works, but not quite. It wasn't as good of an option as I was hoping
-    # Then again, it may work, but what I was testing it with didn't
+        """ Find what the given transition method can return, by looking through its bytecode. Returns a list of
+        (return value, comment) tuples. Results are cached (see AnalysisCache), so don't modify them.
+        """
+        from . import Graphing
+        return Graphing.get_returns_dis(func)
+
     @staticmethod
     def get_returns_ast(func):
-        class ReturnVisitor(ast.NodeVisitor):
-            def __init__(self):
-                self.returns = {}
-
-            def visit_FunctionDef(self, node):
-                """Handles both function definitions and lambdas."""
-                self.generic_visit(node)  # Process child nodes
-
-            def visit_Lambda(self, node):
-                """Handles lambda functions."""
-                return_value = self.extract_value(node.body)
-                self.returns[return_value] = None  # Lambdas don't have doc-like comments after return
-
-            def visit_Return(self, node):
-                """Handles return statements and collects potential trailing string literals."""
-                return_value = self.extract_value(node.value)
-                trailing_string = self.get_trailing_string(node)
-                self.returns[return_value] = trailing_string
-
-            def extract_value(self, node):
-                """Extracts literals or variable names from AST nodes."""
-                if isinstance(node, ast.Constant):  # Literal values (numbers, strings, etc.)
-                    return node.value
-                elif isinstance(node, ast.Name):  # Variables
-                    return node.id
-                return "<unknown>"
-
-            def get_trailing_string(self, node):
-                """Finds a string literal immediately following a return statement."""
-                parent = node.parent
-                if parent:
-                    body = parent.body
-                    try:
-                        node_index = body.index(node)
-                    except ValueError:
-                        body = parent.orelse
-                        try:
-                            node_index = body.index(node)
-                        except ValueError:
-                            print('Comment in unhandled place')
-                            return
-                    if node_index + 1 < len(body):
-                        next_node = body[node_index + 1]
-                        if isinstance(next_node, ast.Expr) and isinstance(next_node.value, ast.Constant):
-                            if isinstance(next_node.value.value, str):  # Must be a string
-                                return next_node.value.value
-                return None
-
-        source = inspect.getsource(func)
-        tree = ast.parse(source)
-
-        # Set parent references for easy access
-        for node in ast.walk(tree):
-            for child in ast.iter_child_nodes(node):
-                child.parent = node
-
-        visitor = ReturnVisitor()
-        visitor.visit(tree)
-        return visitor.returns
+        """ Find what the given transition method can return, by parsing its source. Returns a dict of
+        {return value: comment}. Results are cached (see AnalysisCache), so don't modify them.
+        """
+        from . import Graphing
+        return Graphing.get_returns_ast(func)
 
     def construct_graphvis(self,
                            include_start=True,
@@ -312,8 +403,9 @@ class DynamicStateMachine:
                            virtual_attrs=dict(shape='box', style='dotted'),
                            start_attrs=dict(shape='box', fillcolor='green', style='filled'),
                            end_attrs=dict(shape='triangle', fillcolor='red', style='filled'),
+                           heat:'Profiler|None'=None,
                            _backend:Literal['dis', 'ast']='dis',
-        ) -> Digraph:
+        ) -> 'Digraph':
         """ Construct a graphviz representation of the current statemachine.
             NOTE: depending on the complexity of the machine, this method may take a while.
 
@@ -328,121 +420,43 @@ class DynamicStateMachine:
             ast parser to find return statements that way. Currently, only the dis backend is reliable (surprisingly)
             if highlighted is not provided, it will highlight the current step. If it is provided, it will highlight the
             provided step. If it's set to None, no step will be highlighted.
+            if heat is a Profiler which has been attached to this class, the edges are colored and weighted by how often
+            they've been taken, and the states by how long has been spent in them. See Profiler.edge_style() and
+            Profiler.state_styles().
         """
-        # Allow the package to be optional
-        if not Digraph:
-            return
-
-        # optionally be disconnect virtual states
-        if 'comment' not in graph_attrs:
-            graph_attrs['comment'] = type(self).__name__
-        dot = Digraph(**graph_attrs)
-        handled_transitions = []
-        # To ensure all the end nodes have unique names
-        # I realized later I could have used monotonic() for this, but it's already implemented this way
-        end_counter = 0
-        counters = {}
-        # Putting this here for efficiency's sake
-        state_names = [i.name for i in self.states._states_list]
-
-        def create_destination_state_node(state):
-            nonlocal counters
-            goto = state.name
-            if state.virtual and disconnect_virtual:
-                # we need to keep track to ensure uniqueness
-                if state.name not in counters:
-                    counters[state.name] = 0
-                goto = state.name + str(counters[state.name])
-                counters[state.name] += 1
-                dot.node(goto, state.name, **virtual_attrs)
-            return goto
-
-        def add_function_outputs(trans:Callable):
-            nonlocal end_counter, handled_transitions
-
-            # For some reason just the reference doesn't work? Unsure why. This works though.
-            if trans.__name__ in handled_transitions:
-                return
-            else:
-                handled_transitions.append(trans.__name__)
-
-            if _backend == 'dis':
-                items = DynamicStateMachine.get_returns_dis(trans)
-            elif _backend == 'ast':
-                items = DynamicStateMachine.get_returns_ast(trans).items()
-            else:
-                raise ValueError(f"_backend value must be either 'dis' or 'ast'. Got {_backend}")
-
-            for ret, comment in items:
-                ret: str
-                comment: str
-
-                # Goes to the end
-                if ret is None:
-                    if split_ends or not end_counter:
-                        dot.node(f'End{end_counter}', 'End', **end_attrs)
-                    dot.edge(trans.__name__, f'End{end_counter}', comment)
-                    end_counter += 1
-
-                # Goes to another state
-                elif ret in state_names:
-                    state = self.states._states[ret]
-                    goto = create_destination_state_node(state)
-                    dot.edge(trans.__name__, goto, comment)
-
-                # Goes to another transition function to decide where to go next
-                # TODO: in order to support standalone functions, this if statement will have to be changed
-                elif hasattr(self, ret):
-                    lbl = ret
-                    if not use_names:
-                        lbl = lbl.replace('_', ' ')
-                    dot.node(ret, lbl, **transition_attrs)
-                    dot.edge(trans.__name__, ret, comment)
-                    add_function_outputs(getattr(self, ret))
-
-                else:
-                    raise ValueError(f'return value is not a state, None, nor a transition function. Got {ret!r}')
-
-        if include_start:
-            dot.node('Start', 'Start', **start_attrs)
-            dot.edge('Start', self.initial.name)
-
-        # Add states as nodes
-        for state, transition in self._transitions.items():
-            state: State
-            transition: Callable
-
-            # No idea why it's state.value.value here, instead of state.value
-            label = state.name if use_names else state.value
-
-            dot.node(state.name, label, **(virtual_attrs if state.virtual else state_attrs))
-            if state._simple:
-                goto = create_destination_state_node(state._simple)
-                dot.edge(state.name, goto)
-
-            # If it's not simple, then it's a function
-            else:
-                lbl = transition.__name__
-                if not use_names:
-                    lbl = lbl.replace('_', ' ')
-                dot.node(transition.__name__, lbl, **transition_attrs)
-                dot.edge(state.name, transition.__name__)
-
-                add_function_outputs(transition)
-
-        if highlighted is Ellipsis:
-            dot = DynamicStateMachine.highlight_node(dot, self.state.name)
-        elif highlighted:
-            assert isinstance(highlighted, State), 'highlighted must be a State'
-            dot = DynamicStateMachine.highlight_node(dot, highlighted.name)
-
-        return dot
+        # Imported here, so nothing to do with graphs gets imported until it's needed
+        from . import Graphing
+        return Graphing.construct_graphvis(self, include_start, use_names, disconnect_virtual, split_ends, highlighted,
+                                           graph_attrs, state_attrs, transition_attrs, virtual_attrs, start_attrs,
+                                           end_attrs, heat, _backend)
+
+    @classmethod
+    def graph_index(cls) -> 'GraphIndex':
+        """ Get the GraphIndex of this class's transition graph, for questions like "can a machine in this state
+        still finish?". It's built the first time this is called.
+        """
+        plan = cls._get_plan()
+        if plan.graph_index is None:
+            from .GraphIndex import GraphIndex
+            plan.graph_index = GraphIndex(cls)
+        return plan.graph_index
+
+    @classmethod
+    def compile(cls) -> type:
+        """ Get a version of this class specialized for speed: a subclass with a next() generated from this class's
+        transitions and hooks, which calls them directly instead of going through the dispatch plan. It behaves the
+        same, and shares this class's listeners. It's generated the first time this is called, and reused after that.
+        See Compiler.compile_machine().
+        """
+        if '_compiled' not in cls.__dict__:
+            from .Compiler import compile_machine
+            cls._compiled = compile_machine(cls)
+        return cls._compiled
 
     def __next__(self):
         self.next()
 
     @staticmethod
-    def highlight_node(graph:Digraph, id:str, color='blue', style='bold', **attrs):
-        if Digraph:
-            graph.node(id, color=color, style=style, **attrs)
-            return graph
+    def highlight_node(graph:'Digraph', id:str, color='blue', style='bold', **attrs):
+        from . import Graphing
+        return Graphing.highlight_node(graph, id, color, style, **attrs)
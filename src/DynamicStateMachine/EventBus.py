@@ -0,0 +1,218 @@
+import threading
+import time
+from typing import Any, Callable, Literal, NamedTuple
+from .State import State
+from .Transition import Transition
+
+
+class Event(NamedTuple):
+    """ A state change, as delivered by an EventBus """
+    machine: Any
+    transition: Transition
+    time: float
+    """ When it happened, from the EventBus's clock """
+
+
+class EventBus:
+    """ Delivers state changes to subscribers in batches, off of the thread the machines are running in, so slow
+    consumers (logging, metrics, persistence) don't add to the time a transition takes.
+
+    attach() a machine class to the bus, and every state change of its instances is put into a bounded ring buffer,
+    which is all that happens while the transition is running. A background thread takes what's in the buffer every
+    `interval` seconds (or as soon as `batch_size` events are waiting), and calls each subscriber with the list of
+    events it's subscribed to, in the order they happened. Subscribers can get every event, the ones entering a
+    given state, or the ones for a given (old, new) edge.
+
+    When the buffer is full, what happens to a new event depends on `policy`:
+        - 'drop': it's dropped (and counted in self.dropped)
+        - 'block': the machine waits until there's room
+        - 'coalesce': it's merged with the event for the same machine that's still waiting, if there is one, into a
+            single Transition(first old, latest new, latest comment) (counted in self.coalesced). Otherwise it's
+            dropped. Subscribers to states or edges won't see the states which get merged away.
+
+    With thread=False no thread is started, and events are only delivered when drain() or flush() is called (from an
+    asyncio task, for example).
+    If a subscriber raises an error, the rest still get their events, and the first error is raised by the next
+    flush() or close().
+    """
+
+    def __init__(self, capacity:int=1024, policy:Literal['drop', 'block', 'coalesce']='drop', batch_size:int=256,
+                 interval:float=.05, thread=True, clock:Callable[[], float]=time.time):
+        if policy not in ('drop', 'block', 'coalesce'):
+            raise ValueError(f"policy must be 'drop', 'block', or 'coalesce'. Got {policy!r}")
+        self.capacity = capacity
+        self.policy = policy
+        self.batch_size = min(batch_size, capacity)
+        """ How many waiting events it takes to wake the delivery thread early """
+        self.interval = interval
+        """ The longest an event waits before being delivered, in seconds (unless the thread is busy delivering) """
+        self.clock = clock
+        self.dropped = 0
+        """ How many events have been dropped because the buffer was full """
+        self.coalesced = 0
+        """ How many events have been merged into another one because the buffer was full """
+
+        self._buffer:list[Event|None] = [None] * capacity
+        self._head = 0
+        self._size = 0
+        self._pending:dict[int, int] = {}
+        """ For the coalesce policy: the slot of the event waiting for each machine, by id() """
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._delivering = threading.Lock()
+        self._closed = False
+        self._error:BaseException|None = None
+
+        # Replaced rather than modified, so they can be read while delivering without a lock
+        self._everything:tuple[Callable, ...] = ()
+        self._by_state:dict[State, tuple[Callable, ...]] = {}
+        self._by_edge:dict[tuple[State|None, State|None], tuple[Callable, ...]] = {}
+        self._classes:set[type] = set()
+
+        self._thread = None
+        if thread:
+            self._thread = threading.Thread(target=self._run, name='EventBus', daemon=True)
+            self._thread.start()
+
+    def attach(self, machine_cls:type):
+        """ Start publishing the state changes of every instance of the given machine class """
+        if machine_cls not in self._classes:
+            self._classes.add(machine_cls)
+            machine_cls.add_listener(self.publish)
+
+    def detach(self, machine_cls:type):
+        """ Stop publishing the state changes of the given class. Events already published are still delivered. """
+        if machine_cls in self._classes:
+            self._classes.discard(machine_cls)
+            machine_cls.remove_listener(self.publish)
+
+    def subscribe(self, callback:Callable[[list[Event]], Any], state:State|None=None,
+                  edge:tuple[State|None, State|None]|None=None):
+        """ Call callback(events) with batches of events. If state is given, only the ones entering that state, and if
+        edge is given, only the ones going from edge[0] to edge[1] (where None is the start or the end). Otherwise,
+        all of them.
+        """
+        if state is not None:
+            self._by_state = {**self._by_state, state: self._by_state.get(state, ()) + (callback,)}
+        elif edge is not None:
+            self._by_edge = {**self._by_edge, edge: self._by_edge.get(edge, ()) + (callback,)}
+        else:
+            self._everything += (callback,)
+
+    def unsubscribe(self, callback:Callable[[list[Event]], Any]):
+        """ Stop calling callback, for everything it was subscribed to """
+        self._everything = tuple(c for c in self._everything if c != callback)
+        self._by_state = {k: cs for k, v in self._by_state.items() if (cs := tuple(c for c in v if c != callback))}
+        self._by_edge = {k: cs for k, v in self._by_edge.items() if (cs := tuple(c for c in v if c != callback))}
+
+    def publish(self, machine, transition:Transition):
+        """ Put a state change in the buffer. This is the listener attach() adds to machine classes. """
+        event = Event(machine, transition, self.clock())
+        with self._lock:
+            if self._size == self.capacity:
+                if self.policy == 'block' and threading.current_thread() is not self._thread:
+                    while self._size == self.capacity and not self._closed:
+                        self._wake.notify()
+                        self._not_full.wait()
+                    if self._closed:
+                        self.dropped += 1
+                        return
+                elif self.policy == 'coalesce' and (slot := self._pending.get(id(machine))) is not None:
+                    first = self._buffer[slot].transition
+                    self._buffer[slot] = Event(machine, Transition(first.old, transition.new, transition.comment), event.time)
+                    self.coalesced += 1
+                    return
+                else:
+                    # Including blocking from a subscriber, which would never get unblocked
+                    self.dropped += 1
+                    return
+
+            slot = (self._head + self._size) % self.capacity
+            self._buffer[slot] = event
+            self._size += 1
+            if self.policy == 'coalesce':
+                self._pending[id(machine)] = slot
+            if self._size == self.batch_size:
+                self._wake.notify()
+
+    def _take(self) -> list[Event]:
+        """ Take everything out of the buffer """
+        with self._lock:
+            head, size, capacity = self._head, self._size, self.capacity
+            buffer = self._buffer
+            if head + size <= capacity:
+                batch = buffer[head:head + size]
+            else:
+                batch = buffer[head:] + buffer[:head + size - capacity]
+            for i in range(size):
+                buffer[(head + i) % capacity] = None
+            self._head = (head + size) % capacity
+            self._size = 0
+            self._pending.clear()
+            self._not_full.notify_all()
+        return batch
+
+    def drain(self) -> int:
+        """ Deliver everything that's in the buffer now, in this thread. Returns how many events were delivered. """
+        with self._delivering:
+            batch = self._take()
+            if batch:
+                self._deliver(batch)
+        return len(batch)
+
+    def _deliver(self, batch:list[Event]):
+        groups:list[tuple[Callable, list[Event]]] = [(callback, batch) for callback in self._everything]
+        by_state, by_edge = self._by_state, self._by_edge
+        if by_state or by_edge:
+            filtered:dict[Callable, list[Event]] = {}
+            for event in batch:
+                old, new, _ = event.transition
+                for callback in by_state.get(new, ()):
+                    filtered.setdefault(callback, []).append(event)
+                for callback in by_edge.get((old, new), ()):
+                    filtered.setdefault(callback, []).append(event)
+            groups += filtered.items()
+
+        for callback, events in groups:
+            try:
+                callback(events)
+            except Exception as err:
+                self._error = self._error or err
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._size < self.batch_size and not self._closed:
+                    self._wake.wait(self.interval)
+                if self._closed and not self._size:
+                    return
+            self.drain()
+
+    def flush(self):
+        """ Deliver everything that's been published so far, and raise the first error a subscriber has raised since
+        the last flush(), if any.
+        """
+        while self.drain():
+            pass
+        if (error := self._error) is not None:
+            self._error = None
+            raise error
+
+    def close(self):
+        """ Detach from every class, deliver everything that's left, and stop the delivery thread """
+        for machine_cls in list(self._classes):
+            self.detach(machine_cls)
+        with self._lock:
+            self._closed = True
+            self._wake.notify_all()
+            self._not_full.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
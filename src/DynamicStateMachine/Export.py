@@ -0,0 +1,145 @@
+""" Writing a machine class's graph as DOT or JSON text, without graphviz, see write_dot() and write_json() """
+import json
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from typing import IO, Iterator, Literal
+
+_ID = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*|-?(\.[0-9]+|[0-9]+(\.[0-9]*)?))$')
+_HTML = re.compile(r'<.*>$', re.DOTALL)
+_KEYWORDS = {'node', 'edge', 'graph', 'digraph', 'subgraph', 'strict'}
+_UNESCAPED_QUOTE = re.compile(r'(?P<backslashes>(?<!\\)(?:\\{2})*)"')
+_SPOOL_SIZE = 1 << 20
+""" How much of the edges write_json() keeps in memory before it puts them in a temporary file """
+
+
+def quote(id) -> str:
+    """ Quote a DOT ID if it needs it, the same way graphviz does """
+    id = str(id)
+    if _HTML.match(id):
+        return id
+    if not _ID.match(id) or id.lower() in _KEYWORDS:
+        return '"' + _UNESCAPED_QUOTE.sub(r'\g<backslashes>\\"', id) + '"'
+    return id
+
+
+def _attr_list(label, attrs:dict) -> str:
+    # Sorted like graphviz does, so the output is the same
+    items = [f'label={quote(label)}'] if label is not None else []
+    items += [f'{quote(k)}={quote(v)}' for k, v in sorted(attrs.items()) if v is not None]
+    return f' [{" ".join(items)}]' if items else ''
+
+
+@contextmanager
+def _open(file:str|os.PathLike|IO[str]) -> Iterator[IO[str]]:
+    """ Open file for writing if it's a path, otherwise use it as it is """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'w', encoding='utf-8') as f:
+            yield f
+    else:
+        yield file
+
+
+def _walk(machine, include_start, use_names, disconnect_virtual, split_ends, _backend, state_attrs,
+          transition_attrs, virtual_attrs, start_attrs, end_attrs):
+    from .Graphing import walk_graph
+    machine_cls = machine if isinstance(machine, type) else type(machine)
+    return machine_cls, walk_graph(machine_cls, include_start, use_names, disconnect_virtual, split_ends, _backend,
+                                   state_attrs, transition_attrs, virtual_attrs, start_attrs, end_attrs)
+
+
+def write_dot(machine,
+              file:str|os.PathLike|IO[str],
+              include_start=True,
+              use_names=True,
+              disconnect_virtual=False,
+              split_ends=True,
+              graph_attrs={},
+              state_attrs=dict(shape='box', style='rounded'),
+              transition_attrs=dict(shape='oval', style='filled', fillcolor='grey80'),
+              virtual_attrs=dict(shape='box', style='dotted'),
+              start_attrs=dict(shape='box', fillcolor='green', style='filled'),
+              end_attrs=dict(shape='triangle', fillcolor='red', style='filled'),
+              _backend:Literal['dis', 'ast']='dis'):
+    """ Write the graph of a machine class (or a machine's class) to file, a path or a text stream, as DOT source.
+    The options are the same as DynamicStateMachine.construct_graphvis()'s, and the output is the same as the source
+    of the graph it makes (without any highlighting), but graphviz isn't needed, and each node and edge is written as
+    it's found instead of building the whole graph first.
+
+    graph_attrs are the parameters construct_graphvis() would give graphviz.Digraph(). The ones that are part of the
+    DOT source (name, comment, strict, graph_attr, node_attr, and edge_attr) are used, and the rest are ignored.
+    """
+    machine_cls, items = _walk(machine, include_start, use_names, disconnect_virtual, split_ends, _backend,
+                               state_attrs, transition_attrs, virtual_attrs, start_attrs, end_attrs)
+    graph_attrs = {'comment': machine_cls.__name__, **graph_attrs}
+    with _open(file) as f:
+        if graph_attrs['comment']:
+            f.write(f'// {graph_attrs["comment"]}\n')
+        name = graph_attrs.get('name')
+        f.write(f'{"strict " if graph_attrs.get("strict") else ""}digraph {quote(name) + " " if name else ""}{{\n')
+        for kind in ('graph', 'node', 'edge'):
+            if attrs := graph_attrs.get(f'{kind}_attr'):
+                f.write(f'\t{kind}{_attr_list(None, attrs)}\n')
+
+        for item in items:
+            if item[0] == 'node':
+                _, name, label, _, attrs = item
+                f.write(f'\t{quote(name)}{_attr_list(label, attrs)}\n')
+            else:
+                _, tail, head, label, attrs = item
+                f.write(f'\t{quote(tail)} -> {quote(head)}{_attr_list(label, attrs)}\n')
+        f.write('}\n')
+
+
+def write_json(machine,
+               file:str|os.PathLike|IO[str],
+               include_start=True,
+               use_names=True,
+               disconnect_virtual=False,
+               split_ends=True,
+               graph_attrs={},
+               state_attrs=dict(shape='box', style='rounded'),
+               transition_attrs=dict(shape='oval', style='filled', fillcolor='grey80'),
+               virtual_attrs=dict(shape='box', style='dotted'),
+               start_attrs=dict(shape='box', fillcolor='green', style='filled'),
+               end_attrs=dict(shape='triangle', fillcolor='red', style='filled'),
+               _backend:Literal['dis', 'ast']='dis'):
+    """ Write the graph of a machine class (or a machine's class) to file, a path or a text stream, as JSON:
+        {"machine": <class name>, "attrs": <graph_attrs["graph_attr"]>,
+         "nodes": [{"id": <name>, "label": <label>, "kind": <kind>, "attrs": {...}}, ...],
+         "edges": [{"from": <name>, "to": <name>, "label": <label or null>, "attrs": {...}}, ...]}
+    with one node or edge per line. kind is one of 'start', 'state', 'virtual', 'transition', or 'end'. The nodes and
+    edges are the same as write_dot()'s, with the same options, except each node is only listed once.
+
+    Nodes are written as they're found. Edges are held until the nodes are done, in a temporary file once there's
+    more than a megabyte of them, so big machines don't need to fit in memory.
+    """
+    machine_cls, items = _walk(machine, include_start, use_names, disconnect_virtual, split_ends, _backend,
+                               state_attrs, transition_attrs, virtual_attrs, start_attrs, end_attrs)
+    # States and end nodes are only yielded once, but transition methods are yielded for each state that uses them
+    transitions = set()
+    dumps = json.JSONEncoder(ensure_ascii=False, default=str).encode
+    with _open(file) as f, tempfile.SpooledTemporaryFile(_SPOOL_SIZE, 'w+', encoding='utf-8') as edges:
+        f.write(f'{{"machine": {dumps(machine_cls.__name__)}, "attrs": {dumps(graph_attrs.get("graph_attr", {}))},\n')
+        f.write(' "nodes": [')
+        node_sep = edge_sep = '\n  '
+        for item in items:
+            if item[0] == 'node':
+                _, name, label, kind, attrs = item
+                if kind == 'transition':
+                    if name in transitions:
+                        continue
+                    transitions.add(name)
+                f.write(node_sep + dumps(dict(id=name, label=label, kind=kind, attrs=attrs)))
+                node_sep = ',\n  '
+            else:
+                _, tail, head, label, attrs = item
+                edges.write(edge_sep + dumps({'from': tail, 'to': head, 'label': label, 'attrs': attrs}))
+                edge_sep = ',\n  '
+
+        f.write('],\n "edges": [')
+        edges.seek(0)
+        while chunk := edges.read(_SPOOL_SIZE):
+            f.write(chunk)
+        f.write(']}\n')
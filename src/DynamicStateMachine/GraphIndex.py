@@ -0,0 +1,208 @@
+from typing import Callable
+from .State import State
+
+
+class GraphIndex:
+    """ The structure of a machine class's transition graph, worked out once so questions about it can be answered
+    quickly: which states can reach which, which can never be reached from the initial state, and which can never
+    finish.
+
+    The graph is made from the class's transitions, and for transition methods, what get_returns_dis() finds they
+    can return. Transition methods are nodes of the graph too, so ones which return each other are handled like any
+    other cycle. Reachability is worked out per strongly connected component, as a bitset of node ids (State.ids for
+    states), so a query is a bit test no matter how big the machine is.
+
+    The answers err on the side of "reachable": every transition method is assumed to be able to finish, and if one
+    returns something that can't be worked out statically (like a local variable), the state using it is assumed to
+    be able to go to any state. Those are listed in self.unresolved. Every state can reach itself.
+    """
+
+    def __init__(self, machine_cls:type):
+        states:list[State] = machine_cls.states._states_list
+        self.machine_cls = machine_cls
+        self.states = states
+        n = len(states)
+        self._end = n
+        """ The node id used for finishing """
+
+        self.unresolved:dict[State, list[str]] = {}
+        """ The states with a transition method which returns something that couldn't be worked out, and what """
+        # Transition methods get nodes of their own after the end's, so methods which return each other are just
+        # another cycle for _build() to deal with
+        self._graph:list[set[int]] = [set() for _ in range(n + 1)]
+        self._methods:dict[str, int] = {}
+        """ The node id of each transition method, by name """
+        self._method_unresolved:dict[int, list[str]] = {}
+        """ The returns of each transition method which couldn't be worked out, by node id """
+        for state, transition in machine_cls._get_plan().transitions.items():
+            if isinstance(transition, State):
+                self._graph[state.id].add(transition.id)
+            else:
+                self._graph[state.id].add(self._method_node(transition))
+
+        adjacency:list[tuple[int, ...]] = []
+        for node in range(n + 1):
+            targets, unresolved = self._follow_methods(node)
+            if unresolved:
+                self.unresolved[states[node]] = unresolved
+            adjacency.append(tuple(sorted(targets)))
+        self.adjacency = adjacency
+        """ The ids each state can go to next, by State.id (through any transition methods). The last entry is for the
+            end, which goes nowhere, and the end's id is len(states). """
+
+        self._members:list[tuple[State, ...]] = []
+        """ The states in each strongly connected component (the end's, and those of only methods, are empty) """
+        self._component:list[int] = [0] * len(self._graph)
+        """ The index of the component each node is in """
+        self._reach:list[int] = []
+        """ The bitset of the node ids each component can reach """
+        self._build()
+
+        initial = machine_cls.initial
+        self._from_initial = self._reach[self._component[initial.id]]
+
+    def _method_node(self, func:Callable) -> int:
+        """ The node id of a transition method, adding it (and the methods it returns) to the graph if it's new """
+        name = getattr(func, '__name__', repr(func))
+        if (node := self._methods.get(name)) is not None:
+            return node
+        graph = self._graph
+        node = self._methods[name] = len(graph)
+        # The analysis can't tell `return None` apart from the end of the method, so any of them could finish
+        targets = {self._end}
+        unresolved = []
+        graph.append(targets)
+        states = self.machine_cls.states._states
+        from .Graphing import get_returns_dis
+
+        for ret, _ in get_returns_dis(func):
+            if ret is None:
+                targets.add(self._end)
+            elif isinstance(ret, str) and ret in states:
+                targets.add(states[ret].id)
+            elif isinstance(ret, str) and callable(method := getattr(self.machine_cls, ret, None)):
+                targets.add(self._method_node(method))
+            else:
+                unresolved.append(f'{name}() returns {ret!r}')
+        if unresolved:
+            self._method_unresolved[node] = unresolved
+            targets.update(range(self._end + 1))
+        return node
+
+    def _follow_methods(self, node:int) -> tuple[set[int], list[str]]:
+        """ The states (and end) a node goes to next, going through any transition methods on the way, and the returns
+        of those methods which couldn't be worked out
+        """
+        graph = self._graph
+        end = self._end
+        targets = set()
+        unresolved = []
+        seen = set()
+        work = list(graph[node])
+        while work:
+            if (child := work.pop()) <= end:
+                targets.add(child)
+            elif child not in seen:
+                seen.add(child)
+                unresolved += self._method_unresolved.get(child, ())
+                work += graph[child]
+        return targets, unresolved
+
+    def _build(self):
+        """ Find the strongly connected components (with an iterative Tarjan's algorithm), and what each of them can
+        reach. Tarjan's finds each component after every component it leads to, so they can be filled in in order.
+        """
+        adjacency = [tuple(children) for children in self._graph]
+        count = len(adjacency)
+        index = [-1] * count
+        low = [0] * count
+        on_stack = [False] * count
+        stack = []
+        next_index = 0
+        component = self._component
+        reach = self._reach
+
+        for root in range(count):
+            if index[root] != -1:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = low[node] = next_index
+                    next_index += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                else:
+                    # Coming back from the child before i
+                    low[node] = min(low[node], low[adjacency[node][i - 1]])
+
+                children = adjacency[node]
+                while i < len(children):
+                    child = children[i]
+                    if index[child] == -1:
+                        break
+                    if on_stack[child]:
+                        low[node] = min(low[node], index[child])
+                    i += 1
+                if i < len(children):
+                    work.append((node, i + 1))
+                    work.append((children[i], 0))
+                    continue
+
+                if low[node] == index[node]:
+                    c = len(reach)
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component[member] = c
+                        members.append(member)
+                        if member == node:
+                            break
+                    # Everything it leads to outside of itself is in a component that's already done
+                    bits = 0
+                    for member in members:
+                        bits |= 1 << member
+                        for child in adjacency[member]:
+                            if component[child] != c:
+                                bits |= reach[component[child]]
+                    reach.append(bits)
+                    self._members.append(tuple(self.states[m] for m in reversed(members) if m < self._end))
+
+    def _bits_to_states(self, bits:int) -> frozenset[State]:
+        # Going through the binary string is done in C, unlike shifting a big int over and over
+        states = self.states
+        n = len(states)
+        return frozenset(states[id] for id, bit in enumerate(reversed(bin(bits)[2:])) if bit == '1' and id < n)
+
+    @property
+    def components(self) -> list[tuple[State, ...]]:
+        """ The strongly connected components of the graph: groups of states which can all reach each other. The
+        ones later in the graph come first.
+        """
+        return [members for members in self._members if members]
+
+    def component_of(self, state:State) -> tuple[State, ...]:
+        """ The strongly connected component the state is in """
+        return self._members[self._component[state.id]]
+
+    def can_reach(self, a:State, b:State|None) -> bool:
+        """ If a machine in state a could ever get to state b (or finish, if b is None) """
+        return bool(self._reach[self._component[a.id]] >> (self._end if b is None else b.id) & 1)
+
+    def can_finish(self, state:State) -> bool:
+        """ If a machine in the given state could ever finish """
+        return self.can_reach(state, None)
+
+    def reachable_from(self, state:State) -> frozenset[State]:
+        """ Every state a machine in the given state could get to, including itself """
+        return self._bits_to_states(self._reach[self._component[state.id]])
+
+    def unreachable_states(self) -> frozenset[State]:
+        """ The states a machine can never get to from the initial state """
+        return frozenset(self.states) - self._bits_to_states(self._from_initial)
+
+    def dead_states(self) -> frozenset[State]:
+        """ The states a machine can never finish from (including states without a transition) """
+        return frozenset(state for state in self.states if not self.can_finish(state))
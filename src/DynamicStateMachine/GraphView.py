@@ -0,0 +1,97 @@
+from collections import deque
+from typing import Any, Callable
+from .Transition import Transition
+
+_views:dict[int, tuple['GraphView', ...]] = {}
+""" The open views of every machine being viewed, by id() of the machine """
+_viewed_plans:dict[object, int] = {}
+""" How many open views there are of the machines of each DispatchPlan, which _dispatch() is a listener of """
+
+
+def _dispatch(machine, transition:Transition):
+    """ The one listener added to each class with views, so a transition costs a dict lookup no matter how many views
+    there are """
+    for view in _views.get(id(machine), ()):
+        view._on_transition(transition)
+
+
+class GraphView:
+    """ A live view of a single machine on its class's graph.
+
+    The graph of the class is built once (and cached, see DynamicStateMachine.construct_graphvis()), and the view
+    just keeps track of the machine's current state and the last few transitions it took, which is O(1) per
+    transition. graph() draws those on top of a copy of the cached graph. All the views of a class share a single
+    listener, which finds the views of the machine that changed by its id().
+
+    Front-ends which want to be told about changes instead of polling can subscribe() to the view.
+    """
+
+    def __init__(self, machine, history:int=3, node_attrs:dict=dict(color='blue', style='bold'),
+                 edge_attrs:dict=dict(color='blue', style='dashed', constraint='false'), **graph_options):
+        """ history is how many of the most recent transitions get drawn. node_attrs are the attrs used to highlight
+        the current state, and edge_attrs the ones used to draw the recent transitions. Any other parameters are
+        passed to construct_graphvis().
+        """
+        self.machine = machine
+        """ The machine being viewed """
+        self.recent:deque[Transition] = deque(maxlen=history)
+        """ The most recent transitions the machine took, oldest first """
+        self.node_attrs = node_attrs
+        self.edge_attrs = edge_attrs
+        self._graph_options = graph_options
+        self._subscribers:list[Callable[[Transition], Any]] = []
+        self._open = True
+
+        plan = machine._plan
+        if not _viewed_plans.get(plan):
+            type(machine).add_listener(_dispatch)
+        _viewed_plans[plan] = _viewed_plans.get(plan, 0) + 1
+        _views[id(machine)] = _views.get(id(machine), ()) + (self,)
+
+    def _on_transition(self, transition:Transition):
+        self.recent.append(transition)
+        for subscriber in self._subscribers:
+            subscriber(transition)
+
+    def subscribe(self, callback:Callable[[Transition], Any]):
+        """ Call callback(Transition(old, new, comment)) every time the machine changes state """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback:Callable[[Transition], Any]):
+        self._subscribers.remove(callback)
+
+    def graph(self):
+        """ A graphviz.Digraph of the machine's class, with the current state and recent transitions highlighted """
+        dot = self.machine.construct_graphvis(highlighted=None, **self._graph_options)
+        if dot is None:
+            return None
+        for old, new, comment in self.recent:
+            if old is not None and new is not None:
+                dot.edge(old.name, new.name, comment, **self.edge_attrs)
+        if (state := self.machine.state) is not None:
+            dot.node(state.name, **self.node_attrs)
+        return dot
+
+    def close(self):
+        """ Stop following the machine """
+        if not self._open:
+            return
+        self._open = False
+        key = id(self.machine)
+        if views := tuple(view for view in _views.get(key, ()) if view is not self):
+            _views[key] = views
+        else:
+            _views.pop(key, None)
+
+        plan = self.machine._plan
+        _viewed_plans[plan] -= 1
+        if not _viewed_plans[plan]:
+            del _viewed_plans[plan]
+            type(self.machine).remove_listener(_dispatch)
+        self._subscribers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,292 @@
+""" The graph drawing and transition method analysis behind DynamicStateMachine.construct_graphvis() and
+get_returns_dis()/get_returns_ast(). This is only imported the first time one of those is called, so that importing
+the package (in worker processes, CLI tools, etc.) doesn't have to import graphviz, dis, ast, and inspect.
+"""
+import ast
+import dis
+import inspect
+from typing import Callable, Iterator
+from .State import State
+# Through the package, so the AnalysisCache class is what it's left with, not the module of the same name
+from . import analysis_cache
+
+try:
+    from graphviz import Digraph
+except ImportError:
+    Digraph = None
+
+
+def get_returns_dis(func):
+    """ See DynamicStateMachine.get_returns_dis() """
+    return analysis_cache.get(func, 'dis', _get_returns_dis)
+
+
+def get_returns_ast(func):
+    """ See DynamicStateMachine.get_returns_ast() """
+    return analysis_cache.get(func, 'ast', _get_returns_ast)
+
+
+# This would probably be easier and work better if it used ast instead of dis
+def _get_returns_dis(func):
+    # return [instr.argrepr for instr in dis.Bytecode(func) if instr.opname in ("RETURN_CONST", "RETURN_VALUE")]
+    rtn = []
+    stack = []  # Tracks last loaded values
+
+    for instr in dis.Bytecode(func):
+        if instr.opname in {"LOAD_FAST", "LOAD_GLOBAL", "LOAD_DEREF", "LOAD_CONST", 'LOAD_ATTR'}:  # Variable names
+            stack.append(instr.argval)
+        elif instr.opname == "RETURN_VALUE":
+            if stack[-1] is None:
+                stack.pop(-1)
+                continue
+            if stack:  # Use last loaded value (var name or literal)
+                rtn.append(stack[-1])
+        elif instr.opname == "RETURN_CONST":
+            rtn.append(instr.argval)
+        elif instr.opname == "BUILD_TUPLE":
+            rtn.append((stack.pop(-2), stack.pop(-1)))
+            stack.append(None)
+
+    return [((i, '') if type(i) is not tuple else i) for i in rtn]
+
+# This almost works, but not quite. It wasn't as good of an option as I was hoping
+# Then again, it may work, but what I was testing it with didn't
+
+def _get_returns_ast(func):
+    class ReturnVisitor(ast.NodeVisitor):
+        def __init__(self):
+            self.returns = {}
+
+        def visit_FunctionDef(self, node):
+            """Handles both function definitions and lambdas."""
+            self.generic_visit(node)  # Process child nodes
+
+        def visit_Lambda(self, node):
+            """Handles lambda functions."""
+            return_value = self.extract_value(node.body)
+            self.returns[return_value] = None  # Lambdas don't have doc-like comments after return
+
+        def visit_Return(self, node):
+            """Handles return statements and collects potential trailing string literals."""
+            return_value = self.extract_value(node.value)
+            trailing_string = self.get_trailing_string(node)
+            self.returns[return_value] = trailing_string
+
+        def extract_value(self, node):
+            """Extracts literals or variable names from AST nodes."""
+            if isinstance(node, ast.Constant):  # Literal values (numbers, strings, etc.)
+                return node.value
+            elif isinstance(node, ast.Name):  # Variables
+                return node.id
+            return "<unknown>"
+
+        def get_trailing_string(self, node):
+            """Finds a string literal immediately following a return statement."""
+            parent = node.parent
+            if parent:
+                body = parent.body
+                try:
+                    node_index = body.index(node)
+                except ValueError:
+                    body = parent.orelse
+                    try:
+                        node_index = body.index(node)
+                    except ValueError:
+                        print('Comment in unhandled place')
+                        return
+                if node_index + 1 < len(body):
+                    next_node = body[node_index + 1]
+                    if isinstance(next_node, ast.Expr) and isinstance(next_node.value, ast.Constant):
+                        if isinstance(next_node.value.value, str):  # Must be a string
+                            return next_node.value.value
+            return None
+
+    source = inspect.getsource(func)
+    tree = ast.parse(source)
+
+    # Set parent references for easy access
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            child.parent = node
+
+    visitor = ReturnVisitor()
+    visitor.visit(tree)
+    return visitor.returns
+
+
+def construct_graphvis(machine, include_start, use_names, disconnect_virtual, split_ends, highlighted, graph_attrs,
+                       state_attrs, transition_attrs, virtual_attrs, start_attrs, end_attrs, heat, _backend) -> 'Digraph':
+    """ See DynamicStateMachine.construct_graphvis() """
+    # Allow the package to be optional
+    if not Digraph:
+        return
+
+    # The graph only depends on the class and the options, so it only gets built once for each set of options.
+    # Highlighting is done on a copy of it, which only costs copying its list of lines.
+    options = (include_start, use_names, disconnect_virtual, split_ends, _backend)
+    attrs = (graph_attrs, state_attrs, transition_attrs, virtual_attrs, start_attrs, end_attrs)
+    key = options + tuple(repr(sorted(a.items())) for a in attrs)
+    graphs = machine._plan.graphs
+    if heat is not None:
+        # This changes as the machine runs, so it can't be cached
+        dot = build_graphvis(machine, *options, *attrs, edge_style=heat.edge_style(type(machine)))
+        for state, node_attrs in heat.state_styles(type(machine)).items():
+            dot.node(state.name, **node_attrs)
+    elif (base := graphs.get(key)) is not None:
+        dot = base.copy()
+    else:
+        base = graphs[key] = build_graphvis(machine, *options, *attrs)
+        dot = base.copy()
+
+    if highlighted is Ellipsis:
+        if machine.state is not None:
+            dot = highlight_node(dot, machine.state.name)
+    elif highlighted:
+        assert isinstance(highlighted, State), 'highlighted must be a State'
+        dot = highlight_node(dot, highlighted.name)
+
+    return dot
+
+
+def build_graphvis(machine, include_start, use_names, disconnect_virtual, split_ends, _backend, graph_attrs,
+                   state_attrs, transition_attrs, virtual_attrs, start_attrs, end_attrs, edge_style=None) -> 'Digraph':
+    """ Build the graph for construct_graphvis(), without any highlighting.
+    If edge_style is given, edge_style(tail, head) is called for each edge, and should return a dict of extra attrs
+    for it. tail is the State or the name of the transition method the edge comes from, and head is the State,
+    the name of the transition method, or None (for the end) it goes to.
+    """
+    dot = Digraph(**{'comment': type(machine).__name__, **graph_attrs})
+    for item in walk_graph(type(machine), include_start, use_names, disconnect_virtual, split_ends, _backend,
+                           state_attrs, transition_attrs, virtual_attrs, start_attrs, end_attrs, edge_style):
+        if item[0] == 'node':
+            _, name, label, _, attrs = item
+            dot.node(name, label, **attrs)
+        else:
+            _, tail, head, label, attrs = item
+            dot.edge(tail, head, label, **attrs)
+    return dot
+
+
+def walk_graph(machine_cls, include_start, use_names, disconnect_virtual, split_ends, _backend, state_attrs,
+               transition_attrs, virtual_attrs, start_attrs, end_attrs, edge_style=None) -> Iterator[tuple]:
+    """ Walk the transition table of a machine class, yielding the nodes and edges of its graph as it goes:
+        ('node', name, label, kind, attrs), where kind is 'start', 'state', 'virtual', 'transition', or 'end'
+        ('edge', tail name, head name, label, attrs)
+    Every state gets a node, including ones without a transition, which come after the rest. Nodes come before the
+    first edge to them, except for states, which can be gone to before they're reached in the table. Transition
+    method nodes are yielded again every time a state uses them. This is what build_graphvis() (and so
+    construct_graphvis()) and the writers in Export use, and it only keeps track of the transition methods it's seen,
+    not the whole graph.
+    """
+    def edge_attrs(tail, head) -> dict:
+        return edge_style(tail, head) if edge_style else {}
+
+    handled_transitions = set()
+    # To ensure all the end nodes have unique names
+    # I realized later I could have used monotonic() for this, but it's already implemented this way
+    end_counter = 0
+    counters = {}
+    states = machine_cls.states._states
+
+    def create_destination_state_node(state):
+        """ The name of the node to go to for state. Yields the node first, if it needs its own. """
+        goto = state.name
+        if state.virtual and disconnect_virtual:
+            # we need to keep track to ensure uniqueness
+            if state.name not in counters:
+                counters[state.name] = 0
+            goto = state.name + str(counters[state.name])
+            counters[state.name] += 1
+            yield 'node', goto, state.name, 'virtual', virtual_attrs
+        return goto
+
+    def add_function_outputs(trans:Callable):
+        nonlocal end_counter
+
+        # For some reason just the reference doesn't work? Unsure why. This works though.
+        if trans.__name__ in handled_transitions:
+            return
+        else:
+            handled_transitions.add(trans.__name__)
+
+        if _backend == 'dis':
+            items = get_returns_dis(trans)
+        elif _backend == 'ast':
+            items = get_returns_ast(trans).items()
+        else:
+            raise ValueError(f"_backend value must be either 'dis' or 'ast'. Got {_backend}")
+
+        for ret, comment in items:
+            ret: str
+            comment: str
+
+            # Goes to the end
+            if ret is None:
+                if split_ends or not end_counter:
+                    yield 'node', f'End{end_counter}', 'End', 'end', end_attrs
+                yield 'edge', trans.__name__, f'End{end_counter}', comment, edge_attrs(trans.__name__, None)
+                end_counter += 1
+
+            # Goes to another state
+            elif ret in states:
+                state = states[ret]
+                goto = yield from create_destination_state_node(state)
+                yield 'edge', trans.__name__, goto, comment, edge_attrs(trans.__name__, state)
+
+            # Goes to another transition function to decide where to go next
+            # TODO: in order to support standalone functions, this if statement will have to be changed
+            elif hasattr(machine_cls, ret):
+                lbl = ret
+                if not use_names:
+                    lbl = lbl.replace('_', ' ')
+                yield 'node', ret, lbl, 'transition', transition_attrs
+                yield 'edge', trans.__name__, ret, comment, edge_attrs(trans.__name__, ret)
+                yield from add_function_outputs(getattr(machine_cls, ret))
+
+            else:
+                raise ValueError(f'return value is not a state, None, nor a transition function. Got {ret!r}')
+
+    if include_start:
+        yield 'node', 'Start', 'Start', 'start', start_attrs
+        yield 'edge', 'Start', machine_cls.initial.name, None, {}
+
+    # Add states as nodes
+    transitions = machine_cls._get_plan().transitions
+    for state, transition in transitions.items():
+        state: State
+        transition: Callable
+
+        label = state.name if use_names else state.value
+
+        if state.virtual:
+            yield 'node', state.name, label, 'virtual', virtual_attrs
+        else:
+            yield 'node', state.name, label, 'state', state_attrs
+        if isinstance(transition, State):
+            goto = yield from create_destination_state_node(transition)
+            yield 'edge', state.name, goto, None, edge_attrs(state, transition)
+
+        # If it's not simple, then it's a function
+        else:
+            lbl = transition.__name__
+            if not use_names:
+                lbl = lbl.replace('_', ' ')
+            yield 'node', transition.__name__, lbl, 'transition', transition_attrs
+            yield 'edge', state.name, transition.__name__, None, edge_attrs(state, transition.__name__)
+
+            yield from add_function_outputs(transition)
+
+    # And the states without a transition of their own, which would otherwise only be there as the heads of edges
+    for state in machine_cls.states._states_list:
+        if state not in transitions:
+            label = state.name if use_names else state.value
+            if state.virtual:
+                yield 'node', state.name, label, 'virtual', virtual_attrs
+            else:
+                yield 'node', state.name, label, 'state', state_attrs
+
+
+def highlight_node(graph:'Digraph', id:str, color='blue', style='bold', **attrs):
+    if Digraph:
+        graph.node(id, color=color, style=style, **attrs)
+        return graph
@@ -0,0 +1,201 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple
+from .Transition import Transition
+from .Snapshot import FINISHED, Snapshot, find_machine, machine_path
+
+# magic, version, length of the class path, number of states in the class
+_HEADER = struct.Struct('=4sIII')
+_MAGIC = b'DSMJ'
+_VERSION = 1
+# key, old state id, new state id, timestamp, comment index, reserved. 32 bytes, so records stay aligned.
+_RECORD = struct.Struct('=qiidII')
+_NO_COMMENT = 0
+
+
+class JournalRecord(NamedTuple):
+    """ One transition, as stored in a journal """
+    key: int
+    old: int
+    """ The State.id of the state before, or -1 if the machine was just starting """
+    new: int
+    """ The State.id of the state after, or -1 if the machine finished """
+    time: float
+    comment: str|None
+
+
+class Journal:
+    """ An append-only binary record of every transition the instances of a machine class take, for auditing and
+    recovering after a crash.
+
+    Each transition is a fixed size record of (key, old state id, new state id, timestamp, comment index), where key
+    is key(machine), which must be an int that fits in 64 bits, and identifies the instance when replaying. Comments
+    are stored once each, in a '<path>.comments' file next to the journal, and referred to by index.
+
+    Records are buffered in memory and written and fsync()ed to the file every `batch` records, and on flush() and
+    close(), so a crash can lose up to the last `batch` transitions, but what's on disk is always a valid journal.
+    Opening an existing journal appends to it.
+
+    Use replay_journal() or restore_journal() to get the last state of every instance back.
+    """
+
+    def __init__(self, path:str|os.PathLike, machine_cls:type, key:Callable[[object], int]=id, batch:int=4096,
+                 clock:Callable[[], float]=time.time):
+        """ The default key, id(), is only unique while the machines are alive, so pass something that identifies
+        them across restarts to be able to recover them.
+        """
+        self.path = Path(path)
+        self.machine_cls = machine_cls
+        self.key = key
+        self.batch = batch
+        """ How many records are buffered before they're written and synced """
+        self.clock = clock
+        self._buffer = bytearray()
+        self._count = 0
+        self._lock = threading.Lock()
+        self._comments:dict[str, int] = {}
+        self._new_comments:list[str] = []
+
+        path_bytes = machine_path(machine_cls).encode()
+        num_states = len(machine_cls.states._states_list)
+        self._file = open(self.path, 'ab+')
+        if self._file.tell() == 0:
+            header = _HEADER.pack(_MAGIC, _VERSION, len(path_bytes), num_states) + path_bytes
+            # Pad the header, so the records are aligned
+            self._file.write(header + b'\0' * (-len(header) % _RECORD.size))
+            self._sync()
+        else:
+            start = _header_size(len(path_bytes))
+            self._file.seek(0)
+            _read_header(self._file.read(start), machine_cls)
+            # Cut off a record that was only half written
+            end = self._file.seek(0, os.SEEK_END)
+            self._file.truncate(end - (end - start) % _RECORD.size)
+            self._file.seek(0, os.SEEK_END)
+            for i, comment in enumerate(_read_comments(self.path), 1):
+                self._comments[comment] = i
+
+        machine_cls.add_listener(self.record)
+
+    def record(self, machine, transition:Transition):
+        """ Add a transition to the journal. This is the listener added to the machine class. """
+        old, new, comment = transition
+        index = _NO_COMMENT
+        with self._lock:
+            if comment is not None and (index := self._comments.get(comment)) is None:
+                index = self._comments[comment] = len(self._comments) + 1
+                self._new_comments.append(comment)
+            self._buffer += _RECORD.pack(self.key(machine), FINISHED if old is None else old.id,
+                                         FINISHED if new is None else new.id, self.clock(), index, 0)
+            self._count += 1
+            if self._count >= self.batch:
+                self._write()
+
+    def _write(self):
+        # Comments first, so a record never refers to a comment that isn't on disk
+        if self._new_comments:
+            with open(self.path.with_name(self.path.name + '.comments'), 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(comment) + '\n' for comment in self._new_comments)
+                f.flush()
+                os.fsync(f.fileno())
+            self._new_comments.clear()
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._sync()
+            self._buffer.clear()
+        self._count = 0
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def flush(self):
+        """ Write and sync everything that's been recorded so far """
+        with self._lock:
+            self._write()
+
+    def close(self):
+        """ Stop recording, and write everything that's been recorded """
+        self.machine_cls.remove_listener(self.record)
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _header_size(path_len:int) -> int:
+    size = _HEADER.size + path_len
+    return size + -size % _RECORD.size
+
+
+def _read_header(data, machine_cls:type|None) -> tuple[type, int]:
+    """ Check the header of a journal. Returns the machine class, and where the records start """
+    magic, version, path_len, num_states = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError('Not a journal written by Journal')
+    if version != _VERSION:
+        raise ValueError(f'Unsupported journal version {version}')
+    path = bytes(data[_HEADER.size:_HEADER.size + path_len]).decode()
+    cls = find_machine(path) if machine_cls is None else machine_cls
+    if machine_path(cls) != path:
+        raise ValueError(f'The journal is for {path}, not {machine_path(cls)}')
+    if len(cls.states._states_list) != num_states:
+        raise ValueError(f'{path} has changed since the journal was written: it had {num_states} states, now it has {len(cls.states._states_list)}')
+    return cls, _header_size(path_len)
+
+
+def _read_comments(path:Path) -> list[str]:
+    try:
+        with open(path.with_name(path.name + '.comments'), encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def _map(path:str|os.PathLike, machine_cls:type|None) -> tuple[type, memoryview]:
+    """ Memory map a journal. Returns the machine class, and a memoryview of the (whole) records. """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    cls, start = _read_header(mm, machine_cls)
+    # Ignore a record that was only half written
+    end = start + (len(mm) - start) // _RECORD.size * _RECORD.size
+    return cls, memoryview(mm)[start:end]
+
+
+def replay_journal(path:str|os.PathLike, machine_cls:type=None) -> tuple[type, dict[int, int]]:
+    """ Find the last state of every instance in a journal, without deserializing records one at a time or calling
+    anything on the machines. Returns the machine class, and the State.id each key ended up in (-1 for the ones that
+    finished). If machine_cls is given, the journal must have been written for that class.
+    """
+    cls, records = _map(path, machine_cls)
+    # Each record is 4 int64s: the key, the old and new ids, the timestamp, and the comment index
+    keys = records.cast('q')[0::4]
+    new_ids = records.cast('i')[3::8]
+    # Later records overwrite earlier ones
+    return cls, dict(zip(keys, new_ids))
+
+
+def restore_journal(path:str|os.PathLike, machine_cls:type=None) -> dict[int, object]:
+    """ Recreate the machines in a journal, in the last state they were in, without any side effects. Keys which
+    finished are left out.
+    """
+    cls, ids = replay_journal(path, machine_cls)
+    return {key: cls.restore(Snapshot(None, id)) for key, id in ids.items() if id != FINISHED}
+
+
+def read_journal(path:str|os.PathLike, machine_cls:type=None) -> Iterator[JournalRecord]:
+    """ Every record in a journal, in order """
+    cls, records = _map(path, machine_cls)
+    comments = [None] + _read_comments(Path(path))
+    for key, old, new, timestamp, comment, _ in _RECORD.iter_unpack(records):
+        yield JournalRecord(key, old, new, timestamp, comments[comment])
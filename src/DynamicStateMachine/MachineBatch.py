@@ -0,0 +1,134 @@
+from typing import Iterator
+from .State import State
+from .DynamicStateMachine import DynamicStateMachine
+
+np = None
+""" numpy, once the first MachineBatch is created. It's optional, and slow to import, so it's only imported then. """
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('MachineBatch requires numpy. Install it with `pip install DynamicStateMachine[batch]`') from None
+        np = numpy
+
+
+class MachineBatch:
+    """ Many instances of the same DynamicStateMachine subclass, advanced together.
+
+    The current state of every instance is stored as its State.id in a numpy array (-1 meaning finished). Calling
+    next() advances every instance whose transition is a simple `State >> State` transition (following any virtual
+    states along the way) with a single table lookup over the whole array. Only the instances in a state with a
+    transition method, or where a before_/after_/on_ hook would fire, are advanced one at a time, using a real
+    instance of the machine class which gets created the first time that instance needs it (and is then kept, so any
+    attributes the methods set on it stick around).
+
+    While the class has listeners (see DynamicStateMachine.add_listener()), every instance is advanced one at a time,
+    so the listeners are told about every transition, along with the instance it happened to.
+
+    NOTE: Subclasses which override next() or set_state() won't have those overrides called for the instances that
+    are advanced in bulk.
+    """
+
+    FINISHED = -1
+    """ The id stored for instances which have finished """
+    _SLOW = -2
+    """ Marks a state in the lookup table which has to be advanced per instance """
+
+    def __init__(self, machine_cls:type, n:int, start_immediately=True, trigger_initial_side_effects=True):
+        _import_numpy()
+
+        self.machine_cls = machine_cls
+        """ The DynamicStateMachine subclass of every instance in the batch """
+        self._trigger_initial_side_effects = trigger_initial_side_effects
+        self._plan = plan = machine_cls._get_plan()
+        self._states:list[State] = machine_cls.states._states_list
+        self._machines:dict[int, object] = {}
+        """ The instances which have needed a real machine, by row """
+
+        # Indexed by State.id + 1, so finished instances (-1) look up index 0, and stay finished
+        table = np.full(len(self._states) + 1, self._SLOW, dtype=np.int32)
+        table[0] = self.FINISHED
+        for state in self._states:
+            if (dest := plan.hookless_destination(state)) is not None:
+                table[state.id + 1] = dest.id
+        self._table = table
+
+        self.ids = np.full(n, self.FINISHED, dtype=np.int32)
+        """ The State.id of the current state of each instance, or -1 if it's finished """
+
+        if start_immediately:
+            self.start()
+
+    def start(self):
+        """ Start every instance in the batch. Instances only get created if starting them has side effects. """
+        initial = self.machine_cls.initial
+        has_side_effects = self.machine_cls.on_start is not DynamicStateMachine.on_start or (
+            self._trigger_initial_side_effects and (
+                self._plan.before[initial.id] or self._plan.on[initial.id] or self._plan.listeners
+            )
+        )
+
+        self.ids[:] = initial.id
+        if has_side_effects:
+            for row in range(len(self.ids)):
+                machine = self.machine(row)
+                machine._state = None
+                machine.start(self._trigger_initial_side_effects)
+                self._store(row, machine)
+
+    def machine(self, row:int):
+        """ Get the instance of the machine class at the given row, creating it if it doesn't exist yet.
+        Its state is synced to the batch's current state for that row.
+        """
+        try:
+            machine = self._machines[row]
+        except KeyError:
+            machine = self._machines[row] = self.machine_cls(start_immediately=False)
+        id = int(self.ids[row])
+        machine._state = None if id == self.FINISHED else self._states[id]
+        return machine
+
+    def _store(self, row:int, machine):
+        self.ids[row] = self.FINISHED if machine._state is None else machine._state.id
+
+    def next(self, *args, **kwargs) -> 'np.ndarray':
+        """ Advance every unfinished instance in the batch, passing the given parameters to every instance's
+        transition and side effect methods, just like DynamicStateMachine.next().
+        Returns the array of the new state ids.
+        """
+        old = self.ids
+        if self._plan.listeners:
+            # The listeners need a real instance for every transition
+            new = old.copy()
+            slow = np.flatnonzero(old != self.FINISHED)
+        else:
+            new = self._table[old + 1]
+            slow = np.flatnonzero(new == self._SLOW)
+            # Put them back where they were, so machine() picks up the right state
+            new[slow] = old[slow]
+        self.ids = new
+        for row in slow.tolist():
+            machine = self.machine(row)
+            machine.next(*args, **kwargs)
+            self._store(row, machine)
+        return self.ids
+
+    @property
+    def finished(self) -> 'np.ndarray':
+        """ A boolean mask of which instances have finished """
+        return self.ids == self.FINISHED
+
+    def states(self) -> list[State|None]:
+        """ The current State of each instance (None for finished ones) """
+        states = self._states + [None]
+        return [states[i] for i in self.ids.tolist()]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[State|None]:
+        return iter(self.states())
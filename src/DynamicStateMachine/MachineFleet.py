@@ -0,0 +1,134 @@
+from typing import Any, Hashable, Iterable
+from .State import State
+from .Snapshot import FINISHED, state_id
+
+
+def _worker(machine_cls:type, conn):
+    """ The loop run by each process in a MachineFleet. It owns the machines of one shard, keyed by their key """
+    machines = {}
+    while True:
+        cmd, payload = conn.recv()
+        try:
+            if cmd == 'events':
+                results = {}
+                for key, args, kwargs in payload:
+                    if (machine := machines.get(key)) is None:
+                        machine = machines[key] = machine_cls()
+                    machine.next(*args, **kwargs)
+                    results[key] = id = state_id(machine)
+                    if id == FINISHED:
+                        del machines[key]
+                conn.send(('ok', list(results.items())))
+            elif cmd == 'states':
+                conn.send(('ok', [(key, state_id(machine)) for key, machine in machines.items()]))
+            elif cmd == 'close':
+                conn.send(('ok', None))
+                return
+            else:
+                raise ValueError(f'Unknown command {cmd!r}')
+        except Exception as err:
+            try:
+                conn.send(('error', err))
+            except Exception:
+                conn.send(('error', RuntimeError(repr(err))))
+
+
+class MachineFleet:
+    """ Many keyed instances of the same DynamicStateMachine subclass, sharded over a pool of processes by the hash
+    of their key.
+
+    Events are submitted in batches of (key, args, kwargs), where args and kwargs are passed to the machine's next().
+    Each batch is split up by shard and sent to each process in one message, and the events for a key are applied in
+    the order they were submitted. A machine is created (with machine_cls()) the first time its key gets an event,
+    and is dropped once it finishes; another event for the same key after that starts a new machine.
+
+    The machine class must be importable by the worker processes (i.e. defined at the top level of a module), and
+    the keys, args and kwargs must be picklable.
+    """
+
+    def __init__(self, machine_cls:type, processes:int|None=None, context:str|None=None):
+        """ processes defaults to the number of CPUs. context is the multiprocessing start method to use, and
+        defaults to the platform's default.
+        """
+        # Make sure the class is valid before starting any processes
+        machine_cls._get_plan()
+        self.machine_cls = machine_cls
+        """ The DynamicStateMachine subclass of every machine in the fleet """
+        self._states:list[State] = machine_cls.states._states_list
+        import multiprocessing
+        ctx = multiprocessing.get_context(context)
+        self._conns = []
+        self._processes = []
+        for _ in range(processes or multiprocessing.cpu_count()):
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(machine_cls, child), daemon=True)
+            process.start()
+            child.close()
+            self._conns.append(parent)
+            self._processes.append(process)
+
+    def shard(self, key:Hashable) -> int:
+        """ The index of the process which owns the machine with the given key """
+        return hash(key) % len(self._conns)
+
+    def _request(self, messages:dict[int, tuple[str, Any]]) -> list:
+        """ Send a message to each of the given shards, then wait for all their replies. Raises the first error any
+        of them had, after all of them have replied.
+        """
+        for shard, msg in messages.items():
+            self._conns[shard].send(msg)
+
+        replies = []
+        error = None
+        for shard in messages:
+            status, payload = self._conns[shard].recv()
+            if status == 'error':
+                error = error or payload
+            else:
+                replies.append(payload)
+        if error is not None:
+            raise error
+        return replies
+
+    def _to_states(self, replies:list) -> dict[Hashable, State|None]:
+        states = self._states
+        return {key: None if id == FINISHED else states[id] for reply in replies for key, id in reply}
+
+    def submit(self, events:Iterable[tuple[Hashable, tuple, dict]]) -> dict[Hashable, State|None]:
+        """ Apply a batch of (key, args, kwargs) events, and return the state each key ended up in (None for the
+        ones which finished).
+        If a machine raises an error, the rest of the events for its shard in this batch aren't applied, and the
+        error is raised here once every shard is done.
+        """
+        batches = [[] for _ in self._conns]
+        n = len(batches)
+        for event in events:
+            batches[hash(event[0]) % n].append(event)
+        return self._to_states(self._request({shard: ('events', batch) for shard, batch in enumerate(batches) if batch}))
+
+    def states(self) -> dict[Hashable, State]:
+        """ The current state of every machine in the fleet which hasn't finished """
+        return self._to_states(self._request({shard: ('states', None) for shard in range(len(self._conns))}))
+
+    def __len__(self):
+        return len(self.states())
+
+    def close(self):
+        """ Stop all the worker processes. The machines in them are lost. """
+        if not self._conns:
+            return
+        try:
+            self._request({shard: ('close', None) for shard in range(len(self._conns))})
+        finally:
+            for conn in self._conns:
+                conn.close()
+            for process in self._processes:
+                process.join()
+            self._conns = []
+            self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
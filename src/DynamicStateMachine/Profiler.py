@@ -0,0 +1,272 @@
+import time
+import weakref
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Awaitable
+from typing import Any, Callable
+from .State import State
+from .Transition import Transition
+
+
+DEFAULT_BOUNDS = tuple(1e-6 * 2 ** i for i in range(24))
+""" The default histogram bucket bounds, in seconds: doubling from 1 microsecond to about 8 seconds """
+
+
+class Histogram:
+    """ A histogram of durations with fixed buckets. counts[i] is the number of values <= bounds[i] (and
+    > bounds[i-1]), and the last count is everything bigger than the last bound.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds:tuple[float, ...]=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.counts = array('Q', bytes(8 * (len(bounds) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def record(self, value:float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return dict(count=self.count, sum=self.sum, bounds=list(self.bounds), counts=list(self.counts))
+
+
+class _Attached:
+    """ Everything the Profiler keeps for one machine class """
+    def __init__(self, plan, bounds):
+        self.plan = plan
+        self.originals = (plan.steps, plan.before, plan.after, plan.on, plan._calls)
+        self.edges:Counter[tuple[State|None, State|None]] = Counter()
+        self.calls:dict[str, Histogram] = {}
+        self.states:list[Histogram] = [Histogram(bounds) for _ in plan.machine_cls.states._states_list]
+        self.entered:dict[int, tuple[Any, float]] = {}
+        """ When each instance entered the state it's in, by id(), with a weakref to it (or itself, if it can't have
+            one), so a new instance which gets the same id() isn't mistaken for it """
+        self.listener:Callable = None
+
+
+class Profiler:
+    """ Measures where the time goes in machines, per class. It records:
+        - how many times each transition (old state -> new state) was taken
+        - how long each transition method and before_/after_/on_ method takes
+        - how long instances spend in each state
+    Durations are recorded in pre-allocated Histograms.
+
+    Nothing is measured until the profiler is attach()ed to a class, and after detach() the class runs exactly as
+    it did before, so it costs nothing when it isn't being used. While it's attached, the compiled calls in the class's
+    DispatchPlan are swapped out for timed versions of them, and compiled versions of the class (see
+    DynamicStateMachine.compile()) go through the plan instead of their generated code.
+    Transition method times include the time of any transition methods they return.
+    Coroutine methods (of an AsyncDynamicStateMachine) are timed until they finish, not just until they're called.
+
+    Time in a state is tracked per instance, and only once an instance has entered a state while attached. Instances
+    which are garbage collected before leaving their state are forgotten. Ones which can't be weakly referenced
+    (subclasses with __slots__ that don't include __weakref__) are kept alive until they leave it, and if more than
+    max_tracked instances are waiting to leave a state, the ones which have waited longest are forgotten.
+    """
+
+    def __init__(self, bounds:tuple[float, ...]=DEFAULT_BOUNDS, clock:Callable[[], float]=time.perf_counter,
+                 max_tracked:int=1_000_000):
+        self.bounds = bounds
+        """ The bucket bounds of the histograms, in seconds """
+        self.clock = clock
+        """ The function used to get the current time, in seconds """
+        self.max_tracked = max_tracked
+        """ The most instances per class the time in their current state is kept track of for """
+        self._classes:dict[type, _Attached] = {}
+
+    def attach(self, machine_cls:type):
+        """ Start profiling all instances of the given machine class """
+        if machine_cls in self._classes:
+            return
+        plan = machine_cls._get_plan()
+        data = self._classes[machine_cls] = _Attached(plan, self.bounds)
+        clock = self.clock
+
+        def timed(call, name):
+            hist = data.calls.setdefault(name, Histogram(self.bounds))
+            def timed_call(machine, args, kwargs):
+                start = clock()
+                try:
+                    rtn = call(machine, args, kwargs)
+                except BaseException:
+                    hist.record(clock() - start)
+                    raise
+                if isinstance(rtn, Awaitable):
+                    return _timed_await(rtn, hist, clock, start)
+                hist.record(clock() - start)
+                return rtn
+            return timed_call
+
+        replacements = {id(call): timed(call, getattr(func, '__name__', repr(func))) for func, call in plan._calls.items()}
+        def swap(calls):
+            return [c if c is None or isinstance(c, State) else replacements.get(id(c), c) for c in calls]
+
+        plan._calls = {func: replacements[id(call)] for func, call in plan._calls.items()}
+        plan.steps, plan.before, plan.after, plan.on = swap(plan.steps), swap(plan.before), swap(plan.after), swap(plan.on)
+        plan.profilers += 1
+
+        edges, states, entered, max_tracked = data.edges, data.states, data.entered, self.max_tracked
+
+        def forget(ref, key):
+            if entered.get(key, (None,))[0] is ref:
+                del entered[key]
+
+        def listener(machine, transition:Transition):
+            now = clock()
+            key = id(machine)
+            ref = None
+            if (entry := entered.pop(key, None)) is not None:
+                ref, started = entry
+                if (ref() if type(ref) is weakref.ref else ref) is not machine:
+                    ref = None
+                elif transition.old is not None:
+                    states[transition.old.id].record(now - started)
+            if transition.new is not None:
+                if ref is None:
+                    try:
+                        ref = weakref.ref(machine, lambda ref, key=key: forget(ref, key))
+                    except TypeError:
+                        ref = machine
+                    if len(entered) >= max_tracked:
+                        del entered[next(iter(entered))]
+                # Re-added, so the order is the order they entered their states in
+                entered[key] = ref, now
+            edges[transition.old, transition.new] += 1
+
+        data.listener = listener
+        machine_cls.add_listener(listener)
+
+    def detach(self, machine_cls:type):
+        """ Stop profiling the given machine class. What's been recorded is kept. """
+        data = self._classes.get(machine_cls)
+        if data is None or data.listener is None:
+            return
+        plan = data.plan
+        steps, before, after, on, calls = data.originals
+        # Keep anything that's been compiled since, it was never timed anyway
+        calls.update({func: call for func, call in plan._calls.items() if func not in calls})
+        plan.steps, plan.before, plan.after, plan.on, plan._calls = steps, before, after, on, calls
+        plan.profilers -= 1
+        machine_cls.remove_listener(data.listener)
+        data.listener = None
+        data.entered.clear()
+
+    def reset(self):
+        """ Forget everything that's been recorded """
+        for data in self._classes.values():
+            data.edges.clear()
+            data.entered.clear()
+            for hist in data.calls.values():
+                hist.__init__(self.bounds)
+            for hist in data.states:
+                hist.__init__(self.bounds)
+
+    def edge_counts(self, machine_cls:type) -> Counter[tuple[State|None, State|None]]:
+        """ How many times each (old, new) transition has been taken. None is the start and end of the machine. """
+        return self._classes[machine_cls].edges
+
+    def call_times(self, machine_cls:type) -> dict[str, Histogram]:
+        """ The durations of each transition method and side effect method, by name """
+        return self._classes[machine_cls].calls
+
+    def state_times(self, machine_cls:type) -> dict[State, Histogram]:
+        """ The time spent in each state, for the states that have been left at least once """
+        return {state: hist for state, hist in zip(machine_cls.states._states_list, self._classes[machine_cls].states) if hist.count}
+
+    def as_dict(self) -> dict[str, Any]:
+        """ Everything that's been recorded, by class name """
+        return {
+            cls.__name__: dict(
+                transitions={f'{_name(old)} -> {_name(new)}': n for (old, new), n in data.edges.items()},
+                calls={name: hist.as_dict() for name, hist in data.calls.items() if hist.count},
+                states={state.name: hist.as_dict() for state, hist in self.state_times(cls).items()},
+            )
+            for cls, data in self._classes.items()
+        }
+
+    def prometheus(self, prefix:str='dynamicstatemachine') -> str:
+        """ Everything that's been recorded, in the Prometheus text exposition format """
+        lines = [
+            f'# TYPE {prefix}_transitions_total counter',
+        ]
+        for cls, data in self._classes.items():
+            for (old, new), n in data.edges.items():
+                lines.append(f'{prefix}_transitions_total{{machine="{cls.__name__}",from="{_name(old)}",to="{_name(new)}"}} {n}')
+
+        for metric, label, getter in (
+            ('call_seconds', 'method', lambda cls, data: data.calls.items()),
+            ('state_seconds', 'state', lambda cls, data: ((s.name, h) for s, h in self.state_times(cls).items())),
+        ):
+            lines.append(f'# TYPE {prefix}_{metric} histogram')
+            for cls, data in self._classes.items():
+                for name, hist in getter(cls, data):
+                    if not hist.count:
+                        continue
+                    labels = f'machine="{cls.__name__}",{label}="{name}"'
+                    cumulative = 0
+                    for bound, count in zip(hist.bounds + (float('inf'),), hist.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{prefix}_{metric}_bucket{{{labels},le="{le}"}} {cumulative}')
+                    lines.append(f'{prefix}_{metric}_sum{{{labels}}} {hist.sum!r}')
+                    lines.append(f'{prefix}_{metric}_count{{{labels}}} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+    def edge_style(self, machine_cls:type) -> Callable[[Any, Any], dict]:
+        """ For DynamicStateMachine.construct_graphvis(heat=...). Returns a function giving the graphviz attrs of each
+        edge in the graph: wider and redder the more it's been taken.
+        Edges out of a transition method are counted as the transitions into their destination from any of the
+        states that use that method.
+        """
+        data = self._classes[machine_cls]
+        out = Counter()
+        into = Counter()
+        transitions = data.plan.transitions
+        for (old, new), n in data.edges.items():
+            if old is None:
+                continue
+            out[old] += n
+            if not isinstance(transition := transitions.get(old), State) and transition is not None:
+                into[getattr(transition, '__name__', None), new] += n
+        top = max(out.values(), default=0) or 1
+
+        def style(tail, head) -> dict:
+            n = out[tail] if isinstance(tail, State) else into[tail, head] if isinstance(head, (State, type(None))) else 0
+            return dict(penwidth=f'{1 + 4 * n / top:.2f}', color=_heat_color(n / top), tooltip=str(n))
+        return style
+
+    def state_styles(self, machine_cls:type) -> dict[State, dict]:
+        """ For DynamicStateMachine.construct_graphvis(heat=...). The graphviz attrs of each state that has been left
+        at least once: filled redder the more time has been spent in it in total.
+        """
+        times = self.state_times(machine_cls)
+        top = max((hist.sum for hist in times.values()), default=0) or 1
+        return {
+            state: dict(style='filled', fillcolor=_heat_color(hist.sum / top),
+                        tooltip=f'{hist.count} visits, {hist.mean * 1e3:.3f} ms on average')
+            for state, hist in times.items()
+        }
+
+
+async def _timed_await(awaitable:Awaitable, hist:Histogram, clock:Callable[[], float], start:float):
+    try:
+        return await awaitable
+    finally:
+        hist.record(clock() - start)
+
+
+def _name(state:State|None) -> str:
+    return 'None' if state is None else state.name
+
+
+def _heat_color(fraction:float) -> str:
+    """ An HSV graphviz color, from blue (0) to red (1) """
+    return f'{(2 / 3) * (1 - fraction):.3f} 0.8 0.9'
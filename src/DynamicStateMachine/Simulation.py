@@ -0,0 +1,167 @@
+import random
+from array import array
+from collections import Counter
+from itertools import accumulate
+from typing import Any, Callable, Mapping, NamedTuple, Sequence
+from .State import State
+
+_OUTSIDE = -1
+""" The id used for the start and end in edges """
+
+
+class SimulationResult(NamedTuple):
+    """ The totals from simulate(). Nothing is kept per run. """
+    machine_cls: type
+    runs: int
+    visits: array
+    """ How many times each state was entered, by State.id (including virtual states, and starting) """
+    edge_from: array
+    """ Together with edge_to and edge_counts, how many times each transition was taken: edge_counts[i] times from
+        the state with id edge_from[i] to the one with id edge_to[i]. -1 is the start (in edge_from) and the end
+        (in edge_to). """
+    edge_to: array
+    edge_counts: array
+    lengths: array
+    """ lengths[n] is how many runs finished after exactly n steps (calls to next()) """
+    unfinished: int
+    """ How many runs hadn't finished after max_steps steps """
+
+    def edges(self) -> dict[tuple[State|None, State|None], int]:
+        """ The edge counts as {(old, new): count}, where None is the start or the end """
+        states = self.machine_cls.states._states_list
+        return {
+            (None if old == _OUTSIDE else states[old], None if new == _OUTSIDE else states[new]): count
+            for old, new, count in zip(self.edge_from, self.edge_to, self.edge_counts)
+        }
+
+    def mean_length(self) -> float:
+        """ The average number of steps the runs which finished took """
+        finished = sum(self.lengths)
+        return sum(n * count for n, count in enumerate(self.lengths)) / finished if finished else 0.0
+
+
+def _drawer(inputs:Callable|Mapping|Sequence|None) -> Callable[[random.Random, State], Any]:
+    """ Turn the inputs given to simulate() into a function which picks the next event """
+    if inputs is None:
+        return lambda rng, state: ()
+    if callable(inputs):
+        return inputs
+    if isinstance(inputs, Mapping):
+        events = list(inputs)
+        cum_weights = list(accumulate(inputs.values()))
+        return lambda rng, state: rng.choices(events, cum_weights=cum_weights)[0]
+    events = list(inputs)
+    return lambda rng, state: rng.choice(events)
+
+
+def _simulate_chunk(machine_cls:type, inputs, runs:int, seed:int, max_steps:int) -> tuple[bytes, Counter, bytes, int]:
+    """ Run part of a simulation, in a worker process. Returns the totals for its runs. """
+    rng = random.Random(seed)
+    draw = _drawer(inputs)
+    plan = machine_cls._get_plan()
+    states = machine_cls.states._states_list
+    # The plan's steps skip over virtual states, but they should be counted here
+    steps = [None] * len(states)
+    for state, transition in plan.transitions.items():
+        steps[state.id] = transition if isinstance(transition, State) else plan.compile(transition)
+
+    visits = array('Q', bytes(8 * len(states)))
+    edges = Counter()
+    lengths = array('Q', bytes(8 * (max_steps + 1)))
+    unfinished = 0
+    initial = machine_cls.initial
+    no_kwargs = {}
+
+    for _ in range(runs):
+        # A new machine for each run, so nothing a transition method keeps on it carries over to the next one.
+        # Side effect free: the state is set directly, without calling any hooks or listeners.
+        machine = machine_cls(start_immediately=False)
+        machine._state = state = initial
+        visits[initial.id] += 1
+        edges[_OUTSIDE, initial.id] += 1
+        n = 0
+        while state is not None and n < max_steps:
+            event = draw(rng, state)
+            args = event if type(event) is tuple else (event,)
+            n += 1
+            hops = 0
+            while True:
+                if (step := steps[state.id]) is None:
+                    raise KeyError(f'{state!r} has no transition')
+                new = machine._resolve(step, args, no_kwargs)[0]
+                edges[state.id, _OUTSIDE if new is None else new.id] += 1
+                machine._state = state = new
+                if new is None:
+                    break
+                visits[new.id] += 1
+                if not new.virtual:
+                    break
+                hops += 1
+                if hops > len(states):
+                    raise RuntimeError(f'{machine_cls.__name__} is going around a loop of virtual states')
+
+        if state is None:
+            lengths[n] += 1
+        else:
+            unfinished += 1
+
+    return visits.tobytes(), edges, lengths.tobytes(), unfinished
+
+
+def simulate(machine_cls:type, inputs:Callable|Mapping|Sequence|None, runs:int, processes:int|None=None,
+             seed:int|None=None, max_steps:int=1000, context:str|None=None) -> SimulationResult:
+    """ Estimate how runs of a machine go, by starting `runs` machines and advancing them with random events until
+    they finish (or have taken max_steps steps), across a pool of processes.
+
+    The walks are side effect free: the state is set like set_state(..., side_effects=False) would, so no before_/
+    after_/on_ methods, on_start()/on_end(), or listeners are called. Only the transition methods are, on a new
+    machine instance for each run (made with start_immediately=False).
+
+    inputs picks the event for each step, which is passed to next() like the events given to run() (a tuple is the
+    parameters, anything else is the only one):
+        - a function, called as inputs(rng, state) with a random.Random and the current state
+        - a mapping of {event: weight}, for weighted random events
+        - a sequence of events, which are picked from uniformly
+        - None, to always call next() without any parameters
+
+    Each process gets its own seed, which are all derived from `seed`, so the same seed with the same number of
+    processes gives the same results. processes defaults to the number of CPUs; with processes=1, it all runs in
+    this process. The machine class and inputs must be picklable to run in other processes (i.e. defined at the top
+    level of a module).
+    """
+    if processes is None:
+        import multiprocessing
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, runs))
+    seeds = random.Random(seed)
+    chunks = [(machine_cls, inputs, runs // processes + (i < runs % processes), seeds.getrandbits(64), max_steps)
+              for i in range(processes)]
+
+    if processes == 1:
+        results = [_simulate_chunk(*chunks[0])]
+    else:
+        import multiprocessing
+        with multiprocessing.get_context(context).Pool(processes) as pool:
+            results = pool.starmap(_simulate_chunk, chunks)
+
+    n = len(machine_cls.states._states_list)
+    visits = array('Q', bytes(8 * n))
+    lengths = array('Q', bytes(8 * (max_steps + 1)))
+    edges = Counter()
+    unfinished = 0
+    for chunk_visits, chunk_edges, chunk_lengths, chunk_unfinished in results:
+        for totals, chunk in ((visits, array('Q', chunk_visits)), (lengths, array('Q', chunk_lengths))):
+            for i, count in enumerate(chunk):
+                if count:
+                    totals[i] += count
+        edges.update(chunk_edges)
+        unfinished += chunk_unfinished
+
+    edges = sorted(edges.items())
+    return SimulationResult(
+        machine_cls, runs, visits,
+        array('i', (old for (old, _), _ in edges)),
+        array('i', (new for (_, new), _ in edges)),
+        array('Q', (count for _, count in edges)),
+        lengths, unfinished,
+    )
@@ -0,0 +1,101 @@
+import importlib
+import mmap
+import struct
+from array import array
+from typing import Any, BinaryIO, Iterable, NamedTuple
+
+
+class Snapshot(NamedTuple):
+    """ Everything needed to recreate a machine: which class it is, the id of the State it's in, and whatever else
+    the caller wants to keep with it.
+    """
+    machine: str
+    """ The import path of the machine's class, as 'module:qualname' """
+    state: int
+    """ The State.id of the machine's current state, or -1 if it's finished """
+    payload: Any = None
+    """ Anything else to store with the machine """
+
+
+FINISHED = -1
+""" The state id used for machines which have finished """
+
+# magic, length of the class path, number of states in the class, number of machines
+_HEADER = struct.Struct('=4sIIQ')
+_MAGIC = b'DSMS'
+
+
+def machine_path(machine_cls:type) -> str:
+    """ The import path of a machine class, as used in snapshots """
+    return f'{machine_cls.__module__}:{machine_cls.__qualname__}'
+
+
+def find_machine(path:str) -> type:
+    """ Import the machine class at the given import path (see machine_path()) """
+    module, _, qualname = path.partition(':')
+    obj = importlib.import_module(module)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def state_id(machine) -> int:
+    """ The id of the current state of the given machine, or -1 if it's finished """
+    return FINISHED if machine._state is None else machine._state.id
+
+
+def dump_states(machines:Iterable, file:BinaryIO, machine_cls:type=None):
+    """ Write the states of many machines of the same class to a binary file, as a header followed by one int32
+    state id per machine (in the native byte order). The file can be read back with load_states() or
+    restore_states().
+    If machine_cls isn't given, it's taken from the first machine.
+    """
+    machines = iter(machines)
+    ids = array('i')
+    if machine_cls is None:
+        try:
+            first = next(machines)
+        except StopIteration:
+            raise ValueError('machine_cls must be given if there are no machines')
+        machine_cls = type(first)
+        ids.append(state_id(first))
+
+    for machine in machines:
+        if type(machine) is not machine_cls:
+            raise TypeError(f'All the machines must be of type {machine_cls.__name__}, got {type(machine).__name__}')
+        ids.append(state_id(machine))
+
+    path = machine_path(machine_cls).encode()
+    header = _HEADER.pack(_MAGIC, len(path), len(machine_cls.states._states_list), len(ids)) + path
+    # Pad the header, so the ids are aligned
+    header += b'\0' * (-len(header) % 8)
+    file.write(header)
+    ids.tofile(file)
+
+
+def load_states(file:BinaryIO, machine_cls:type=None) -> tuple[type, memoryview]:
+    """ Memory map a file written by dump_states(), without deserializing anything per machine.
+    Returns the machine class and a memoryview of the int32 state id of each machine (-1 for finished ones).
+    If machine_cls is given, the file must have been written for that class.
+    """
+    mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, path_len, num_states, count = _HEADER.unpack_from(mm)
+    if magic != _MAGIC:
+        raise ValueError('Not a file written by dump_states()')
+
+    start = _HEADER.size + path_len
+    path = mm[_HEADER.size:start].decode()
+    start += -start % 8
+    cls = find_machine(path) if machine_cls is None else machine_cls
+    if machine_path(cls) != path:
+        raise ValueError(f'The states in the file are for {path}, not {machine_path(cls)}')
+    if len(cls.states._states_list) != num_states:
+        raise ValueError(f'{path} has changed since the file was written: it had {num_states} states, now it has {len(cls.states._states_list)}')
+
+    return cls, memoryview(mm)[start:start + count * 4].cast('i')
+
+
+def restore_states(file:BinaryIO, machine_cls:type=None) -> list:
+    """ Recreate all the machines stored in a file written by dump_states(), without any side effects """
+    cls, ids = load_states(file, machine_cls)
+    return [cls.restore(Snapshot(None, id)) for id in ids]
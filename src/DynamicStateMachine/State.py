@@ -7,7 +7,9 @@ class State:
     to other states via the `>>` operator.
     """
 
-    def __init__(self, name:str, value:Any, virtual=False):
+    __slots__ = ('name', 'value', 'transition', 'virtual', '_simple', 'id', 'owner')
+
+    def __init__(self, name:str, value:Any, virtual=False, id:int=-1, owner:type=None):
         self.name = name
         """ The variable name of the state when it was defined """
         self.value = value
@@ -18,6 +20,11 @@ class State:
         """ A virtual state is one that immediately transitions to the next state without requiring a call to `next()`. """
         self._simple = None
         """ A state is simple if it only transitions to a single state. """
+        self.id = id
+        """ The index of this state in the States subclass it was defined in. Assigned by States, and dense, so it
+            can be used to index lookup tables """
+        self.owner = owner
+        """ The States subclass this state was defined in """
 
     def __rshift__(self, other):
         """ If the right hand side is a State, then it's a simple transition, and self.transition
@@ -29,6 +36,9 @@ class State:
         if isinstance(other, State):
             self._simple = other
             self.transition = lambda *args, **kwargs: other
+            # Simple transitions are handed over as the State itself, so the machine can tell them apart from
+            # transition methods without having to call anything
+            return self, other
         elif callable(other):
             self._simple = False
             self.transition = other
@@ -38,15 +48,21 @@ class State:
         return self, self.transition
 
     def __eq__(self, other):
+        # Every State is unique to the States subclass it was defined in, so identity is all we need
         if isinstance(other, State):
-            return self.value == other.value and self.name == other.name
+            return self is other
         elif isinstance(other, str):
             return self.value == other
         else:
             return False
 
-    def __hash__(self):
-        return hash(self.name)
+    __hash__ = object.__hash__
+
+    def __reduce__(self):
+        # States are unique, so unpickle them as the same State, instead of a copy of it
+        if self.owner is not None:
+            return getattr, (self.owner, self.name)
+        return super().__reduce__()
 
     def __repr__(self):
         return f'<State {self.name}>'
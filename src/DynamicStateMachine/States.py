@@ -1,5 +1,7 @@
+import sys
+from enum import Enum
+from typing import Any, Iterable, Mapping
 from .State import State
-from typing import Any
 
 class States:
     """ An abstract class that must be subclassed to define states. It will automatically create State instances
@@ -8,20 +10,86 @@ class States:
     In the future, instancing States directly will be supported, but it's not yet.
     """
 
-    def __init_subclass__(cls, /, virtual_value=None):
-        cls._states: dict[str: State] = {}
-        """ A dict of all states, with the name as the key and the State instance as the value """
-        cls._reverse_states:dict[Any, State] = {}
-        """ A dict of all states, with the value as the key and the State instance as the value """
-        cls._states_list = []
-        """ A list of all states, in the order they were defined """
+    def __init_subclass__(cls, /, virtual_value=None, _members:list[State]|None=None):
         cls._virtual_value = virtual_value
         """ The value which you set a state to in order to mark it as a virtual state """
 
-        for name, value in cls.__dict__.items():
-            if not name.startswith('_'):
-                state = State(name, value, virtual=value is virtual_value)
-                cls._states[name] = state
-                cls._reverse_states[value] = state
-                cls._states_list.append(state)
-                setattr(cls, name, state)
+        if _members is None:
+            # Collect them first, since replacing the values with States changes cls.__dict__
+            items = [(name, value) for name, value in cls.__dict__.items() if not name.startswith('_')]
+            _members = [State(name, value, virtual=value is virtual_value, id=id, owner=cls)
+                        for id, (name, value) in enumerate(items)]
+            for state in _members:
+                setattr(cls, state.name, state)
+        else:
+            # Made by one of the from_ methods, which already put the States in the class body
+            for state in _members:
+                state.owner = cls
+
+        cls._states_list = _members
+        """ A list of all states, in the order they were defined. Each State's id is its index in this list """
+        cls._states: dict[str: State] = {state.name: state for state in _members}
+        """ A dict of all states, with the name as the key and the State instance as the value """
+        cls._unhashable_states:list[tuple[Any, State]] = []
+        """ The (value, State) of each state whose value can't be used as a dict key, so isn't in _reverse_states """
+        try:
+            cls._reverse_states:dict[Any, State] = {state.value: state for state in _members}
+            """ A dict of all states, with the value as the key and the State instance as the value """
+        except TypeError:
+            cls._reverse_states = {}
+            for state in _members:
+                try:
+                    cls._reverse_states[state.value] = state
+                except TypeError:
+                    cls._unhashable_states.append((state.value, state))
+
+    @classmethod
+    def _from_value(cls, value:Any) -> State:
+        """ The State with the given value. Raises a KeyError if there isn't one. """
+        try:
+            return cls._reverse_states[value]
+        except (KeyError, TypeError):
+            pass
+        for state_value, state in cls._unhashable_states:
+            if state_value == value:
+                return state
+        raise KeyError(value)
+
+    @classmethod
+    def from_iterable(cls, name:str, items:Iterable[str|tuple[str, Any]], virtual_value=None, module:str|None=None) -> type:
+        """ Make a States subclass called `name` from (name, value) pairs, in order. A plain string is a state whose
+        value is its name. Values don't have to be hashable.
+        This is the same as defining them in a class body, but builds everything in one go, so it stays fast for
+        (generated) classes with a lot of states. module is the __module__ of the new class, and defaults to the
+        caller's, so it can be found again by snapshots if it's assigned to a module level variable with that name.
+        """
+        members = []
+        for id, item in enumerate(items):
+            state_name, value = (item, item) if isinstance(item, str) else item
+            if not isinstance(state_name, str) or state_name.startswith('_'):
+                raise ValueError(f'State names must be strings which don\'t start with an underscore. Got {state_name!r}')
+            members.append(State(state_name, value, virtual=value is virtual_value, id=id))
+
+        namespace = {state.name: state for state in members}
+        if len(namespace) != len(members):
+            raise ValueError('State names must be unique')
+        if module is None:
+            module = sys._getframe(1).f_globals.get('__name__', '__main__')
+        namespace['__module__'] = module
+        return type(name, (cls,), namespace, virtual_value=virtual_value, _members=members)
+
+    @classmethod
+    def from_mapping(cls, name:str, mapping:Mapping[str, Any], virtual_value=None, module:str|None=None) -> type:
+        """ Make a States subclass called `name` from a {state name: value} mapping. See from_iterable(). """
+        if module is None:
+            module = sys._getframe(1).f_globals.get('__name__', '__main__')
+        return cls.from_iterable(name, mapping.items(), virtual_value, module)
+
+    @classmethod
+    def from_enum(cls, enum:type[Enum], name:str|None=None, virtual_value=None, module:str|None=None) -> type:
+        """ Make a States subclass from the members of an Enum, with the same names and values. It's called the same
+        as the Enum unless a name is given. See from_iterable().
+        """
+        if module is None:
+            module = sys._getframe(1).f_globals.get('__name__', '__main__')
+        return cls.from_iterable(name or enum.__name__, ((member.name, member.value) for member in enum), virtual_value, module)
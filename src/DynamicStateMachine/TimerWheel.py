@@ -0,0 +1,221 @@
+import math
+import sys
+import threading
+import time
+from typing import Callable
+from .Transition import Transition
+
+TIMEOUT_COMMENT = 'timed out'
+""" The comment the transitions made by a TimerWheel have, for listeners """
+
+# The fields of a timer. Timers are lists, so they can be moved between buckets without making a new one.
+_TICK, _MACHINE, _STATE, _TARGET, _LEVEL, _BUCKET = range(6)
+
+
+class TimerWheel:
+    """ Drives the timeouts of machine classes (see DynamicStateMachine.timeouts) for any number of machines, with a
+    hierarchical timing wheel.
+
+    attach() a machine class, and every time one of its instances goes into a state with a timeout, a timer is
+    started for it, replacing the one it had before (if any). Whenever advance() is called, every timer which is due
+    fires, in one batch, and moves its machine to the timeout's target with set_state(), with the comment
+    TIMEOUT_COMMENT. Call advance() regularly, from a thread, an event loop, or a simulation, to drive it.
+
+    Time is counted in ticks of `resolution` seconds, from when the wheel is made, by `clock`. Timers fire on the
+    first tick at or after their deadline. There are `levels` wheels of `slots` buckets each: the first has a bucket
+    per tick, the second a bucket per `slots` ticks, and so on, and timers are moved down to the lower wheels as their
+    deadlines get close. Starting or cancelling a timer is O(1), and advancing costs the number of timers which fire
+    or move, plus the number of ticks which pass where something happens. Timers further away than the wheels reach
+    (slots ** levels ticks) wait in an overflow bucket, which is checked each time the top wheel goes around.
+
+    The wheel keeps a reference to each machine with a timer running.
+    """
+
+    def __init__(self, resolution:float=.01, slots:int=256, levels:int=4, clock:Callable[[], float]=time.monotonic):
+        if slots < 2 or slots & (slots - 1):
+            raise ValueError(f'slots must be a power of 2. Got {slots!r}')
+        if levels < 1:
+            raise ValueError(f'levels must be at least 1. Got {levels!r}')
+        self.resolution = resolution
+        """ How long a tick is, in seconds """
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+        self._start = clock()
+        self._tick = 0
+        """ The last tick that's been processed """
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._wheels:list[list[dict[int, list]]] = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._overflow:dict[int, list] = {}
+        """ The timers too far away to be in any wheel yet """
+        self._overflow_min = math.inf
+        """ No timer in the overflow is earlier than this tick (but it isn't updated when they're cancelled) """
+        self._counts:list[int] = [0] * (levels + 1)
+        """ How many timers are in each wheel, and then in the overflow """
+        self._timers:dict[int, list] = {}
+        """ The timer of each machine, by id() """
+        self._classes:set[type] = set()
+        self._lock = threading.Lock()
+
+    def attach(self, machine_cls:type):
+        """ Start running the timeouts of the given class's instances, from their next state change on. Use add() for
+        machines which are already in a state with a timeout.
+        """
+        # If it hasn't been imported, nothing can be a subclass of it
+        async_module = sys.modules.get(f'{__package__}.AsyncDynamicStateMachine')
+        if async_module is not None and issubclass(machine_cls, async_module.AsyncDynamicStateMachine):
+            raise TypeError('TimerWheel can\'t drive an AsyncDynamicStateMachine, since set_state() has to be awaited')
+        if machine_cls not in self._classes:
+            self._classes.add(machine_cls)
+            machine_cls.add_listener(self._on_transition)
+
+    def detach(self, machine_cls:type):
+        """ Stop starting timers for the given class. Timers which are already running still fire. """
+        if machine_cls in self._classes:
+            self._classes.discard(machine_cls)
+            machine_cls.remove_listener(self._on_transition)
+
+    def _on_transition(self, machine, transition:Transition):
+        self.add(machine)
+
+    def add(self, machine):
+        """ (Re)start the timer for the state the machine is in now, replacing the one it had. If the state doesn't
+        have a timeout (or the machine has finished), this just cancels its timer.
+        """
+        state = machine._state
+        timeout = machine._plan.timeouts[state.id] if state is not None else None
+        with self._lock:
+            self._cancel(id(machine))
+            if timeout is not None:
+                seconds, target = timeout
+                tick = max(math.ceil((self.clock() + seconds - self._start) / self.resolution), self._tick + 1)
+                timer = [tick, machine, state, target, 0, None]
+                self._timers[id(machine)] = timer
+                self._place(id(machine), timer)
+
+    def cancel(self, machine) -> bool:
+        """ Stop the machine's timer. Returns whether it had one. """
+        with self._lock:
+            return self._cancel(id(machine))
+
+    def _cancel(self, key:int) -> bool:
+        if (timer := self._timers.pop(key, None)) is None:
+            return False
+        del timer[_BUCKET][key]
+        self._counts[timer[_LEVEL]] -= 1
+        return True
+
+    def _place(self, key:int, timer:list):
+        """ Put a timer in the bucket for its tick, on the lowest wheel that reaches that far """
+        tick = timer[_TICK]
+        delta = tick - self._tick
+        level = 0
+        bits = self._bits
+        while level < self.levels and delta >> (bits * (level + 1)):
+            level += 1
+        timer[_LEVEL] = level
+        if level == self.levels:
+            timer[_BUCKET] = bucket = self._overflow
+            self._overflow_min = min(self._overflow_min, tick)
+        else:
+            timer[_BUCKET] = bucket = self._wheels[level][(tick >> (bits * level)) & self._mask]
+        bucket[key] = timer
+        self._counts[level] += 1
+
+    def _take(self, level:int, slot:int) -> dict[int, list]:
+        """ Empty a bucket, and return what was in it """
+        wheel = self._wheels[level]
+        bucket = wheel[slot]
+        if bucket:
+            wheel[slot] = {}
+            self._counts[level] -= len(bucket)
+        return bucket
+
+    def _process(self, tick:int, due:list[list]):
+        """ Move the timers which are now close enough down a wheel, and add the ones due on this tick to due """
+        bits = self._bits
+        if self._overflow and not tick & ((1 << (bits * self.levels)) - 1):
+            overflow = self._overflow
+            self._overflow = {}
+            self._overflow_min = math.inf
+            self._counts[self.levels] -= len(overflow)
+            for key, timer in overflow.items():
+                self._place(key, timer)
+        # From the top, since timers can go down more than one wheel at once
+        for level in range(self.levels - 1, 0, -1):
+            if not tick & ((1 << (bits * level)) - 1):
+                for key, timer in self._take(level, (tick >> (bits * level)) & self._mask).items():
+                    self._place(key, timer)
+        for key in (bucket := self._take(0, tick & self._mask)):
+            del self._timers[key]
+        due += bucket.values()
+
+    def advance(self) -> int:
+        """ Fire every timer which is due by the clock's current time. Returns how many fired. The timers the state
+        changes start count from the same time. If a machine raises an error when its timer fires, the rest still
+        fire, and then the first error is raised.
+        """
+        target = math.floor((self.clock() - self._start) / self.resolution)
+        due:list[list] = []
+        bits = self._bits
+        with self._lock:
+            while self._tick < target:
+                # Skip straight to the next tick where something could happen: the next time the first wheel that
+                # has any timers moves them down, or for the overflow, the time the top wheel goes around before its
+                # earliest timer
+                empty = 0
+                while empty <= self.levels and not self._counts[empty]:
+                    empty += 1
+                if empty:
+                    if empty > self.levels:
+                        self._tick = target
+                        break
+                    next_tick = ((self._tick >> (bits * empty)) + 1) << (bits * empty)
+                    if empty == self.levels:
+                        next_tick = max(next_tick, self._overflow_min >> (bits * empty) << (bits * empty))
+                    if next_tick > target:
+                        self._tick = target
+                        break
+                    self._tick = next_tick - 1
+                self._tick += 1
+                self._process(self._tick, due)
+
+        # Outside of the lock, since the state changes start new timers
+        error = None
+        for _, machine, state, target_state, _, _ in due:
+            try:
+                # Just in case it changed state without its listener being called
+                if machine._state is state:
+                    machine.set_state((target_state, TIMEOUT_COMMENT))
+                    if (new := machine._state) is not None and new.virtual:
+                        machine.next()
+            except Exception as err:
+                error = error or err
+        if error is not None:
+            raise error
+        return len(due)
+
+    def deadline(self, machine) -> float|None:
+        """ When the machine's timer will fire (by the clock), or None if it doesn't have one """
+        if (timer := self._timers.get(id(machine))) is None:
+            return None
+        return self._start + timer[_TICK] * self.resolution
+
+    def __len__(self) -> int:
+        """ How many timers are running """
+        return len(self._timers)
+
+    def close(self):
+        """ Detach from every class, and cancel every timer """
+        for machine_cls in list(self._classes):
+            self.detach(machine_cls)
+        with self._lock:
+            for key in list(self._timers):
+                self._cancel(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,12 @@
+from typing import NamedTuple
+from .State import State
+
+
+class Transition(NamedTuple):
+    """ A record of a machine moving from one state to another """
+    old: State|None
+    """ The state the machine was in """
+    new: State|None
+    """ The state the machine ended up in (None if it finished) """
+    comment: str|None = None
+    """ The comment the transition method returned along with the state, if there was one """
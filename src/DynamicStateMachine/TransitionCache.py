@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from collections.abc import Awaitable
+from typing import Any, Callable, NamedTuple
+
+_CO_COROUTINE = 0x80
+""" inspect.CO_COROUTINE """
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int|None
+    currsize: int
+
+
+class TransitionCache:
+    """ A bounded LRU cache of where a pure transition method leads. See pure().
+
+    Entries are keyed by the machine's DispatchPlan (so a subclass which overrides the transition methods it returns
+    gets its own entries), the state being left, and the parameters the method actually accepts (after the same
+    filtering its call gets). They hold the State it resolved to, after following any transition methods it returned,
+    along with the comment it was returned with. Calls with unhashable parameters aren't cached.
+    One cache, with one maxsize, is shared by every class (and state) the method is used in.
+    """
+
+    def __init__(self, maxsize:int|None=128):
+        """ maxsize is the most entries kept, dropping the least recently used ones first. None is unbounded. """
+        self.maxsize = maxsize
+        self._entries:OrderedDict[tuple, tuple] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def wrap(self, call:Callable[[Any, tuple, dict], Any], nargs:int|None, kwnames:set[str]|None) -> Callable[[Any, tuple, dict], Any]:
+        """ Wrap a compiled call of the method (see DispatchPlan.compile()), which accepts nargs positional arguments
+        and the keywords in kwnames (None meaning any), so it returns the cached destination when there is one.
+        """
+        entries = self._entries
+
+        def cached(machine, args, kwargs):
+            key_args = args if nargs is None else args[:nargs]
+            key_kwargs = kwargs if not kwargs or kwnames is None else {k: v for k, v in kwargs.items() if k in kwnames}
+            try:
+                key = (machine._plan, machine._state, key_args, frozenset(key_kwargs.items()) if key_kwargs else None)
+                entry = entries.get(key)
+            except TypeError:
+                # Unhashable parameters
+                return call(machine, args, kwargs)
+
+            if entry is not None:
+                entries.move_to_end(key)
+                self.hits += 1
+                state, comment = entry
+                return state if comment is None else (state, comment)
+            self.misses += 1
+            result = machine._resolve(call, args, kwargs)
+            if isinstance(result, Awaitable):
+                # An AsyncDynamicStateMachine's resolution has to be awaited first. It's awaited like any other
+                # coroutine a transition method returns.
+                return self._store_later(key, result)
+            return self._store(key, result)
+
+        cached.__name__ = call.__name__
+        return cached
+
+    def _store(self, key:tuple, result:tuple) -> Any:
+        """ Cache where a call resolved to, and return it the way the transition method would have """
+        entries = self._entries
+        state, comment = entries[key] = result
+        if self.maxsize is not None and len(entries) > self.maxsize:
+            entries.popitem(last=False)
+        return state if comment is None else (state, comment)
+
+    async def _store_later(self, key:tuple, result:Awaitable) -> Any:
+        return self._store(key, await result)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def cache_clear(self):
+        """ Forget every entry, and reset the stats """
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def invalidate(self, state):
+        """ Forget the entries for leaving the given State """
+        for key in [key for key in self._entries if key[1] is state]:
+            del self._entries[key]
+
+
+def pure(func:Callable|None=None, *, maxsize:int|None=128):
+    """ Declare a transition method pure: where it leads only depends on the current state and the parameters it
+    accepts. The State it resolves to is then cached (see TransitionCache), and on a cache hit neither it nor any of
+    the transition methods it returns are called.
+    It works on an AsyncDynamicStateMachine too, as long as the method itself isn't a coroutine (the methods it
+    returns can be).
+    Can be used as @pure or @pure(maxsize=...). The method gets cache_info(), cache_clear() and invalidate(state),
+    like functools.lru_cache.
+
+        @pure
+        def route(self, msg_type):
+            return States.ack if msg_type == 'ACK' else States.error
+    """
+    def decorator(func):
+        # Checking the code's flags directly, so inspect doesn't have to be imported
+        if getattr(func, '__code__', None) is not None and func.__code__.co_flags & _CO_COROUTINE:
+            raise TypeError(f'{func.__name__}() is async, so it can\'t be pure')
+        func.transition_cache = cache = TransitionCache(maxsize)
+        func.cache_info = cache.cache_info
+        func.cache_clear = cache.cache_clear
+        func.invalidate = cache.invalidate
+        return func
+
+    if func is None:
+        return decorator
+    return decorator(func)
@@ -1,3 +1,54 @@
 from .DynamicStateMachine import DynamicStateMachine
 from .State import State
 from .States import States
+from .Snapshot import Snapshot, dump_states, load_states, restore_states
+from .Transition import Transition
+from .TransitionCache import TransitionCache, pure
+from .GraphIndex import GraphIndex
+
+# Everything else is only imported the first time it's used, so importing the package stays fast for the processes
+# (workers, CLI tools, etc.) which only need the machines themselves. Most of these modules have the same name as the
+# class they define, and importing a module sets it as an attribute of the package, so __getattr__() sets every name
+# from the module after importing it. (Importing one of them directly, like `import DynamicStateMachine.Profiler`,
+# still leaves the module there, like it would in any package.)
+_LAZY = {
+    'MachineBatch': 'MachineBatch',
+    'AsyncDynamicStateMachine': 'AsyncDynamicStateMachine',
+    'MachineFleet': 'MachineFleet',
+    'AnalysisCache': 'AnalysisCache',
+    'analysis_cache': 'AnalysisCache',
+    'GraphView': 'GraphView',
+    'Profiler': 'Profiler',
+    'Histogram': 'Profiler',
+    'EventBus': 'EventBus',
+    'Event': 'EventBus',
+    'Journal': 'Journal',
+    'JournalRecord': 'Journal',
+    'read_journal': 'Journal',
+    'replay_journal': 'Journal',
+    'restore_journal': 'Journal',
+    'SimulationResult': 'Simulation',
+    'simulate': 'Simulation',
+    'write_dot': 'Export',
+    'write_json': 'Export',
+    'TimerWheel': 'TimerWheel',
+}
+
+__all__ = ['DynamicStateMachine', 'State', 'States', 'Snapshot', 'dump_states', 'load_states', 'restore_states',
+           'Transition', 'TransitionCache', 'pure', 'GraphIndex', *_LAZY]
+
+
+def __getattr__(name:str):
+    if (module_name := _LAZY.get(name)) is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    from importlib import import_module
+    module = import_module(f'.{module_name}', __name__)
+    names = globals()
+    for other, other_module in _LAZY.items():
+        if other_module == module_name:
+            names[other] = getattr(module, other)
+    return names[name]
+
+
+def __dir__() -> list[str]:
+    return sorted({*globals(), *_LAZY})
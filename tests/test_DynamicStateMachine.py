@@ -1,3 +1,4 @@
+import pytest
 from src.DynamicStateMachine.DynamicStateMachine import DynamicStateMachine
 from src.DynamicStateMachine.States import States
 
@@ -70,9 +71,10 @@ class ExampleMachine(DynamicStateMachine):
     )
 
 
-def test_example_machine():
+@pytest.mark.parametrize('machine_cls', [ExampleMachine, ExampleMachine.compile()], ids=['plan', 'compiled'])
+def test_example_machine(machine_cls):
     # Initial state is a
-    m = ExampleMachine()
+    m = machine_cls()
     # Starting...
     m.next()      # a -> b
     m.next(False) # b -> c
@@ -116,3 +118,1250 @@ decide if done
 done
 finished
 """, m.log
+
+
+def test_dispatch_plan_is_built_once(monkeypatch):
+    import inspect
+
+    m = ExampleMachine()
+    assert ExampleMachine()._plan is m._plan is ExampleMachine._plan
+
+    # Stepping the machine shouldn't need to inspect anything anymore
+    def fail(*args, **kwargs):
+        raise AssertionError('inspect.signature() called while stepping')
+    monkeypatch.setattr(inspect, 'signature', fail)
+    m.next()
+    m.next(False)
+    m.next(done=False)
+    m.next()
+    m.next(decider=True)
+    assert m.state == ExampleStates.a
+
+
+def test_compiled_calls_are_bounded():
+    class LambdaMachine(DynamicStateMachine):
+        def pick(self):
+            # A new function every step
+            return lambda: ExampleStates.a
+
+        states = ExampleStates
+        initial = ExampleStates.a
+        transitions = (
+            ExampleStates.a >> pick,
+        )
+
+    m = LambdaMachine()
+    plan = LambdaMachine._plan
+    for _ in range(10_000):
+        m.next()
+    assert m.state is ExampleStates.a
+    # Only the class's own functions are kept for good
+    assert list(plan._calls) == [LambdaMachine.pick]
+    assert len(plan._other_calls) <= 256
+
+
+def test_hook_parameters():
+    class ParamMachine(DynamicStateMachine):
+        seen = ()
+
+        def before_b(self, x, *, flag=None):
+            self.seen += ((x, flag),)
+
+        states = ExampleStates
+        initial = ExampleStates.a
+        transitions = (
+            ExampleStates.a >> ExampleStates.b,
+            ExampleStates.b >> ExampleStates.a,
+        )
+
+    m = ParamMachine()
+    m.next(1, 2, flag=3, unused=4)
+    assert m.seen == ((1, 3),)
+
+
+class ChainMachine(DynamicStateMachine):
+    def first(self, n):
+        return self.second, 'go to second'
+
+    def second(self, n):
+        if n < 0:
+            # A genuine bug in a transition method
+            return len(n)
+        return ExampleStates.a if n else None
+
+    states = ExampleStates
+    initial = ExampleStates.b
+    transitions = (
+        ExampleStates.a >> ExampleStates.b,
+        ExampleStates.b >> first,
+    )
+
+
+def test_transition_chain():
+    m = ChainMachine()
+    assert m.next(1) == ExampleStates.a
+    assert m._resolve(m._plan.steps[ExampleStates.b.id], (1,), {}) == (ExampleStates.a, 'go to second')
+    m.next()
+    assert m.next(0) is None
+    assert m.finished
+
+
+def test_transition_errors_propagate():
+    import pytest
+
+    m = ChainMachine()
+    with pytest.raises(TypeError, match='len'):
+        m.next(-1)
+    assert m.state == ExampleStates.b
+
+
+def test_state_ids_and_identity():
+    import pytest
+
+    class OtherStates(States):
+        a = 'this is a'
+        b = 'this is b'
+
+    assert [s.id for s in ExampleStates._states_list] == list(range(len(ExampleStates._states_list)))
+    assert ExampleStates.a.owner is ExampleStates
+    # Same name and value, but from a different States class
+    assert OtherStates.a != ExampleStates.a
+    assert len({OtherStates.a, ExampleStates.a}) == 2
+    assert ExampleStates.a == 'this is a'
+    assert not hasattr(ExampleStates.a, '__dict__')
+
+    m = ExampleMachine()
+    with pytest.raises(ValueError):
+        m.state = OtherStates.b
+
+
+class LoopStates(States):
+    idle = 'idle'
+    hop1 = None
+    hop2 = None
+    busy = 'busy'
+    check = 'check'
+
+
+class LoopMachine(DynamicStateMachine):
+    def after_busy(self):
+        self.busy_count = getattr(self, 'busy_count', 0) + 1
+
+    def decide(self, go=True):
+        return LoopStates.idle if go else None
+
+    states = LoopStates
+    initial = LoopStates.idle
+    transitions = (
+        LoopStates.idle >> LoopStates.hop1,
+        LoopStates.hop1 >> LoopStates.hop2,
+        LoopStates.hop2 >> LoopStates.busy,
+        LoopStates.busy >> LoopStates.check,
+        LoopStates.check >> decide,
+    )
+
+
+def test_machine_batch():
+    import pytest
+    pytest.importorskip('numpy')
+    from src.DynamicStateMachine.MachineBatch import MachineBatch
+
+    batch = MachineBatch(LoopMachine, 5)
+    single = LoopMachine()
+    for go in (True, True, True, True, True, False):
+        batch.next(go)
+        single.next(go)
+        assert batch.states() == [single.state] * 5
+
+    # Jumped straight through the virtual states
+    assert batch._table[LoopStates.idle.id + 1] == LoopStates.busy.id
+    assert batch.finished.all()
+    # The hooks still ran on real instances
+    assert batch.machine(0).busy_count == single.busy_count == 2
+
+    # Listeners hear about every transition, even the ones which would be done in bulk
+    seen = []
+    listener = lambda machine, transition: seen.append((machine, transition))
+    LoopMachine.add_listener(listener)
+    try:
+        batch = MachineBatch(LoopMachine, 3)
+        assert len(seen) == 3
+        batch.next()
+        assert len(seen) == 6 and {seen[-1][1].new, seen[-2][1].new} == {LoopStates.busy}
+        assert {id(machine) for machine, _ in seen} == {id(batch.machine(row)) for row in range(3)}
+    finally:
+        LoopMachine.remove_listener(listener)
+
+
+class SlimMachine(DynamicStateMachine):
+    __slots__ = ('busy_count',)
+
+    def after_busy(self):
+        self.busy_count = getattr(self, 'busy_count', 0) + 1
+
+    decide = LoopMachine.decide
+
+    states = LoopStates
+    initial = LoopStates.idle
+    transitions = LoopMachine.transitions
+
+
+def _bytes_per_instance(cls, n=10_000):
+    import tracemalloc
+
+    cls()  # Build the plan before measuring
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    machines = [cls() for _ in range(n)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Don't count the list holding them
+    return (after - before) / n - 8
+
+
+def test_slotted_machine_memory():
+    m = SlimMachine()
+    assert not hasattr(m, '__dict__')
+    m.next(); m.next(); m.next()
+    assert m.busy_count == 1 and m.state == LoopStates.idle
+
+    # On CPython 3.11 they're about 56 and 88 bytes: the slots (_state, _trigger_initial_side_effects, and busy_count)
+    # are kept in the object itself, instead of in a __dict__
+    slim = _bytes_per_instance(SlimMachine)
+    regular = _bytes_per_instance(LoopMachine)
+    assert slim < 72 and regular - slim >= 24, (slim, regular)
+
+
+def test_deferred_start():
+    # The constructor's flag still counts when the machine is started later
+    m = ExampleMachine(start_immediately=False, trigger_initial_side_effects=False)
+    m.start()
+    assert m.state is ExampleStates.a and m.log == 'starting\n'
+    m = ExampleMachine(start_immediately=False)
+    m.start()
+    assert m.log == 'starting\nbefore a\n'
+    # ...unless start() is told otherwise
+    m = ExampleMachine(start_immediately=False, trigger_initial_side_effects=False)
+    m.start(True)
+    assert m.log == 'starting\nbefore a\n'
+    slim = SlimMachine(start_immediately=False, trigger_initial_side_effects=False)
+    slim.start()
+    assert slim.state is LoopStates.idle
+
+
+def test_snapshot_restore(tmp_path):
+    import pickle
+    from src.DynamicStateMachine.Snapshot import dump_states, load_states, restore_states
+
+    m = ExampleMachine()
+    m.next()
+    snap = m.snapshot({'user': 1})
+    assert snap.state == ExampleStates.b.id
+    restored = DynamicStateMachine.restore(pickle.loads(pickle.dumps(snap)))
+    assert type(restored) is ExampleMachine and restored.state is ExampleStates.b
+    # No side effects happened when restoring
+    assert restored.log == ''
+
+    # States survive pickling as themselves
+    assert pickle.loads(pickle.dumps(ExampleStates.pre_c)) is ExampleStates.pre_c
+
+    finished = ExampleMachine()
+    finished.state = None
+    machines = [m, ExampleMachine(), finished]
+    with open(tmp_path / 'states', 'wb') as f:
+        dump_states(machines, f)
+    with open(tmp_path / 'states', 'rb') as f:
+        cls, ids = load_states(f)
+        assert cls is ExampleMachine
+        assert ids.tolist() == [ExampleStates.b.id, ExampleStates.a.id, -1]
+        assert [r.state for r in restore_states(f, ExampleMachine)] == [ExampleStates.b, ExampleStates.a, None]
+
+
+def test_async_machine():
+    import asyncio
+    import time
+    from src.DynamicStateMachine.AsyncDynamicStateMachine import AsyncDynamicStateMachine
+
+    class AsyncMachine(AsyncDynamicStateMachine):
+        log = ''
+
+        async def on_start(self):
+            self.log += 'starting\n'
+
+        async def before_b(self, delay=0):
+            await asyncio.sleep(delay)
+            self.log += 'before b\n'
+
+        def after_b(self):
+            self.log += 'after b\n'
+
+        async def lookup(self, delay=0, done=False):
+            await asyncio.sleep(delay)
+            return self.decide
+
+        async def decide(self, delay=0, done=False):
+            if done or self.log.count('after b') >= 2:
+                return None, 'done'
+            return ExampleStates.pre_c
+
+        async def on_end(self):
+            self.log += 'finished\n'
+
+        states = ExampleStates
+        initial = ExampleStates.a
+        transitions = (
+            ExampleStates.a >> ExampleStates.b,
+            ExampleStates.b >> lookup,
+            ExampleStates.pre_c >> ExampleStates.a,
+        )
+
+    async def run(m, delay):
+        await m.start()
+        await m.next(delay)
+        await m.next(delay)
+        assert m.state == ExampleStates.a
+        await m.next(delay)
+        await m.next(delay, done=True)
+        return m
+
+    async def main():
+        machines = [AsyncMachine() for _ in range(100)]
+        start = time.perf_counter()
+        await asyncio.gather(*(run(m, .05) for m in machines))
+        # They all waited at the same time, instead of one after the other
+        assert time.perf_counter() - start < 1
+        assert all(m.finished for m in machines)
+        assert machines[0].log == 'starting\nbefore b\nafter b\nbefore b\nfinished\n'
+
+        m = AsyncMachine()
+        await m.start()
+        assert [s async for s in m] == [ExampleStates.b, ExampleStates.a] * 2 + [ExampleStates.b, None]
+
+        m = AsyncMachine()
+        await m.start()
+        assert [t async for t in m.run([(), (), (), (0, True), ()])] == [
+            (ExampleStates.a, ExampleStates.b, None),
+            (ExampleStates.b, ExampleStates.a, None),
+            (ExampleStates.a, ExampleStates.b, None),
+            (ExampleStates.b, None, 'done'),
+        ]
+
+        m = AsyncMachine()
+        await m.start()
+        await m.next()
+        # Through the coroutines and the virtual pre_c, without calling before_b again
+        assert await m.peek() is ExampleStates.a
+        assert await m.peek(0, True) is None
+        assert m.state is ExampleStates.b and m.log.count('before b') == 1
+        assert await m.fork().next() is ExampleStates.a and m.state is ExampleStates.b
+
+    asyncio.run(main())
+
+
+def test_run():
+    m = ExampleMachine()
+    events = iter([(), False, (False,), (), (True,), (), (), ()])
+    transitions = list(m.run(events))
+    assert transitions == [
+        (ExampleStates.a, ExampleStates.b, None),
+        (ExampleStates.b, ExampleStates.c, None),
+        (ExampleStates.c, ExampleStates.a, 'no keep going!'),
+        (ExampleStates.a, ExampleStates.b, None),
+        (ExampleStates.b, ExampleStates.a, 'if decider is True'),
+        (ExampleStates.a, ExampleStates.b, None),
+    ] + [(ExampleStates.b, ExampleStates.a, 'if decider is True'), (ExampleStates.a, ExampleStates.b, None)]
+    assert next(events, 'empty') == 'empty'
+
+    # Stops as soon as the machine finishes
+    m = ExampleMachine()
+    events = iter([(), (False,), (True,), (), ()])
+    assert [t.new for t in m.run(events)] == [ExampleStates.b, ExampleStates.c, None]
+    assert len(list(events)) == 2
+    assert list(m.run()) == []
+
+
+def test_machine_fleet():
+    from src.DynamicStateMachine.MachineFleet import MachineFleet
+
+    with MachineFleet(LoopMachine, processes=2) as fleet:
+        events = [(key, (), {}) for key in range(10)] * 2
+        assert fleet.submit(events) == {key: LoopStates.check for key in range(10)}
+        # Finish the even ones
+        assert fleet.submit([(key, (key % 2,), {}) for key in range(10)]) == {
+            key: LoopStates.idle if key % 2 else None for key in range(10)
+        }
+        assert fleet.states() == {key: LoopStates.idle for key in range(1, 10, 2)}
+        assert len(fleet) == 5
+
+
+def test_virtual_jumps():
+    import pytest
+
+    # hop1 and hop2 don't have hooks, so idle goes straight to busy
+    assert LoopMachine._plan.steps[LoopStates.idle.id] is LoopStates.busy
+
+    class HookedLoopMachine(LoopMachine):
+        log = ''
+
+        def before_hop1(self):
+            self.log += 'before hop1\n'
+
+        def after_hop1(self):
+            self.log += 'after hop1\n'
+
+        def before_busy(self):
+            self.log += 'before busy\n'
+
+    assert HookedLoopMachine._plan.steps[LoopStates.idle.id] is LoopStates.hop1
+    # hop2 still gets skipped
+    assert HookedLoopMachine._plan.steps[LoopStates.hop1.id] is LoopStates.busy
+    m = HookedLoopMachine()
+    assert m.next() is LoopStates.busy
+    assert m.log == 'before hop1\nafter hop1\nbefore busy\n'
+
+    with pytest.raises(ValueError, match='hop1 >> hop2 >> hop1'):
+        class CycleMachine(DynamicStateMachine):
+            states = LoopStates
+            initial = LoopStates.idle
+            transitions = (
+                LoopStates.idle >> LoopStates.hop1,
+                LoopStates.hop1 >> LoopStates.hop2,
+                LoopStates.hop2 >> LoopStates.hop1,
+            )
+
+
+def test_analysis_cache(tmp_path):
+    from src.DynamicStateMachine.AnalysisCache import AnalysisCache
+    from src.DynamicStateMachine.Graphing import _get_returns_dis
+
+    cache = AnalysisCache(tmp_path)
+    analyse = _get_returns_dis
+    expected = analyse(ExampleMachine.do_the_thing)
+    assert cache.get(ExampleMachine.do_the_thing, 'dis', analyse) == expected
+    assert cache.get(ExampleMachine().do_the_thing, 'dis', analyse) == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A new worker with the same directory doesn't have to analyse it again
+    fresh = AnalysisCache(tmp_path)
+    def fail(func):
+        raise AssertionError('analysed again')
+    assert fresh.get(ExampleMachine.do_the_thing, 'dis', fail) == expected
+    assert fresh.hits == 1
+
+    # Files in the directory are only ever read as plain data
+    import marshal
+    [path] = tmp_path.glob('*.marshal')
+    path.write_bytes(marshal.dumps([(compile('1', '', 'eval'), '')]))
+    assert AnalysisCache(tmp_path).get(ExampleMachine.do_the_thing, 'dis', analyse) == expected
+    path.write_bytes(b'not marshal')
+    assert AnalysisCache(tmp_path).get(ExampleMachine.do_the_thing, 'dis', analyse) == expected
+
+    assert DynamicStateMachine.get_returns_dis(ExampleMachine.decide_if_done) == [
+        (None, 'Im done talking to you now.'), ('a', 'no keep going!')
+    ]
+
+
+def test_listeners_and_graph_view():
+    from src.DynamicStateMachine.GraphView import GraphView
+    from src.DynamicStateMachine.Transition import Transition
+
+    seen = []
+    listener = lambda machine, transition: seen.append(transition)
+    ExampleMachine.add_listener(listener)
+    try:
+        m = ExampleMachine()
+        m.next()
+        m.next(True)
+        m.next(False)
+    finally:
+        ExampleMachine.remove_listener(listener)
+    m.next()
+    assert seen == [
+        Transition(None, ExampleStates.a),
+        Transition(ExampleStates.a, ExampleStates.b),
+        Transition(ExampleStates.b, ExampleStates.a, 'if decider is True'),
+        Transition(ExampleStates.a, ExampleStates.b),
+    ]
+
+    # The base graph is only built once per set of options
+    graphs = ExampleMachine._plan.graphs
+    base = m.construct_graphvis(highlighted=None)
+    assert m.construct_graphvis(highlighted=None).source == base.source
+    assert len(graphs) == 1
+
+    other = ExampleMachine()
+    with GraphView(m, history=2) as view:
+        updates = []
+        view.subscribe(updates.append)
+        m.next()
+        m.next(False)
+        other.next()
+        m.next(True)
+        assert updates == [
+            Transition(ExampleStates.a, ExampleStates.b),
+            Transition(ExampleStates.b, ExampleStates.pre_c),
+            Transition(ExampleStates.pre_c, ExampleStates.c),
+            Transition(ExampleStates.c, None, 'Im done talking to you now.'),
+        ]
+        source = view.graph().source
+        assert source.startswith(base.source[:-2])
+        assert '\tpre_c -> c [color=blue constraint=false style=dashed]' in source
+    assert len(graphs) == 1
+    assert ExampleMachine._plan.listeners == ()
+
+    # However many views there are, there's one listener, and only the viewed machine's views hear about it
+    machines = [ExampleMachine() for _ in range(10)]
+    views = [GraphView(machine) for machine in machines] + [GraphView(machines[0])]
+    assert len(ExampleMachine._plan.listeners) == 1
+    machines[0].next()
+    assert [len(view.recent) for view in views] == [1] + [0] * 9 + [1]
+    for view in views:
+        view.close()
+    view.close()
+    assert ExampleMachine._plan.listeners == ()
+
+
+def test_profiler():
+    from src.DynamicStateMachine.Profiler import Profiler
+
+    ticks = iter(range(10_000))
+    profiler = Profiler(bounds=(1, 2, 4, 8), clock=lambda: next(ticks))
+    plan = ExampleMachine._plan
+    untimed = (list(plan.steps), list(plan.before))
+
+    profiler.attach(ExampleMachine)
+    try:
+        m = ExampleMachine()
+        m.next()
+        m.next(False)
+        m.next(False)
+        m.next()
+    finally:
+        profiler.detach(ExampleMachine)
+    # Back to exactly how it was
+    assert (plan.steps, plan.before) == untimed
+    assert ExampleMachine._plan.listeners == ()
+
+    edges = profiler.edge_counts(ExampleMachine)
+    assert edges[ExampleStates.a, ExampleStates.b] == 2
+    assert edges[None, ExampleStates.a] == 1
+    assert edges[ExampleStates.c, ExampleStates.a] == 1
+    calls = profiler.call_times(ExampleMachine)
+    assert calls['do_the_thing'].count == 1 and calls['before_a'].count == 2
+    # The fake clock ticks once per reading, so each call takes 1 "second"
+    assert calls['before_a'].counts[0] == 2
+    assert profiler.state_times(ExampleMachine)[ExampleStates.a].count == 2
+
+    data = profiler.as_dict()['ExampleMachine']
+    assert data['transitions']['a -> b'] == 2
+    text = profiler.prometheus()
+    assert 'dynamicstatemachine_transitions_total{machine="ExampleMachine",from="a",to="b"} 2' in text
+    assert 'dynamicstatemachine_call_seconds_bucket{machine="ExampleMachine",method="do_the_thing",le="+Inf"} 1' in text
+    assert 'dynamicstatemachine_state_seconds_count{machine="ExampleMachine",state="a"} 2' in text
+
+    source = m.construct_graphvis(heat=profiler).source
+    assert 'a -> b [color="0.000 0.8 0.9" penwidth=5.00 tooltip=2]' in source
+
+    # Machines dropped without finishing are forgotten, and ones without weakrefs are only kept up to max_tracked
+    profiler = Profiler(max_tracked=10)
+    for cls in (LoopMachine, SlimMachine):
+        profiler.attach(cls)
+        try:
+            for _ in range(50):
+                cls().next()
+        finally:
+            profiler.detach(cls)
+    assert profiler.state_times(LoopMachine)[LoopStates.idle].count == 50
+    assert len(profiler._classes[SlimMachine].entered) == 0
+    profiler = Profiler(max_tracked=10)
+    profiler.attach(SlimMachine)
+    machines = [SlimMachine() for _ in range(50)]
+    assert len(profiler._classes[SlimMachine].entered) == 10
+    profiler.detach(SlimMachine)
+
+    # Coroutines are timed until they're done
+    import asyncio
+    from src.DynamicStateMachine.AsyncDynamicStateMachine import AsyncDynamicStateMachine
+
+    class SlowMachine(AsyncDynamicStateMachine):
+        async def before_b(self):
+            await asyncio.sleep(.05)
+
+        states = ExampleStates
+        initial = ExampleStates.a
+        transitions = (ExampleStates.a >> ExampleStates.b,)
+
+    profiler = Profiler()
+    profiler.attach(SlowMachine)
+    async def main():
+        m = SlowMachine()
+        await m.start()
+        await m.next()
+    asyncio.run(main())
+    profiler.detach(SlowMachine)
+    assert profiler.call_times(SlowMachine)['before_b'].sum >= .04
+
+
+def test_pure_transitions():
+    from src.DynamicStateMachine.TransitionCache import pure
+    from src.DynamicStateMachine.Transition import Transition
+
+    class RouteStates(States):
+        idle = 'idle'
+        ack = 'ack'
+        error = 'error'
+
+    class RouteMachine(DynamicStateMachine):
+        calls = 0
+
+        @pure(maxsize=2)
+        def route(self, msg_type, *, retries=0):
+            RouteMachine.calls += 1
+            return self.to_ack if msg_type == 'ACK' else (RouteStates.error, 'bad message')
+
+        def to_ack(self):
+            RouteMachine.calls += 1
+            return RouteStates.ack
+
+        states = RouteStates
+        initial = RouteStates.idle
+        transitions = (
+            RouteStates.idle >> route,
+            RouteStates.ack >> RouteStates.idle,
+            RouteStates.error >> RouteStates.idle,
+        )
+
+    RouteMachine.route.cache_clear()
+    m = RouteMachine()
+    assert m.next('ACK', 'ignored') == RouteStates.ack
+    m.next()
+    # The whole chain is cached, so nothing is called the 2nd time
+    assert m.next('ACK', extra=1) == RouteStates.ack
+    assert RouteMachine.calls == 2
+    m.next()
+    assert list(m.run([('NAK',), ()])) == [
+        Transition(RouteStates.idle, RouteStates.error, 'bad message'),
+        Transition(RouteStates.error, RouteStates.idle),
+    ]
+    assert m.next('NAK') == RouteStates.error
+    assert RouteMachine.calls == 3
+    assert RouteMachine.route.cache_info() == (2, 2, 2, 2)
+
+    # The least recently used entry is dropped
+    m.next()
+    m.next('ACK', retries=1)
+    assert RouteMachine.route.cache_info().currsize == 2
+    m.next()
+    m.next('ACK')
+    assert RouteMachine.route.cache_info().misses == 4
+
+    RouteMachine.route.invalidate(RouteStates.idle)
+    assert RouteMachine.route.cache_info().currsize == 0
+    # Unhashable parameters aren't cached
+    m.next()
+    m.next(['ACK'], retries=[])
+    assert RouteMachine.route.cache_info().currsize == 0
+
+    # Subclasses which override what it returns get their own entries
+    class SubMachine(RouteMachine):
+        def to_ack(self):
+            return RouteStates.error
+
+    m.next()
+    assert m.next('ACK') == RouteStates.ack
+    sub = SubMachine()
+    assert sub.next('ACK') == RouteStates.error
+    assert RouteMachine.route.cache_info().currsize == 2
+
+    # Asynchronous machines can use them too, including ones which return coroutine methods
+    import asyncio
+    from src.DynamicStateMachine.AsyncDynamicStateMachine import AsyncDynamicStateMachine
+
+    class AsyncRouteMachine(AsyncDynamicStateMachine):
+        calls = 0
+
+        @pure
+        def route(self, msg_type):
+            AsyncRouteMachine.calls += 1
+            return self.to_ack if msg_type == 'ACK' else RouteStates.error
+
+        async def to_ack(self):
+            AsyncRouteMachine.calls += 1
+            return RouteStates.ack, 'acked'
+
+        states = RouteStates
+        initial = RouteStates.idle
+        transitions = (
+            RouteStates.idle >> route,
+            RouteStates.ack >> RouteStates.idle,
+            RouteStates.error >> RouteStates.idle,
+        )
+
+    async def run():
+        m = AsyncRouteMachine(start_immediately=False)
+        await m.start()
+        results = []
+        for event in ('ACK', 'NAK', 'ACK'):
+            results.append(await m.next(event))
+            await m.next()
+        return results
+
+    assert asyncio.run(run()) == [RouteStates.ack, RouteStates.error, RouteStates.ack]
+    assert AsyncRouteMachine.calls == 3 and AsyncRouteMachine.route.cache_info()[:2] == (1, 2)
+
+
+def test_lazy_imports():
+    import subprocess
+    import sys
+    from pathlib import Path
+
+    # In a fresh interpreter, since graphviz etc. have already been imported in this one
+    code = (
+        'import sys\n'
+        'from src.DynamicStateMachine import DynamicStateMachine, States\n'
+        'class S(States):\n'
+        '    a = 1\n'
+        '    b = 2\n'
+        'class M(DynamicStateMachine):\n'
+        '    def go(self, x=True):\n'
+        '        return S.a if x else None\n'
+        '    states = S\n'
+        '    initial = S.a\n'
+        '    transitions = (S.a >> S.b, S.b >> go)\n'
+        'M().next()\n'
+        'M().next()\n'
+        'print(" ".join(sorted({"graphviz", "dis", "ast", "inspect", "numpy", "multiprocessing"} & set(sys.modules))))\n'
+    )
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).parent.parent)
+    assert result.stdout.strip() == ''
+
+    # The modules that aren't needed to run a machine aren't imported until they're used, and then the package's
+    # names are the classes, not the modules they're in
+    code = (
+        'import sys\n'
+        'import src.DynamicStateMachine as package\n'
+        'lazy = {f"src.DynamicStateMachine.{name}" for name in package._LAZY.values()}\n'
+        'print(" ".join(sorted((lazy | {"graphviz", "numpy", "multiprocessing"}) & set(sys.modules))))\n'
+        'print(isinstance(package.Profiler, type), package.Histogram.__module__)\n'
+        'import src.DynamicStateMachine.Graphing\n'
+        'print(isinstance(package.AnalysisCache, type))\n'
+    )
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).parent.parent)
+    assert result.stdout.split('\n')[:3] == ['', 'True src.DynamicStateMachine.Profiler', 'True']
+
+
+def test_compiled_machine():
+    from src.DynamicStateMachine.Transition import Transition
+
+    Compiled = LoopMachine.compile()
+    assert LoopMachine.compile() is Compiled and Compiled.compile() is Compiled
+    assert issubclass(Compiled, LoopMachine) and Compiled._plan is LoopMachine._plan
+
+    seen = []
+    listener = lambda machine, transition: seen.append(transition)
+    LoopMachine.add_listener(listener)
+    try:
+        m = Compiled()
+        assert list(m.run([(), (), (True,), (), (), (False,)])) == [
+            Transition(LoopStates.idle, LoopStates.busy),
+            Transition(LoopStates.busy, LoopStates.check),
+            Transition(LoopStates.check, LoopStates.idle),
+            Transition(LoopStates.idle, LoopStates.busy),
+            Transition(LoopStates.busy, LoopStates.check),
+            Transition(LoopStates.check, None),
+        ]
+    finally:
+        LoopMachine.remove_listener(listener)
+    # Including starting
+    assert m.busy_count == 2 and len(seen) == 7
+
+    # Transitions through virtual states with hooks still call them
+    class HookedLoopMachine(LoopMachine):
+        log = ''
+
+        def before_hop1(self, *args):
+            self.log += f'before hop1 {args}\n'
+
+        def after_hop1(self):
+            self.log += 'after hop1\n'
+
+    m = HookedLoopMachine.compile()()
+    assert m.next(1, 2) is LoopStates.busy
+    assert m.log == 'before hop1 (1, 2)\nafter hop1\n'
+
+    m = SlimMachine.compile()()
+    assert not hasattr(m, '__dict__')
+
+    # Compiling doesn't build another DispatchPlan, since the compiled class shares its original's
+    import sys
+    module = sys.modules['src.DynamicStateMachine.DynamicStateMachine']
+    built = []
+    class CountingPlan(module.DispatchPlan):
+        def __init__(self, machine_cls):
+            built.append(machine_cls)
+            super().__init__(machine_cls)
+    original, module.DispatchPlan = module.DispatchPlan, CountingPlan
+    try:
+        class FreshLoopMachine(LoopMachine):
+            pass
+        FreshLoopMachine.compile()
+    finally:
+        module.DispatchPlan = original
+    assert built == [FreshLoopMachine]
+
+
+def test_profile_compiled_machine():
+    from src.DynamicStateMachine.Profiler import Profiler
+
+    Compiled = LoopMachine.compile()
+    profiler = Profiler()
+    profiler.attach(LoopMachine)
+    try:
+        m = Compiled()
+        list(m.run([(), (), (True,), (), (), (False,)]))
+    finally:
+        profiler.detach(LoopMachine)
+    assert profiler.call_times(LoopMachine)['after_busy'].count == 2
+    assert profiler.call_times(LoopMachine)['decide'].count == 2
+    assert profiler.edge_counts(LoopMachine)[LoopStates.check, None] == 1
+
+    # Once it's detached, the generated code is used again
+    m = Compiled()
+    list(m.run([(), (), (False,)]))
+    assert m.finished and profiler.call_times(LoopMachine)['after_busy'].count == 2
+    assert LoopMachine._plan.profilers == 0
+
+
+def test_event_bus():
+    import threading
+    from src.DynamicStateMachine.EventBus import EventBus
+    from src.DynamicStateMachine.Transition import Transition
+
+    everything, busy, ends = [], [], []
+    with EventBus(capacity=4, thread=False, clock=lambda: 0) as bus:
+        bus.attach(LoopMachine)
+        bus.subscribe(everything.extend)
+        bus.subscribe(busy.extend, state=LoopStates.busy)
+        bus.subscribe(ends.extend, edge=(LoopStates.check, None))
+        m = LoopMachine()
+        m.next()
+        m.next()
+        # Nothing's delivered until it's drained
+        assert everything == []
+        bus.flush()
+        assert [e.transition for e in everything] == [
+            Transition(None, LoopStates.idle), Transition(LoopStates.idle, LoopStates.busy),
+            Transition(LoopStates.busy, LoopStates.check),
+        ]
+        assert len(busy) == 1 and busy[0].machine is m
+
+        # A full buffer drops what doesn't fit
+        for _ in range(4):
+            m.next()
+        m.next(False)
+        assert bus.dropped == 1
+        bus.flush()
+        assert ends == []
+    assert LoopMachine._plan.listeners == ()
+
+    # Coalescing merges the newest event into the one that's already waiting for that machine
+    with EventBus(capacity=2, policy='coalesce', thread=False) as bus:
+        bus.attach(LoopMachine)
+        m = LoopMachine()
+        for go in (True, True, True, True, True, False):
+            m.next(go)
+        events = []
+        bus.subscribe(events.extend)
+        bus.flush()
+        assert [e.transition for e in events] == [Transition(None, LoopStates.idle), Transition(LoopStates.idle, None)]
+        assert bus.coalesced == 5
+
+    # With the delivery thread, blocking waits for room instead of losing anything
+    delivered = threading.Event()
+    events = []
+    def slow(batch):
+        events.extend(batch)
+        delivered.set()
+    with EventBus(capacity=2, policy='block', batch_size=1, interval=.01) as bus:
+        bus.subscribe(slow)
+        bus.attach(LoopMachine)
+        m = LoopMachine()
+        while not m.finished:
+            m.next(len(events) < 5)
+        assert delivered.wait(5)
+    assert events[-1].transition.new is None and bus.dropped == 0
+
+
+def test_journal(tmp_path):
+    from src.DynamicStateMachine.Journal import Journal, read_journal, replay_journal, restore_journal
+
+    path = tmp_path / 'example.journal'
+    machines = {key: ExampleMachine(start_immediately=False) for key in range(3)}
+    with Journal(path, ExampleMachine, key=lambda m: m.key, batch=4, clock=lambda: 1.5) as journal:
+        for key, m in machines.items():
+            m.key = key
+            m.start()
+        machines[0].next()
+        machines[1].next()
+        machines[1].next(True)
+    # Appends to what's already there
+    with Journal(path, ExampleMachine, key=lambda m: m.key):
+        machines[2].next()
+        machines[2].next(False)
+        machines[2].next(False)
+        machines[2].next(True)
+        machines[2].next(False)
+        machines[2].next(True)
+    assert ExampleMachine._plan.listeners == ()
+
+    records = list(read_journal(path))
+    # b -> c goes through pre_c, which has hooks, so it shows up as 2 transitions
+    assert len(records) == 3 + 3 + 8
+    assert records[0] == (0, -1, ExampleStates.a.id, 1.5, None)
+    assert records[5][:3] == (1, ExampleStates.b.id, ExampleStates.a.id)
+    assert records[5].comment == 'if decider is True'
+
+    cls, ids = replay_journal(path)
+    assert cls is ExampleMachine
+    assert ids == {0: ExampleStates.b.id, 1: ExampleStates.a.id, 2: -1}
+    restored = restore_journal(path, ExampleMachine)
+    assert {key: m.state for key, m in restored.items()} == {0: ExampleStates.b, 1: ExampleStates.a}
+
+
+def test_states_factories():
+    import enum
+
+    class Color(enum.Enum):
+        red = 'r'
+        green = 'g'
+
+    ColorStates = States.from_enum(Color)
+    assert ColorStates.__name__ == 'Color' and ColorStates.__module__ == __name__
+    assert ColorStates.green.value == 'g' and ColorStates.green.id == 1 and ColorStates.green.owner is ColorStates
+
+    # Values don't have to be hashable
+    ConfigStates = States.from_mapping('ConfigStates', {'idle': {'timeout': 5}, 'hop': None, 'busy': ['x']})
+    assert ConfigStates.hop.virtual and ConfigStates._states_list == [ConfigStates.idle, ConfigStates.hop, ConfigStates.busy]
+
+    class ConfigMachine(DynamicStateMachine):
+        states = ConfigStates
+        initial = ConfigStates.idle
+        transitions = (
+            ConfigStates.idle >> ConfigStates.hop,
+            ConfigStates.hop >> ConfigStates.busy,
+            ConfigStates.busy >> ConfigStates.idle,
+        )
+
+    m = ConfigMachine()
+    assert m.next() is ConfigStates.busy
+    m.state = {'timeout': 5}
+    assert m.state is ConfigStates.idle
+    with pytest.raises(ValueError):
+        m.state = ['y']
+
+    Big = States.from_iterable('Big', (f's{i}' for i in range(10_000)))
+    assert Big.s9999.id == 9999 and Big._from_value('s5') is Big.s5
+    with pytest.raises(ValueError):
+        States.from_iterable('Bad', ['a', 'a'])
+    with pytest.raises(ValueError):
+        States.from_iterable('Bad', ['_a'])
+
+
+def test_graph_index():
+    index = ExampleMachine.graph_index()
+    assert ExampleMachine.graph_index() is index
+    assert index.can_reach(ExampleStates.c, ExampleStates.b) and index.can_finish(ExampleStates.a)
+    assert index.reachable_from(ExampleStates.pre_c) == set(ExampleStates._states_list)
+    assert index.unreachable_states() == set() and index.dead_states() == set()
+    assert index.unresolved == {}
+
+    class TrapStates(States):
+        start = 'start'
+        trap1 = 'trap1'
+        trap2 = 'trap2'
+        orphan = 'orphan'
+        stuck = 'stuck'
+
+    class TrapMachine(DynamicStateMachine):
+        def choose(self, x=0):
+            if x:
+                return self.end_it
+            return TrapStates.trap1
+
+        def end_it(self):
+            return None
+
+        states = TrapStates
+        initial = TrapStates.start
+        transitions = (
+            TrapStates.start >> choose,
+            TrapStates.trap1 >> TrapStates.trap2,
+            TrapStates.trap2 >> TrapStates.trap1,
+            TrapStates.orphan >> TrapStates.stuck,
+        )
+
+    index = TrapMachine.graph_index()
+    assert index.unreachable_states() == {TrapStates.orphan, TrapStates.stuck}
+    assert index.dead_states() == {TrapStates.trap1, TrapStates.trap2, TrapStates.orphan, TrapStates.stuck}
+    assert index.can_finish(TrapStates.start) and not index.can_reach(TrapStates.trap1, TrapStates.start)
+    assert set(index.component_of(TrapStates.trap2)) == {TrapStates.trap1, TrapStates.trap2}
+
+    # Transition methods which return each other
+    class PingStates(States):
+        a = 'a'
+        b = 'b'
+        p = 'p'
+        q = 'q'
+
+    class PingMachine(DynamicStateMachine):
+        def to_p(self, x=0):
+            if x:
+                return self.to_q
+            return PingStates.p
+
+        def to_q(self, x=0):
+            if x:
+                return self.to_p
+            return PingStates.q
+
+        states = PingStates
+        initial = PingStates.a
+        transitions = (
+            PingStates.a >> to_p,
+            PingStates.b >> to_q,
+        )
+
+    index = PingMachine.graph_index()
+    for state in (PingStates.a, PingStates.b):
+        assert index.can_reach(state, PingStates.p) and index.can_reach(state, PingStates.q)
+        assert index.adjacency[state.id] == (PingStates.p.id, PingStates.q.id, index._end)
+    assert index.unreachable_states() == {PingStates.b}
+    assert set(index.components) == {(PingStates.a,), (PingStates.b,), (PingStates.p,), (PingStates.q,)}
+
+    # Stays fast on big machines
+    Big = States.from_iterable('Big', (f's{i}' for i in range(10_000)))
+    members = Big._states_list
+    BigMachine = type('BigMachine', (DynamicStateMachine,), dict(
+        states=Big, initial=members[0], transitions=tuple(a >> b for a, b in zip(members, members[1:])),
+    ))
+    index = BigMachine.graph_index()
+    assert index.can_reach(members[0], members[-1]) and not index.can_reach(members[-1], members[0])
+    assert index.dead_states() == set(members) and len(index.components) == 10_000
+
+
+def test_simulate():
+    from src.DynamicStateMachine.Simulation import simulate
+
+    result = simulate(LoopMachine, {True: 3, False: 1}, runs=2000, processes=1, seed=1, max_steps=30)
+    assert simulate(LoopMachine, {True: 3, False: 1}, runs=2000, processes=1, seed=1, max_steps=30) == result
+    # Every loop is idle -> busy -> check -> idle, 3 steps
+    assert sum(result.lengths) + result.unfinished == 2000
+    assert all(count == 0 for n, count in enumerate(result.lengths) if n % 3)
+    assert 8 < result.mean_length() < 16
+    visits = dict(zip(LoopStates._states_list, result.visits))
+    edges = result.edges()
+    # Virtual states are counted too
+    assert visits[LoopStates.hop1] == visits[LoopStates.hop2] == edges[LoopStates.idle, LoopStates.hop1] > 0
+    assert edges[None, LoopStates.idle] == 2000
+    assert edges[LoopStates.check, None] == sum(result.lengths)
+    # Nothing ran any hooks
+    assert not hasattr(LoopMachine, 'busy_count')
+
+    # Each run gets its own machine, so what a transition method keeps on it doesn't carry over
+    class CountStates(States):
+        counting = 'counting'
+
+    class CountingMachine(DynamicStateMachine):
+        def count(self):
+            self.n = getattr(self, 'n', 0) + 1
+            return None if self.n == 3 else CountStates.counting
+
+        states = CountStates
+        initial = CountStates.counting
+        transitions = (CountStates.counting >> count,)
+
+    result = simulate(CountingMachine, None, runs=50, processes=1, seed=1, max_steps=10)
+    assert result.lengths[3] == 50 and result.unfinished == 0
+
+    # Spread across processes, each with its own seed
+    parallel = simulate(LoopMachine, [True, True, True, False], runs=2000, processes=2, seed=1, max_steps=30)
+    assert sum(parallel.lengths) + parallel.unfinished == 2000
+    assert parallel.edges()[None, LoopStates.idle] == 2000
+
+
+def test_export(tmp_path):
+    import io
+    import json
+    from src.DynamicStateMachine.Export import write_dot, write_json
+
+    # The same as the graphviz source, for every combination of options
+    for options in (dict(), dict(use_names=False, split_ends=False), dict(include_start=False, disconnect_virtual=True),
+                    dict(graph_attrs=dict(name='example graph', graph_attr=dict(rankdir='LR')))):
+        out = io.StringIO()
+        write_dot(ExampleMachine, out, **options)
+        dot = ExampleMachine().construct_graphvis(highlighted=None, **options)
+        if dot is not None:
+            assert out.getvalue() == dot.source
+
+    write_json(ExampleMachine(), tmp_path / 'graph.json', disconnect_virtual=True)
+    graph = json.loads((tmp_path / 'graph.json').read_text())
+    assert graph['machine'] == 'ExampleMachine'
+    nodes = {node['id']: node for node in graph['nodes']}
+    assert len(nodes) == len(graph['nodes'])
+    assert nodes['Start']['kind'] == 'start' and nodes['End0']['kind'] == 'end'
+    assert nodes['do_the_thing'] == dict(id='do_the_thing', label='do_the_thing', kind='transition',
+                                         attrs=dict(shape='oval', style='filled', fillcolor='grey80'))
+    assert nodes['pre_c0']['kind'] == 'virtual' and nodes['pre_c0']['label'] == 'pre_c'
+    edges = {(edge['from'], edge['to']): edge['label'] for edge in graph['edges']}
+    assert edges['do_the_thing', 'a'] == 'if decider is True'
+    assert edges['Start', 'a'] is None and ('do_the_thing', 'pre_c0') in edges
+    assert all(a in nodes and b in nodes for a, b in edges)
+
+    # States without a transition of their own are still listed, whether or not anything goes to them
+    class StuckStates(States):
+        a = 'a'
+        stuck = 'stuck'
+        lonely = 'lonely'
+
+    class StuckMachine(DynamicStateMachine):
+        states = StuckStates
+        initial = StuckStates.a
+        transitions = (StuckStates.a >> StuckStates.stuck,)
+
+    out = io.StringIO()
+    write_json(StuckMachine, out)
+    graph = json.loads(out.getvalue())
+    nodes = {node['id']: node for node in graph['nodes']}
+    assert nodes.keys() == {'Start', 'a', 'stuck', 'lonely'} and nodes['stuck']['kind'] == 'state'
+    assert all(edge['from'] in nodes and edge['to'] in nodes for edge in graph['edges'])
+    out = io.StringIO()
+    write_dot(StuckMachine, out)
+    dot = StuckMachine().construct_graphvis(highlighted=None)
+    if dot is not None:
+        assert out.getvalue() == dot.source
+
+
+@pytest.mark.parametrize('machine_cls', [ExampleMachine, ExampleMachine.compile()], ids=['plan', 'compiled'])
+def test_peek_and_fork(machine_cls):
+    from src.DynamicStateMachine.Transition import Transition
+
+    m = machine_cls()
+    m.next()
+    log = m.log
+    seen = []
+    listener = lambda machine, transition: seen.append(transition)
+    ExampleMachine.add_listener(listener)
+    try:
+        # Through the virtual pre_c, without running any hooks
+        assert m.peek(False) is ExampleStates.c
+        assert m.peek(True) is ExampleStates.a
+        assert m.state is ExampleStates.b
+        assert m.log == log + 'decide: c\ndecide: a\n'
+        assert seen == []
+
+        # Forks share nothing they change, and start where the original was
+        forks = [m.fork() for _ in range(3)]
+        assert all(type(f) is machine_cls and f.state is ExampleStates.b for f in forks)
+        forks[0].next(False)
+        forks[1].next(True)
+        assert [f.state for f in forks] == [ExampleStates.c, ExampleStates.a, ExampleStates.b]
+        assert m.state is ExampleStates.b and m.log == log + 'decide: c\ndecide: a\n'
+        assert forks[0].log.endswith('before c\n') and seen[0] == Transition(ExampleStates.b, ExampleStates.pre_c)
+        assert forks[0].peek(True) is None
+    finally:
+        ExampleMachine.remove_listener(listener)
+
+    slim = SlimMachine()
+    slim.next(); slim.next()
+    clone = slim.fork()
+    assert clone.busy_count == 1 and clone.state is LoopStates.check and not hasattr(clone, '__dict__')
+    assert SlimMachine().fork().peek() is LoopStates.busy
+    finished = slim.fork()
+    finished.next(False)
+    assert finished.peek() is None and slim.state is LoopStates.check
+
+
+class SessionStates(States):
+    waiting = 'waiting'
+    active = 'active'
+    retry = None
+    expired = 'expired'
+
+
+class SessionMachine(DynamicStateMachine):
+    def on_active(self):
+        self.log = getattr(self, 'log', '') + 'active\n'
+
+    def act(self, go=True):
+        return SessionStates.active if go else SessionStates.waiting
+
+    states = SessionStates
+    initial = SessionStates.waiting
+    transitions = (
+        SessionStates.waiting >> act,
+        SessionStates.active >> act,
+        SessionStates.retry >> SessionStates.waiting,
+        SessionStates.expired >> act,
+    )
+    timeouts = {
+        SessionStates.waiting: (30, SessionStates.expired),
+        SessionStates.active: (5, SessionStates.retry),
+        SessionStates.expired: (3600 * 24 * 365 * 10, None),
+    }
+
+
+def test_timer_wheel():
+    from src.DynamicStateMachine.TimerWheel import TimerWheel, TIMEOUT_COMMENT
+    from src.DynamicStateMachine.Transition import Transition
+
+    now = [1000.0]
+    wheel = TimerWheel(resolution=.5, slots=8, levels=3, clock=lambda: now[0])
+    wheel.attach(SessionMachine)
+    seen = []
+    listener = lambda machine, transition: seen.append(transition)
+    SessionMachine.add_listener(listener)
+    try:
+        machines = [SessionMachine() for _ in range(100)]
+        assert len(wheel) == 100 and wheel.deadline(machines[0]) == 1030
+        # Events restart the timer
+        now[0] = 1020
+        for m in machines[:50]:
+            m.next()
+        assert wheel.deadline(machines[0]) == 1025
+
+        now[0] = 1024.9
+        assert wheel.advance() == 0
+        now[0] = 1025
+        assert wheel.advance() == 50
+        # Through the virtual retry, back to waiting, which has its own timeout
+        assert machines[0].state is SessionStates.waiting and wheel.deadline(machines[0]) == 1055
+        assert Transition(SessionStates.active, SessionStates.retry, TIMEOUT_COMMENT) in seen
+
+        # Cancelled timers don't fire
+        assert wheel.cancel(machines[50]) and not wheel.cancel(machines[50])
+        now[0] = 1030
+        assert wheel.advance() == 49
+        assert machines[51].state is SessionStates.expired and machines[50].state is SessionStates.waiting
+
+        # Further than the wheels reach, and jumping far ahead at once
+        assert wheel.deadline(machines[51]) == 1030 + 3600 * 24 * 365 * 10
+        now[0] = 1055
+        assert wheel.advance() == 50
+        assert all(m.state is SessionStates.expired for m in machines[:50])
+        now[0] = 1030 + 3600 * 24 * 365 * 10 - 1
+        assert wheel.advance() == 0
+        now[0] += 1
+        assert wheel.advance() == 49
+        assert all(m.finished for m in machines[51:]) and len(wheel) == 50
+        now[0] += 25
+        assert wheel.advance() == 50 and len(wheel) == 0
+    finally:
+        SessionMachine.remove_listener(listener)
+        wheel.close()
+
+    assert len(wheel) == 0
+    with pytest.raises(ValueError, match='positive'):
+        class BadMachine(SessionMachine):
+            timeouts = {SessionStates.active: (0, None)}